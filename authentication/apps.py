@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class AuthenticationConfig(AppConfig):
@@ -7,3 +8,6 @@ class AuthenticationConfig(AppConfig):
 
     def ready(self):
         import authentication.signals
+        from authentication.services.sharding import reserve_id_range
+
+        post_migrate.connect(reserve_id_range, sender=self)
@@ -0,0 +1,32 @@
+import threading
+
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+
+from authentication.services.metrics import PASSWORD_HASH_DURATION
+
+
+class TimedHasherMixin:
+    """
+    Records the duration of every hash and check. The algorithm name is
+    unchanged, so stored hashes stay valid either way.
+    """
+    _verifying = threading.local()
+
+    def encode(self, password, salt, *args, **kwargs):
+        # verify() re-encodes; that time is already counted as a check
+        if getattr(self._verifying, "active", False):
+            return super().encode(password, salt, *args, **kwargs)
+        with PASSWORD_HASH_DURATION.time(algorithm=self.algorithm, operation="encode"):
+            return super().encode(password, salt, *args, **kwargs)
+
+    def verify(self, password, encoded):
+        self._verifying.active = True
+        try:
+            with PASSWORD_HASH_DURATION.time(algorithm=self.algorithm, operation="verify"):
+                return super().verify(password, encoded)
+        finally:
+            self._verifying.active = False
+
+
+class TimedPBKDF2PasswordHasher(TimedHasherMixin, PBKDF2PasswordHasher):
+    pass
@@ -0,0 +1,52 @@
+import math
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.services.email_filter import BloomFilter
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the email filter for synthetic user counts and report its memory, build and lookup "
+        "time and the measured false-positive rate on emails that are not in it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, action="append", help="user counts (default 1M, 10M)")
+        parser.add_argument("--error-rate", type=float, default=0.01)
+        parser.add_argument("--probes", type=int, default=200_000, help="unknown emails looked up per size")
+
+    def handle(self, *args, **options):
+        sizes = options["users"] or [1_000_000, 10_000_000]
+        error_rate = options["error_rate"]
+        if not 0 < error_rate < 1:
+            raise CommandError("--error-rate must be between 0 and 1")
+
+        self.stdout.write(
+            f"{'users':>11} {'hashes':>6} {'memory':>10} {'bits/user':>9} {'build':>8} "
+            f"{'lookup':>9} {'false positives':>16}"
+        )
+        for size in sizes:
+            bloom = BloomFilter(size, error_rate)
+            started = time.perf_counter()
+            for n in range(size):
+                bloom.add(f"user-{n}@example.com")
+            build = time.perf_counter() - started
+
+            missing = [f"nobody-{n}@example.com" for n in range(options["probes"])]
+            started = time.perf_counter()
+            hits = sum(key in bloom for key in missing)
+            lookup = (time.perf_counter() - started) / len(missing)
+
+            members = [f"user-{n}@example.com" for n in range(0, size, max(size // 10_000, 1))]
+            if not all(key in bloom for key in members):
+                raise CommandError("a member was reported missing")
+
+            self.stdout.write(
+                f"{size:>11,} {bloom.hashes:>6} {bloom.nbytes / 2 ** 20:8.1f}MB {bloom.size / size:9.2f} "
+                f"{build:7.1f}s {lookup * 1e6:7.2f}us {hits / len(missing):15.3%}"
+            )
+        self.stdout.write(
+            f"target {error_rate:.3%}; optimum {-math.log(error_rate) / math.log(2) ** 2:.2f} bits per user"
+        )
@@ -0,0 +1,77 @@
+import os
+import re
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+# what a worker does before it can serve its first request
+STARTUP = (
+    "import django; django.setup(); "
+    "from django.urls import get_resolver; get_resolver().url_patterns"
+)
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def parse(stderr):
+    """{module: (self_us, cumulative_us)} for the modules imported at top level."""
+    modules = {}
+    for match in LINE.finditer(stderr):
+        self_us, cumulative_us, indent, name = match.groups()
+        modules[name] = (int(self_us), int(cumulative_us), len(indent) == 1)
+    return modules
+
+
+class Command(BaseCommand):
+    help = "Measure interpreter start-up plus django.setup() and URL loading with `python -X importtime`."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5)
+        parser.add_argument("--top", type=int, default=15)
+
+    def run_once(self):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", STARTUP],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            env={**os.environ, "DJANGO_SETTINGS_MODULE": settings.SETTINGS_MODULE},
+        )
+        if result.returncode:
+            raise CommandError(result.stderr[-2000:])
+        return parse(result.stderr)
+
+    def handle(self, *args, **options):
+        runs = [self.run_once() for _ in range(options["runs"])]
+
+        totals = [sum(self_us for self_us, _, _ in run.values()) for run in runs]
+        self.stdout.write(
+            f"imports: {len(runs[-1])} modules, median {statistics.median(totals) / 1000:.1f} ms "
+            f"(min {min(totals) / 1000:.1f}, max {max(totals) / 1000:.1f}) over {len(runs)} runs"
+        )
+
+        # self time rolled up to the top-level package, median across runs
+        packages = defaultdict(list)
+        for run in runs:
+            per_package = defaultdict(int)
+            for name, (self_us, _, _) in run.items():
+                per_package[name.split(".")[0]] += self_us
+            for package, self_us in per_package.items():
+                packages[package].append(self_us)
+        ranked = sorted(packages.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+        self.stdout.write("by package (self time)")
+        for package, samples in ranked[:options["top"]]:
+            self.stdout.write(f"  {package:<28} {statistics.median(samples) / 1000:8.1f} ms")
+
+        cumulative = sorted(
+            ((name, cumulative_us) for name, (_, cumulative_us, top) in runs[-1].items() if top),
+            key=lambda item: item[1], reverse=True,
+        )
+        self.stdout.write("top-level imports (cumulative, last run)")
+        for name, cumulative_us in cumulative[:options["top"]]:
+            self.stdout.write(f"  {name:<28} {cumulative_us / 1000:8.1f} ms")
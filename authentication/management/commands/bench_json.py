@@ -0,0 +1,134 @@
+import datetime
+import decimal
+import io
+import timeit
+import uuid
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from authentication.models import User, UserProfile
+from authentication.serializers.profile import AdminUserSerializer, MeSerializer
+from core import fastjson
+
+
+class Rollback(Exception):
+    pass
+
+
+def edge_cases():
+    """Types and strings where the two encoders could disagree."""
+    now = timezone.now()
+    return {
+        "aware": now,
+        "naive": datetime.datetime(2026, 1, 2, 3, 4, 5, 6),
+        "date": now.date(),
+        "time": datetime.time(12, 30),
+        "duration": datetime.timedelta(hours=1, microseconds=5),
+        "uuid": uuid.uuid4(),
+        "decimal": decimal.Decimal("12.50"),
+        "unicode": "Zoë 東京 🔐",
+        "separators": "line paragraph ",
+        "escapes": "quote \" backslash \\ tab \t nul \x00",
+        "numbers": [0, -1, 2 ** 63 - 1, 2 ** 64, 0.1, 1.5e-7, True, None],
+        "int keys": {1: "one", 2: "two"},
+        "nested": [[], {}, [{"a": ()}]],
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare core.fastjson's orjson renderer and parser with DRF's JSONRenderer and JSONParser "
+        "on admin user list pages and /me payloads, and check that both write the same bytes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, action="append", help="admin page sizes (default 50, 500)")
+        parser.add_argument("--number", type=int, default=0, help="runs per timing (default: about 0.2 s worth)")
+
+    def handle(self, *args, **options):
+        if fastjson.orjson is None:
+            raise CommandError("orjson is not installed; ORJSONRenderer is using the stdlib encoder")
+
+        sizes = options["users"] or [50, 500]
+        # fake users, thrown away when done
+        try:
+            with transaction.atomic():
+                payloads = self.build_payloads(sizes)
+                raise Rollback
+        except Rollback:
+            pass
+        payloads["edge cases"] = edge_cases()
+
+        stock, fast = JSONRenderer(), fastjson.ORJSONRenderer()
+        mismatches = []
+        self.stdout.write(f"{'payload':<24} {'bytes':>9} {'DRF render':>11} {'orjson':>9} {'x':>6}"
+                          f" {'DRF parse':>10} {'orjson':>9} {'x':>6}")
+        for name, data in payloads.items():
+            expected = stock.render(data)
+            if fast.render(data) != expected:
+                mismatches.append(f"render: {name}")
+            if self.parse(fastjson.ORJSONParser(), expected) != self.parse(JSONParser(), expected):
+                mismatches.append(f"parse: {name}")
+
+            render_stock = self.time(lambda: stock.render(data), options["number"])
+            render_fast = self.time(lambda: fast.render(data), options["number"])
+            parse_stock = self.time(lambda: self.parse(JSONParser(), expected), options["number"])
+            parse_fast = self.time(lambda: self.parse(fastjson.ORJSONParser(), expected), options["number"])
+            self.stdout.write(
+                f"{name:<24} {len(expected):9} {render_stock:9.1f}us {render_fast:7.1f}us "
+                f"{render_stock / render_fast:5.1f}x {parse_stock:8.1f}us {parse_fast:7.1f}us "
+                f"{parse_stock / parse_fast:5.1f}x"
+            )
+
+        if mismatches:
+            raise CommandError("output differs from DRF: " + ", ".join(mismatches))
+        self.stdout.write("renderer output and parsed data identical to DRF for every payload")
+
+    def build_payloads(self, sizes):
+        password = make_password("bench-json-password")
+        created = User.objects.bulk_create([
+            User(
+                email=f"bench-json-{n}@example.com",
+                slug=f"bench-json-{n}",
+                first_name="Bench",
+                last_name=f"Zoë {n}",
+                password=password,
+                is_active=True,
+                is_email_verified=True,
+                email_verified_at=timezone.now(),
+                last_login=timezone.now(),
+            )
+            for n in range(max(sizes))
+        ])
+        UserProfile.objects.bulk_create([UserProfile(user=user, bio="Bench user " * 5) for user in created])
+        ids = [user.pk for user in created]
+
+        payloads = {}
+        for size in sizes:
+            users = (
+                User.objects.filter(pk__in=ids[:size])
+                .select_related("profile")
+                .prefetch_related("groups", "user_permissions")
+                .order_by("pk")
+            )
+            payloads[f"admin users x{size}"] = AdminUserSerializer(users, many=True, context={"request": None}).data
+        profile = UserProfile.objects.select_related("user").get(user_id=ids[0])
+        payloads["me"] = MeSerializer(profile, context={"request": None}).data
+        payloads["me PATCH body"] = {"first_name": "Zoë", "bio": "Hello " * 20, "multi_factor_enabled": True}
+        return payloads
+
+    @staticmethod
+    def parse(parser, body):
+        return parser.parse(io.BytesIO(body), "application/json", {"encoding": "utf-8"})
+
+    @staticmethod
+    def time(fn, number):
+        timer = timeit.Timer(fn)
+        if not number:
+            number, _ = timer.autorange()
+        return min(timer.repeat(repeat=3, number=number)) / number * 1e6
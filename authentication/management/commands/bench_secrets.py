@@ -0,0 +1,97 @@
+import hashlib
+import hmac
+import math
+import secrets
+import timeit
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.services.secrets import (
+    MFA_ALPHABET,
+    TEMP_PASSWORD_ALPHABET,
+    SecretGenerator,
+)
+
+
+def legacy_random_string(alphabet, length):
+    return "".join(secrets.choice(alphabet) for _ in range(length))
+
+
+def legacy_mfa_hash(email, code):
+    return hmac.new(settings.SECRET_KEY.encode(), f"{email}:{code}".encode(), hashlib.sha256).hexdigest()
+
+
+def chi_square_critical(df, z=3.09):
+    """Wilson-Hilferty approximation of the chi-square quantile (z=3.09 -> p=0.001)."""
+    return df * (1 - 2 / (9 * df) + z * math.sqrt(2 / (9 * df))) ** 3
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark SecretGenerator against the per-character secrets.choice version and check its output distribution."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--number", type=int, default=20000, help="calls per timing")
+        parser.add_argument("--batch", type=int, default=1000, help="secrets per batch call")
+        parser.add_argument("--samples", type=int, default=2_000_000, help="characters for the distribution check")
+
+    def handle(self, *args, **options):
+        number = options["number"]
+        batch = options["batch"]
+
+        self.stdout.write("timings (microseconds per secret)")
+        cases = [
+            (
+                "mfa code",
+                lambda: legacy_random_string(MFA_ALPHABET, 8),
+                SecretGenerator.generate_mfa_code,
+                1,
+            ),
+            (
+                "temp password",
+                lambda: legacy_random_string(TEMP_PASSWORD_ALPHABET, 12),
+                SecretGenerator.generate_temp_password,
+                1,
+            ),
+            (
+                f"temp password x{batch}",
+                lambda: [legacy_random_string(TEMP_PASSWORD_ALPHABET, 12) for _ in range(batch)],
+                lambda: SecretGenerator.generate_temp_passwords(batch),
+                batch,
+            ),
+            (
+                "mfa hash",
+                lambda: legacy_mfa_hash("user@example.com", "AbCd1234"),
+                lambda: SecretGenerator.generate_mfa_hash("user@example.com", "AbCd1234"),
+                1,
+            ),
+        ]
+        for name, legacy, current, per_call in cases:
+            calls = max(number // per_call, 10)
+            before = min(timeit.repeat(legacy, number=calls, repeat=3)) / (calls * per_call) * 1e6
+            after = min(timeit.repeat(current, number=calls, repeat=3)) / (calls * per_call) * 1e6
+            self.stdout.write(f"  {name:<24} {before:8.2f} -> {after:8.2f}  ({before / after:5.1f}x)")
+
+        self.stdout.write("distribution (chi-square, p=0.001)")
+        failed = False
+        length = 64
+        count = options["samples"] // length
+        checks = (
+            ("mfa", MFA_ALPHABET, SecretGenerator.generate_mfa_codes),
+            ("temp password", TEMP_PASSWORD_ALPHABET, SecretGenerator.generate_temp_passwords),
+        )
+        for name, alphabet, generate in checks:
+            counts = Counter("".join(generate(count, length)))
+            total = sum(counts.values())
+            expected = total / len(alphabet)
+            statistic = sum((counts.get(char, 0) - expected) ** 2 / expected for char in alphabet)
+            critical = chi_square_critical(len(alphabet) - 1)
+            ok = statistic < critical and set(counts) <= set(alphabet)
+            failed |= not ok
+            self.stdout.write(
+                f"  {name:<24} chi2={statistic:8.2f} critical={critical:8.2f} {'ok' if ok else 'FAIL'}"
+            )
+
+        if failed:
+            raise CommandError("output distribution is not uniform")
@@ -0,0 +1,150 @@
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Q
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from authentication.models import User, UserProfile
+from authentication.services import sharding, user_search
+from authentication.services.claims import AuthStateRefreshToken
+
+
+FIRST_NAMES = (
+    "John", "Joan", "Joanna", "Jose", "Maria", "Mario", "Ana", "Anne", "Li", "Wei", "Ahmed", "Fatima",
+    "Olga", "Oleg", "Sven", "Chloé", "Zoë", "Ravi", "Priya", "Kwame", "Amara", "Hiro", "Yuki", "Ebony",
+)
+LAST_NAMES = (
+    "Smith", "Smithers", "Garcia", "Garner", "Nguyen", "Müller", "Miller", "Okafor", "Quinn", "Kowalski",
+    "Ivanova", "Tanaka", "Silva", "Haddad", "Brown", "Brownlee", "Dubois", "Rossi", "Khan", "Larsen",
+)
+BIO_WORDS = (
+    "engineer", "designer", "astronomy", "coffee", "running", "photography", "teacher", "gardening",
+    "security", "music", "travel", "writer", "chess", "cycling", "data", "marketing", "biology", "film",
+)
+DOMAINS = ("example.com", "mail.example.org", "corp.example.net", "uni.example.edu")
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill a throwaway SQLite database with synthetic users, build the user search index and "
+        "time admin searches against it, next to an unindexed LIKE scan."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1_000_000)
+        parser.add_argument("--repeat", type=int, default=20, help="runs per query")
+        parser.add_argument("--keep", action="store_true", help="leave the database file behind")
+
+    def handle(self, *args, **options):
+        if sharding.is_enabled():
+            raise CommandError("run with USER_SHARDS unset: the benchmark uses one SQLite file")
+
+        directory = Path(tempfile.mkdtemp(prefix="bench-user-search-"))
+        connections.close_all()
+        connections.settings[DEFAULT_DB_ALIAS]["NAME"] = str(directory / "search.sqlite3")
+        del connections[DEFAULT_DB_ALIAS]
+
+        with override_settings(ALLOWED_HOSTS=["testserver"]):
+            call_command("migrate", verbosity=0)
+            call_command("createcachetable", verbosity=0)
+            if not user_search.is_available():
+                raise CommandError("this SQLite has no FTS5")
+            started = time.perf_counter()
+            self.create_users(options["users"])
+            self.stdout.write(f"created {options['users']:,} users in {time.perf_counter() - started:.0f} s")
+
+            started = time.perf_counter()
+            with transaction.atomic():
+                user_search.rebuild()
+            self.stdout.write(f"indexed in {time.perf_counter() - started:.1f} s, "
+                              f"database {self.database_size(directory) / 2 ** 20:.0f} MB")
+            self.run_queries(options["repeat"])
+
+        connections.close_all()
+        if not options["keep"]:
+            for path in directory.iterdir():
+                path.unlink()
+            directory.rmdir()
+
+    def create_users(self, count, batch=20_000):
+        rng = random.Random(0)
+        password = make_password("bench-user-search")
+        for start in range(0, count, batch):
+            users = []
+            for n in range(start, min(start + batch, count)):
+                first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+                users.append(User(
+                    email=f"{first.lower()}.{last.lower()}{n}@{rng.choice(DOMAINS)}",
+                    slug=f"user-{n}",
+                    first_name=first,
+                    last_name=last,
+                    password=password,
+                ))
+            with transaction.atomic():
+                created = User.objects.bulk_create(users)
+                UserProfile.objects.bulk_create([
+                    UserProfile(user=user, bio=" ".join(rng.sample(BIO_WORDS, 3))) for user in created
+                ])
+
+    @staticmethod
+    def database_size(directory):
+        return sum(path.stat().st_size for path in directory.iterdir())
+
+    def run_queries(self, repeat):
+        admin = User.objects.create_superuser(email="bench-admin@example.com", password="Bench-passw0rd")
+        client = Client(HTTP_AUTHORIZATION=f"Bearer {AuthStateRefreshToken.for_user(admin).access_token}")
+        url = reverse("admin-users-search")
+        response = client.get(url, {"q": "maria"})
+        if response.status_code != 200:
+            raise CommandError(f"search endpoint answered {response.status_code}")
+        # the start of one user's address, cut inside the number
+        email = User.objects.order_by("pk").values_list("email", flat=True)[User.objects.count() // 2]
+        fragment = email.partition("@")[0][:-2]
+        queries = [
+            ("rare word", "astronomy chess cycling", 1),
+            ("email fragment", fragment, 1),
+            ("first and last name", "maria garcia", 1),
+            ("two-letter prefix", "jo", 1),
+            ("accent-free name", "muller", 1),
+            ("deep page", "maria", 50),
+        ]
+        self.stdout.write(
+            f"\n{'query':<22} {'q':<26} {'page':>4} {'matches':>9} {'search':>9} {'endpoint':>9} {'LIKE scan':>10}"
+        )
+        for label, q, page in queries:
+            matches = len(user_search.search(q, limit=10 ** 7))
+            search = self.median(lambda: user_search.search(q, offset=(page - 1) * 20, limit=21), repeat)
+            endpoint = self.median(lambda: client.get(url, {"q": q, "page": page}), repeat)
+            like = self.median(lambda: self.like_scan(q, page), 1)
+            self.stdout.write(
+                f"{label:<22} {q:<26} {page:>4} {matches:>9,} {search:7.1f}ms {endpoint:7.1f}ms {like:8.0f}ms"
+            )
+
+    @staticmethod
+    def like_scan(q, page):
+        """What search without the index costs: every term as a substring of any column."""
+        queryset = User.objects.all()
+        for word in user_search.terms(q):
+            queryset = queryset.filter(
+                Q(email__icontains=word) | Q(first_name__icontains=word)
+                | Q(last_name__icontains=word) | Q(profile__bio__icontains=word)
+            )
+        return list(queryset.order_by("pk").values_list("pk", flat=True)[(page - 1) * 20:page * 20 + 1])
+
+    @staticmethod
+    def median(fn, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
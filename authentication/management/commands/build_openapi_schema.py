@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core import schema
+
+
+class Command(BaseCommand):
+    help = "Render the OpenAPI schema once (JSON, YAML and gzip copies) for the cached schema view."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output-dir", help="defaults to settings.OPENAPI_SCHEMA_DIR")
+
+    def handle(self, *args, **options):
+        for path in schema.write(options["output_dir"]):
+            self.stdout.write(f"wrote {path} ({path.stat().st_size} bytes)")
@@ -0,0 +1,97 @@
+import pstats
+import statistics
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.profiling import FILENAME, profile_dir
+
+
+def pstats_label(func):
+    filename, lineno, name = func
+    if filename == "~":
+        # built-ins like <method 'execute' of 'sqlite3.Cursor' objects>
+        return name
+    for marker in ("site-packages/", "lib/python"):
+        if marker in filename:
+            filename = filename.split(marker, 1)[1]
+            break
+    return f"{name} ({filename}:{lineno})"
+
+
+class Command(BaseCommand):
+    help = (
+        "Aggregate request profiles written by core.profiling.ProfilingMiddleware per endpoint: "
+        "function tables from cProfile files, collapsed stacks from sampling files."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dir", type=Path, help="profile directory (default: PROFILE_DIR)")
+        parser.add_argument("--endpoint", action="append", default=[], help="only this URL name (repeatable)")
+        parser.add_argument("--top", type=int, default=15, help="rows listed per endpoint")
+        parser.add_argument(
+            "--folded", type=Path,
+            help="write the merged sampled stacks here, one root frame per endpoint, for flamegraph.pl or speedscope",
+        )
+
+    def handle(self, *args, **options):
+        directory = options["dir"] or profile_dir()
+        profiles = defaultdict(lambda: defaultdict(list))
+        for path in sorted(directory.glob("*")):
+            match = FILENAME.match(path.name)
+            if match and (not options["endpoint"] or match["endpoint"] in options["endpoint"]):
+                profiles[match["endpoint"]][match["kind"]].append((path, int(match["elapsed_us"])))
+        if not profiles:
+            raise CommandError(f"no profiles found in {directory}")
+
+        folded = []
+        for endpoint, kinds in sorted(profiles.items(), key=lambda item: -sum(map(len, item[1].values()))):
+            elapsed = sorted(us / 1000 for samples in kinds.values() for _, us in samples)
+            p95 = elapsed[min(int(len(elapsed) * 0.95), len(elapsed) - 1)]
+            self.stdout.write(
+                f"{endpoint}: {len(elapsed)} requests, median {statistics.median(elapsed):.1f} ms, "
+                f"p95 {p95:.1f} ms, max {elapsed[-1]:.1f} ms"
+            )
+            if kinds["prof"]:
+                self.write_functions(kinds["prof"], options["top"])
+            if kinds["folded"]:
+                stacks = self.read_stacks(kinds["folded"])
+                self.write_self_frames(stacks, options["top"])
+                folded += [f"{endpoint};{stack} {count}" for stack, count in stacks.items()]
+
+        if options["folded"]:
+            if not folded:
+                raise CommandError("no sampling profiles to fold; set PROFILER = 'sampling'")
+            options["folded"].write_text("\n".join(folded) + "\n")
+            self.stdout.write(f"collapsed stacks written to {options['folded']}")
+
+    def write_functions(self, samples, top):
+        merged = pstats.Stats(*(str(path) for path, _ in samples))
+        ranked = sorted(merged.stats.items(), key=lambda item: item[1][3], reverse=True)
+        n = len(samples)
+        self.stdout.write(f"  cProfile, {n} requests")
+        self.stdout.write(f"  {'cumulative ms/req':>18} {'own ms/req':>11} {'calls/req':>10}  function")
+        for func, (_, calls, own, cumulative, _) in ranked[:top]:
+            self.stdout.write(
+                f"  {cumulative * 1000 / n:18.2f} {own * 1000 / n:11.2f} {calls / n:10.1f}  {pstats_label(func)}"
+            )
+
+    def read_stacks(self, samples):
+        stacks = Counter()
+        for path, _ in samples:
+            for line in path.read_text().splitlines():
+                stack, _, count = line.rpartition(" ")
+                if stack:
+                    stacks[stack] += int(count)
+        return stacks
+
+    def write_self_frames(self, stacks, top):
+        total = sum(stacks.values()) or 1
+        own = Counter()
+        for stack, count in stacks.items():
+            own[stack.rsplit(";", 1)[-1]] += count
+        self.stdout.write(f"  sampling, {total} samples")
+        self.stdout.write(f"  {'own %':>7}  frame")
+        for frame, count in own.most_common(top):
+            self.stdout.write(f"  {count * 100 / total:7.1f}  {frame}")
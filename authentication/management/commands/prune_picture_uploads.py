@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from authentication.services import picture_uploads
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the part files of resumable picture uploads left unfinished for "
+        "PROFILE_PICTURE_UPLOAD_EXPIRY seconds. Run it periodically, e.g. hourly from cron."
+    )
+
+    def handle(self, *args, **options):
+        pruned = picture_uploads.prune()
+        self.stdout.write(f"deleted {pruned} expired part files from {picture_uploads.upload_dir()}")
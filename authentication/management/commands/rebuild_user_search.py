@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from authentication.services import sharding, user_search
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the full-text index behind the admin user search from the user and profile "
+        "tables, on every shard. Creates the index where it is missing."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", action="append", help="default: every shard")
+
+    def handle(self, *args, **options):
+        for alias in options["database"] or sharding.aliases():
+            connection = connections[alias]
+            if connection.vendor != "sqlite":
+                self.stdout.write(f"{alias}: not SQLite, search uses prefix matching")
+                continue
+            if not user_search.create_index(connection):
+                raise CommandError(f"{alias}: this SQLite has no FTS5")
+            started = time.perf_counter()
+            with transaction.atomic(using=alias):
+                count = user_search.rebuild(alias)
+            self.stdout.write(f"{alias}: indexed {count} users in {time.perf_counter() - started:.1f} s")
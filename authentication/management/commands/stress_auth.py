@@ -0,0 +1,334 @@
+import logging
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import Client
+from django.test.client import ClientHandler
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from authentication.models import (
+    EmailVerificationToken,
+    MultiFactorAuthCode,
+    PasswordResetToken,
+    User,
+    UserProfile,
+)
+from authentication.services import audit, sharding
+from authentication.services.claims import AuthStateRefreshToken
+
+
+PASSWORD = "Stress-passw0rd"
+
+
+class Run:
+    """Outcome of one scenario: one entry per request."""
+
+    def __init__(self):
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.latencies = []
+        self.results = {}
+        self.errored = set()
+        self._lock = threading.Lock()
+
+    def add(self, key, started, status=None, error=None):
+        with self._lock:
+            self.latencies.append(time.perf_counter() - started)
+            if error is None:
+                self.statuses[status] += 1
+                self.results.setdefault(key, []).append(status)
+            else:
+                self.errors[error] += 1
+                self.errored.add(key)
+
+    @property
+    def lock_errors(self):
+        return sum(count for error, count in self.errors.items() if "locked" in error)
+
+
+def error_label(exc):
+    return f"{type(exc).__name__}: {exc}"[:80]
+
+
+class Command(BaseCommand):
+    help = (
+        "Fire concurrent requests at the MFA, token and profile endpoints against a throwaway "
+        "file-backed SQLite database, then check that no state transition raced."
+    )
+
+    SCENARIOS = ("mfa-login", "mfa-verify", "email-verify", "password-reset", "profile")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scenario", action="append", choices=self.SCENARIOS, help="default: all")
+        parser.add_argument("--threads", type=int, default=200, help="concurrent requests per scenario")
+        parser.add_argument("--users", type=int, default=20, help="users the requests are spread over")
+        parser.add_argument("--timeout", type=float, default=5, help="SQLite busy timeout, seconds")
+        parser.add_argument("--wal", action="store_true", help="journal_mode=WAL")
+        parser.add_argument(
+            "--immediate", action="store_true",
+            help="BEGIN IMMEDIATE transactions: take the write lock up front instead of on first write",
+        )
+        parser.add_argument("--keep", action="store_true", help="leave the database file behind")
+
+    def handle(self, *args, **options):
+        if sharding.is_enabled():
+            raise CommandError("run with USER_SHARDS unset: the harness uses one SQLite file")
+        if options["users"] < 1 or options["threads"] < options["users"]:
+            raise CommandError("--threads must be at least --users, and --users at least 1")
+
+        directory = Path(tempfile.mkdtemp(prefix="stress-auth-"))
+        self.use_database(directory / "stress.sqlite3", options)
+        self.stdout.write(f"database {directory / 'stress.sqlite3'}")
+
+        failed = []
+        with override_settings(
+            ALLOWED_HOSTS=["testserver"],
+            # the races are the point, not PBKDF2's cost
+            PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+            EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+        ):
+            call_command("migrate", verbosity=0)
+            call_command("createcachetable", verbosity=0)
+            if options["wal"]:
+                with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+                    cursor.execute("PRAGMA journal_mode=WAL")
+            # expected 400s would flood the console
+            request_logger = logging.getLogger("django.request")
+            level = request_logger.level
+            request_logger.setLevel(logging.CRITICAL)
+            self.handler = ClientHandler()
+            Client(handler=self.handler).get("/")  # builds the middleware chain once
+
+            for name in options["scenario"] or self.SCENARIOS:
+                users = self.create_users(name, options["users"])
+                jobs, check = getattr(self, "scenario_" + name.replace("-", "_"))(users, options["threads"])
+                run = self.fire(jobs)
+                audit.get_buffer().flush()
+                violations = check(run)
+                self.report(name, run, violations)
+                if violations:
+                    failed.append(name)
+            request_logger.setLevel(level)
+
+        connections.close_all()
+        if not options["keep"]:
+            for path in directory.iterdir():
+                path.unlink()
+            directory.rmdir()
+        if failed:
+            raise CommandError("invariants violated: " + ", ".join(failed))
+
+    def use_database(self, path, options):
+        connections.close_all()
+        settings_dict = connections.settings[DEFAULT_DB_ALIAS]
+        settings_dict["NAME"] = str(path)
+        settings_dict["OPTIONS"] = {"timeout": options["timeout"]}
+        if options["immediate"]:
+            settings_dict["OPTIONS"]["transaction_mode"] = "IMMEDIATE"
+        # threads open their connections from the new settings
+        del connections[DEFAULT_DB_ALIAS]
+
+    def create_users(self, prefix, count):
+        users = []
+        for n in range(count):
+            user = User.objects.create_user(
+                email=f"{prefix}-{n}@stress.example.com",
+                password=PASSWORD,
+                is_active=True,
+                is_email_verified=True,
+                has_temp_password=False,
+            )
+            users.append(user)
+        return users
+
+    def fire(self, jobs):
+        """Run every job in its own thread, all released at once."""
+        run = Run()
+        barrier = threading.Barrier(len(jobs) + 1)
+
+        def worker(key, job):
+            client = Client(handler=self.handler)
+            barrier.wait()
+            started = time.perf_counter()
+            try:
+                response = job(client)
+            except Exception as exc:
+                run.add(key, started, error=error_label(exc))
+            else:
+                run.add(key, started, status=response.status_code)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=job) for job in jobs]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        run.started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        run.elapsed = time.perf_counter() - run.started
+        return run
+
+    @staticmethod
+    def spread(users, threads):
+        """(index, user) pairs, `threads` of them, round-robin over `users`."""
+        return [(n, users[n % len(users)]) for n in range(threads)]
+
+    # ------------------------------------------------------------
+    # Scenarios: each returns the jobs and an invariant check
+    # ------------------------------------------------------------
+    def scenario_mfa_login(self, users, threads):
+        """Concurrent logins of MFA users: create_code deletes, then inserts."""
+        UserProfile.objects.filter(user__in=users).update(multi_factor_enabled=True)
+        jobs = [
+            (user.pk, lambda client, email=user.email: client.post(
+                reverse("login"), {"email": email, "password": PASSWORD}, content_type="application/json",
+            ))
+            for _, user in self.spread(users, threads)
+        ]
+
+        def check(run):
+            live = Counter(
+                MultiFactorAuthCode.objects.filter(user__in=users, expires_at__gt=timezone.now())
+                .values_list("user_id", flat=True)
+            )
+            return [f"user {pk}: {n} live MFA codes" for pk, n in live.items() if n > 1]
+
+        return jobs, check
+
+    def scenario_mfa_verify(self, users, threads):
+        """The same emailed code submitted many times at once."""
+        codes = {user.pk: MultiFactorAuthCode.create_code(user, _FakeRequest())[1] for user in users}
+        UserProfile.objects.filter(user__in=users).update(multi_factor_enabled=True)
+        jobs = [
+            (user.pk, lambda client, email=user.email, code=codes[user.pk]: client.post(
+                reverse("login-verify-mfa"), {"email": email, "code": code}, content_type="application/json",
+            ))
+            for _, user in self.spread(users, threads)
+        ]
+        return jobs, self.consumed_once
+
+    def scenario_email_verify(self, users, threads):
+        """One verification link clicked many times at once."""
+        User.objects.filter(pk__in=[user.pk for user in users]).update(is_email_verified=False)
+        tokens = {
+            user.pk: EmailVerificationToken.objects.create(
+                user=user, expires_at=timezone.now() + timezone.timedelta(hours=1),
+            ).token
+            for user in users
+        }
+        jobs = [
+            (user.pk, lambda client, token=tokens[user.pk]: client.get(reverse("email-verify", args=[token])))
+            for _, user in self.spread(users, threads)
+        ]
+
+        def check(run):
+            violations = self.consumed_once(run)
+            unverified = User.objects.filter(pk__in=set(tokens) - run.errored, is_email_verified=False).count()
+            if unverified:
+                violations.append(f"{unverified} users still unverified")
+            return violations
+
+        return jobs, check
+
+    def scenario_password_reset(self, users, threads):
+        """One reset token confirmed many times at once, each with its own password."""
+        tokens = {
+            user.pk: str(PasswordResetToken.objects.create(
+                user=user, expires_at=timezone.now() + timezone.timedelta(hours=1),
+            ).token)
+            for user in users
+        }
+        jobs = [
+            (user.pk, lambda client, token=tokens[user.pk], n=n: client.post(
+                reverse("password-reset-confirm"),
+                {"token": token, "password": f"New-passw0rd-{n}"},
+                content_type="application/json",
+            ))
+            for n, user in self.spread(users, threads)
+        ]
+
+        def check(run):
+            violations = self.consumed_once(run)
+            unused = PasswordResetToken.objects.filter(
+                user__in=set(tokens) - run.errored, is_used=False
+            ).count()
+            if unused:
+                violations.append(f"{unused} tokens still unused")
+            return violations
+
+        return jobs, check
+
+    def scenario_profile(self, users, threads):
+        """
+        Concurrent PATCHes of different profile fields of the same user.
+        Every field written must survive.
+        """
+        headers = {
+            user.pk: {"HTTP_AUTHORIZATION": f"Bearer {AuthStateRefreshToken.for_user(user).access_token}"}
+            for user in users
+        }
+        jobs = []
+        for n, user in self.spread(users, threads):
+            # alternate per round, so every user gets both kinds
+            body = {"bio": f"bio {n}"} if n // len(users) % 2 else {"multi_factor_enabled": True}
+            jobs.append((user.pk, lambda client, body=body, auth=headers[user.pk]: client.patch(
+                reverse("me"), body, content_type="application/json", **auth,
+            )))
+
+        def check(run):
+            lost = (
+                UserProfile.objects.filter(user__in=set(headers) - run.errored)
+                .exclude(bio__startswith="bio ", multi_factor_enabled=True)
+            )
+            return [
+                f"user {profile.user_id}: bio={profile.bio!r} multi_factor_enabled={profile.multi_factor_enabled}"
+                for profile in lost
+            ]
+
+        return jobs, check
+
+    @staticmethod
+    def consumed_once(run):
+        """
+        Never accepted twice, and accepted once unless a request for it
+        failed with an error (a lock timeout is not a race).
+        """
+        violations = []
+        for key, statuses in run.results.items():
+            accepted = statuses.count(200)
+            if accepted > 1 or (accepted == 0 and key not in run.errored):
+                violations.append(f"user {key}: accepted {accepted} times")
+        return violations
+
+    def report(self, name, run, violations):
+        total = sum(run.statuses.values()) + sum(run.errors.values())
+        latencies = sorted(run.latencies)
+        p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        self.stdout.write(
+            f"\n{name}: {total} requests in {run.elapsed:.2f} s, {total / run.elapsed:.0f} req/s, "
+            f"median {statistics.median(latencies) * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms"
+        )
+        self.stdout.write("  statuses  " + ", ".join(f"{status}: {n}" for status, n in sorted(run.statuses.items())))
+        self.stdout.write(f"  lock errors {run.lock_errors}, shed (503) {run.statuses.get(503, 0)}")
+        for error, count in run.errors.most_common():
+            self.stdout.write(f"    {count:5} x {error}")
+        if violations:
+            self.stdout.write(self.style.ERROR(f"  FAIL {len(violations)} invariant violations"))
+            for violation in violations[:10]:
+                self.stdout.write(f"    {violation}")
+        else:
+            self.stdout.write(self.style.SUCCESS("  ok"))
+
+
+class _FakeRequest:
+    META = {"REMOTE_ADDR": "127.0.0.1", "HTTP_USER_AGENT": "stress_auth"}
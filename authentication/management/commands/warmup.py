@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.warmup import STEPS, warmup
+
+
+class Command(BaseCommand):
+    help = "Run the worker warm-up steps in this process and print how long each took."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--skip", action="append", default=[], choices=[name for name, _ in STEPS],
+            help="step to leave out (repeatable)",
+        )
+
+    def handle(self, *args, **options):
+        timings = warmup(skip=options["skip"])
+        for name, seconds in timings.items():
+            self.stdout.write(f"  {name:<12} {seconds * 1000:8.1f} ms")
+        self.stdout.write(f"  {'total':<12} {sum(timings.values()) * 1000:8.1f} ms")
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0002_alter_userprofile_profile_picture'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='auth_state_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
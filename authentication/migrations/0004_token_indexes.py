@@ -0,0 +1,41 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:55
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0003_user_auth_state_version'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='multifactorauthcode',
+            name='authenticat_token_b1afde_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='multifactorauthcode',
+            name='authenticat_expires_b2a01b_idx',
+        ),
+        migrations.AddIndex(
+            model_name='emailverificationtoken',
+            index=models.Index(fields=['user', 'is_used', 'expires_at'], name='emailverify_user_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='passwordresettoken',
+            index=models.Index(fields=['user', 'is_used', 'expires_at'], name='pwreset_user_live_idx'),
+        ),
+        migrations.AlterField(
+            model_name='emailverificationtoken',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='email_verification_tokens', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='passwordresettoken',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='password_reset_tokens', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
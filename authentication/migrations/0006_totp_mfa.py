@@ -0,0 +1,46 @@
+# Generated by Django 5.2.7 on 2026-10-19 18:01
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0005_user_created_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='mfa_method',
+            field=models.CharField(choices=[('email', 'Email code'), ('totp', 'Authenticator app')], default='email', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='totp_confirmed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='totp_secret',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.CreateModel(
+            name='MFARecoveryCode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code_hash', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('used_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mfa_recovery_codes', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'MFA Recovery Code',
+                'verbose_name_plural': 'MFA Recovery Codes',
+                'constraints': [models.UniqueConstraint(fields=('user', 'code_hash'), name='mfa_recovery_user_code_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-19 18:12
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0007_trusted_devices'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.CharField(blank=True, max_length=254)),
+                ('event', models.CharField(choices=[('login.succeeded', 'Login succeeded'), ('login.failed', 'Login failed'), ('mfa.required', 'MFA challenge issued'), ('mfa.succeeded', 'MFA succeeded'), ('mfa.failed', 'MFA failed'), ('password_reset.requested', 'Password reset requested'), ('password_reset.completed', 'Password reset completed'), ('email.verified', 'Email verified')], max_length=40)),
+                ('request_ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('device', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('detail', models.JSONField(blank=True, default=dict)),
+                ('user', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='audit_events', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Audit Event',
+                'verbose_name_plural': 'Audit Events',
+                'indexes': [models.Index(fields=['user', 'created_at'], name='audit_user_time_idx'), models.Index(fields=['email', 'created_at'], name='audit_email_time_idx'), models.Index(fields=['created_at'], name='audit_time_idx')],
+            },
+        ),
+    ]
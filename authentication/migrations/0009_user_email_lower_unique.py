@@ -0,0 +1,52 @@
+# Generated by Django 5.2.7 on 2026-10-19 18:15
+
+import django.db.models.functions.text
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+def normalize_emails(apps, schema_editor):
+    """
+    Lower-case the domain of existing emails, as UserManager.normalize_email
+    does for new users, after making sure no two users differ only by case.
+    Those have to be merged or renamed by hand before the constraint can be
+    added.
+    """
+    User = apps.get_model("authentication", "User")
+    users = User.objects.using(schema_editor.connection.alias)
+
+    duplicates = list(
+        users.annotate(email_lower=Lower("email"))
+        .values("email_lower")
+        .annotate(n=Count("id"))
+        .filter(n__gt=1)
+        .values_list("email_lower", flat=True)[:20]
+    )
+    if duplicates:
+        raise RuntimeError(
+            "Users whose emails differ only by case must be resolved before "
+            "migrating: " + ", ".join(duplicates)
+        )
+
+    for pk, email in users.values_list("id", "email").iterator():
+        local, sep, domain = email.rpartition("@")
+        normalized = f"{local}{sep}{domain.lower()}"
+        if normalized != email:
+            users.filter(pk=pk).update(email=normalized)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('authentication', '0008_audit_events'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_emails, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='user',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('email'), name='user_email_lower_uniq'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    """
+    The FTS5 table behind authentication.services.user_search, filled from
+    the existing users. SQLite only; elsewhere, or without FTS5, search
+    falls back to prefix matching.
+    """
+    from authentication.services import user_search
+
+    connection = schema_editor.connection
+    if connection.vendor == "sqlite" and user_search.create_index(connection):
+        user_search.rebuild(connection.alias)
+
+
+def drop_search_index(apps, schema_editor):
+    from authentication.services import user_search
+
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute(f"DROP TABLE IF EXISTS {user_search.TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0009_user_email_lower_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-19 19:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0010_user_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailClaim',
+            fields=[
+                ('email', models.CharField(max_length=254, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-19 19:26
+
+import authentication.services.upload_path
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0011_email_claims'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userprofile',
+            name='profile_picture',
+            field=models.ImageField(db_index=True, default='media/default/default.jpg', upload_to=authentication.services.upload_path.user_profile_pic_path),
+        ),
+    ]
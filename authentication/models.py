@@ -3,7 +3,8 @@ This module contains the models for user authentication, including custom user m
 password reset tokens, email verification tokens, multi-factor authentication codes,
 and user profiles.
 """
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models.functions import Lower
 from django.contrib.auth.models import AbstractUser , BaseUserManager
 from django.utils import timezone
 from django.utils.text import slugify
@@ -11,13 +12,35 @@ import uuid
 from authentication.services.secrets import SecretGenerator
 from datetime import timedelta
 from authentication.services.upload_path import user_profile_pic_path
+from authentication.services import auth_state, metrics, sharding
+from authentication.services.sharding import UserOwnedQuerySet, UserQuerySet
+from authentication.services.totp import generate_recovery_codes
 
-class UserManager(BaseUserManager):
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
     """
     User manager for the custom User model.
     """
     use_in_migrations = True
 
+    @staticmethod
+    def email_key(email):
+        return (email or "").strip().lower()
+
+    def by_email(self, email):
+        """
+        Users whose email matches case-insensitively: one seek on the
+        user_email_lower_uniq index, on the shard that email hashes to.
+        Finish with `.first_on_any_shard()` to also find users whose email
+        changed after they were placed.
+        """
+        return self.alias(email_lower=Lower("email")).filter(email_lower=self.email_key(email))
+
+    def get_by_natural_key(self, username):
+        user = self.by_email(username).first_on_any_shard()
+        if user is None:
+            raise self.model.DoesNotExist
+        return user
+
     def _create_user(self, email, password, **extra_fields):
         if not email:
             raise ValueError('The given email must be set')
@@ -55,39 +78,125 @@ class User(AbstractUser):
     slug = models.SlugField(unique=True)
     is_email_verified = models.BooleanField(default=False)
     email_verified_at = models.DateTimeField(null=True, blank=True)
-    created_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
     last_password_change = models.DateTimeField(null=True, blank=True)
     has_temp_password = models.BooleanField(default=True)
+    auth_state_version = models.PositiveIntegerField(default=0)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
     objects = UserManager()
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._auth_state_snapshot = self._auth_state()
+        self._email_snapshot = self.__dict__.get("email")
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        # what was just read is the stored state, not a change to it; this also
+        # covers a deferred field (such as the password) loading on first access
+        self._auth_state_snapshot = self._auth_state(fields, self._auth_state_snapshot)
+        if fields is None or "email" in fields:
+            self._email_snapshot = self.__dict__.get("email")
+
     def __str__(self):
         return self.email
+
+    def _auth_state(self, fields=None, previous=None):
+        # read from __dict__ so deferred fields are not fetched; with `fields`,
+        # the others are kept from `previous`
+        current = tuple(self.__dict__.get(field) for field in auth_state.AUTH_STATE_FIELDS)
+        if fields is None:
+            return current
+        return tuple(
+            value if field in fields else old
+            for field, value, old in zip(auth_state.AUTH_STATE_FIELDS, current, previous)
+        )
     
     def verify_email(self):
         self.is_email_verified = True
         self.email_verified_at = timezone.now()
         self.is_active = True
-        self.save()
+        self.save(update_fields=["is_email_verified", "email_verified_at", "is_active", "updated_at"])
 
     def change_password(self, new_password):
         self.set_password(new_password)
         self.last_password_change = timezone.now()
         self.has_temp_password = False
-        self.save()
+        self.save(update_fields=["password", "last_password_change", "has_temp_password", "updated_at"])
 
     def save(self, *args, **kwargs):
         if not self.slug:
             base_slug = slugify(self.username or self.email.split('@')[0])
             self.slug = f"{base_slug}-{uuid.uuid4().hex[:8]}"
-        super().save(*args, **kwargs)
+
+        # any change to the auth state invalidates the claims in issued tokens
+        before = self._auth_state_snapshot
+        state_changed = self.pk is not None and self._auth_state() != before
+        if state_changed:
+            self.auth_state_version += 1
+            update_fields = kwargs.get("update_fields")
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "auth_state_version"}
+
+        # with USER_SHARDS, the unique index of one shard does not see the others
+        claimed, adding = self._email_to_claim(kwargs.get("update_fields")), self._state.adding
+        if claimed:
+            sharding.claim_email(claimed, self.pk)
+        try:
+            super().save(*args, **kwargs)
+        except Exception:
+            if claimed:
+                sharding.release_email(claimed)
+            raise
+        if claimed and not adding and self._email_snapshot:
+            sharding.release_email(UserManager.email_key(self._email_snapshot))
+        self._email_snapshot = self.__dict__.get("email")
+
+        self._auth_state_snapshot = self._auth_state()
+        if state_changed:
+            auth_state.store_version(self.pk, self.auth_state_version)
+            if self._ends_device_trust(before):
+                TrustedDevice.revoke_for_users([self.pk], using=self._state.db)
+
+    def _email_to_claim(self, update_fields):
+        # an email that is deferred, or not among `update_fields`, is not written
+        if not sharding.is_enabled() or "email" not in self.__dict__:
+            return None
+        if update_fields is not None and "email" not in update_fields:
+            return None
+        email = UserManager.email_key(self.email)
+        if not self._state.adding and email == UserManager.email_key(self._email_snapshot):
+            return None
+        return email
+
+    def _ends_device_trust(self, before):
+        # a new password may follow a compromise, and a deactivated account
+        # must pass MFA again when it comes back: no device skips it after either
+        was, now = (dict(zip(auth_state.AUTH_STATE_FIELDS, state)) for state in (before, self._auth_state()))
+        return now["password"] != was["password"] or (was["is_active"] is not False and now["is_active"] is False)
 
     class Meta:
         verbose_name = 'User'
         verbose_name_plural = 'Users'
+        constraints = [
+            # case-insensitive uniqueness, and the index behind User.objects.by_email()
+            models.UniqueConstraint(Lower("email"), name="user_email_lower_uniq"),
+        ]
+
+
+class EmailClaim(models.Model):
+    """
+    A lower-cased user email, reserved across all shards. Only used with
+    USER_SHARDS, and only on the default database; see sharding.claim_email().
+    """
+    email = models.CharField(max_length=254, primary_key=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.email
 
 
 class BaseToken(models.Model):
@@ -106,10 +215,13 @@ class BaseToken(models.Model):
     request_ip = models.GenericIPAddressField(null=True)
     device = models.CharField(max_length=255, null=True, blank=True)
 
+    objects = UserOwnedQuerySet.as_manager()
+
     def mark_as_used(self):
         self.is_used = True
         self.used_at = timezone.now()
         self.save(update_fields=["is_used", "used_at"])
+        metrics.TOKENS_CONSUMED.inc(type=type(self).__name__)
 
     def is_valid(self):
         return not self.is_used and timezone.now() < self.expires_at
@@ -119,14 +231,12 @@ class BaseToken(models.Model):
 
     class Meta:
         abstract = True
-        indexes = [
-            models.Index(fields=["token", "is_used"]),
-        ]
 
 
 class PasswordResetToken(BaseToken):
 
-    user = models.ForeignKey(User,on_delete=models.CASCADE , related_name="password_reset_tokens")
+    # user lookups go through pwreset_user_live_idx, no separate FK index
+    user = models.ForeignKey(User,on_delete=models.CASCADE , related_name="password_reset_tokens", db_index=False)
 
     def __str__(self):
         return f"PasswordResetToken for {self.user.email} - {'Used' if self.is_used else 'Unused'}"
@@ -134,11 +244,15 @@ class PasswordResetToken(BaseToken):
     class Meta:
         verbose_name = 'Password Reset Token'
         verbose_name_plural = 'Password Reset Tokens'
+        # token lookups are covered by the unique constraint
+        indexes = [
+            models.Index(fields=["user", "is_used", "expires_at"], name="pwreset_user_live_idx"),
+        ]
 
     
 
 class EmailVerificationToken(BaseToken):
-    user = models.ForeignKey(User,on_delete=models.CASCADE,related_name="email_verification_tokens")
+    user = models.ForeignKey(User,on_delete=models.CASCADE,related_name="email_verification_tokens", db_index=False)
     
     def __str__(self):
         return f"EmailVerificationToken for {self.user.email} - {'Used' if self.is_used else 'Unused'}"
@@ -146,6 +260,9 @@ class EmailVerificationToken(BaseToken):
     class Meta:
         verbose_name = 'Email Verification Token'
         verbose_name_plural = 'Email Verification Tokens'
+        indexes = [
+            models.Index(fields=["user", "is_used", "expires_at"], name="emailverify_user_live_idx"),
+        ]
 
 
 
@@ -167,30 +284,33 @@ class MultiFactorAuthCode(models.Model):
     request_ip = models.GenericIPAddressField(null=True, blank=True)
     device = models.CharField(max_length=255, null=True, blank=True)
 
+    objects = UserOwnedQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Multi-Factor Authentication Code"
         verbose_name_plural = "Multi-Factor Authentication Codes"
-        indexes = [
-            models.Index(fields=["token"]),
-            models.Index(fields=["expires_at"]),
-        ]
 
     @classmethod
     def create_code(cls, user, request, validity_minutes=5):
-        cls.objects.filter(user=user).delete()
         raw_code = SecretGenerator.generate_mfa_code()
         token = SecretGenerator.generate_mfa_hash(user.email, raw_code)
         request_ip = request.META.get("REMOTE_ADDR", "Unknown")
         device = request.META.get("HTTP_USER_AGENT", "Unknown Device")
 
-        obj = cls.objects.create(
-            user=user,
-            token=token,
-            expires_at=timezone.now() + timedelta(minutes=validity_minutes),
-            request_ip=request_ip,
-            device=device
-        )
+        # one live code per user, also for concurrent logins: the user's row
+        # lock serialises them, on SQLite the DELETE's write lock does
+        codes = cls.objects.filter(user=user)
+        with transaction.atomic(using=codes.db):
+            if connections[codes.db].features.has_select_for_update:
+                list(User.objects.using(codes.db).select_for_update().filter(pk=user.pk).values_list("pk"))
+            codes.delete()
+            obj = codes.create(
+                user=user,
+                token=token,
+                expires_at=timezone.now() + timedelta(minutes=validity_minutes),
+                request_ip=request_ip,
+                device=device
+            )
 
         return obj, raw_code
 
@@ -204,6 +324,13 @@ class MultiFactorAuthCode(models.Model):
             self.delete()
             return False
 
+        # single use: of concurrent submissions only the one whose DELETE
+        # removed the row is accepted
+        deleted, _ = type(self).objects.using(self._state.db).filter(pk=self.pk).delete()
+        if not deleted:
+            return False
+
+        metrics.TOKENS_CONSUMED.inc(type=type(self).__name__)
         return True
 
     def __str__(self):
@@ -216,15 +343,33 @@ class UserProfile(models.Model):
     """
     User profile model to store additional user information.
     """
+    MFA_EMAIL = "email"
+    MFA_TOTP = "totp"
+    MFA_METHODS = [
+        (MFA_EMAIL, "Email code"),
+        (MFA_TOTP, "Authenticator app"),
+    ]
+
     user = models.OneToOneField(User,on_delete=models.CASCADE,related_name="profile")
     bio = models.TextField(blank=True)
-    profile_picture = models.ImageField(upload_to=user_profile_pic_path, default="media/default/default.jpg")
+    # indexed for /media/, which finds a picture's owner by its stored name
+    profile_picture = models.ImageField(upload_to=user_profile_pic_path, default="media/default/default.jpg", db_index=True)
     multi_factor_enabled = models.BooleanField(default=False)
+    mfa_method = models.CharField(max_length=10, choices=MFA_METHODS, default=MFA_EMAIL)
+    # base32 secret; only used once totp_confirmed_at is set
+    totp_secret = models.CharField(max_length=64, blank=True)
+    totp_confirmed_at = models.DateTimeField(null=True, blank=True)
     is_deleted = models.BooleanField(default=False)
 
+    objects = UserOwnedQuerySet.as_manager()
+
     def __str__(self):
         return f"Profile of {self.user.first_name} {self.user.last_name}"
     
+    @property
+    def uses_totp(self):
+        return self.mfa_method == self.MFA_TOTP and self.totp_confirmed_at is not None
+
     def restore(self):
         self.is_deleted = False
         self.save(update_fields=['is_deleted'])
@@ -239,6 +384,93 @@ class UserProfile(models.Model):
 
 
 
+class MFARecoveryCode(models.Model):
+    """
+    Single-use recovery codes for authenticator-app MFA, stored as keyed hashes.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="mfa_recovery_codes")
+    code_hash = models.CharField(max_length=64)
+    created_at = models.DateTimeField(default=timezone.now)
+    used_at = models.DateTimeField(null=True, blank=True)
+
+    objects = UserOwnedQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = "MFA Recovery Code"
+        verbose_name_plural = "MFA Recovery Codes"
+        constraints = [
+            models.UniqueConstraint(fields=["user", "code_hash"], name="mfa_recovery_user_code_uniq"),
+        ]
+
+    def __str__(self):
+        return f"Recovery code for {self.user.email}"
+
+    @classmethod
+    def regenerate(cls, user, count=10):
+        """Replace all codes of `user`; the raw codes are only returned here."""
+        codes = generate_recovery_codes(count)
+        cls.objects.filter(user=user).delete()
+        cls.objects.bulk_create([
+            cls(user=user, code_hash=SecretGenerator.generate_recovery_hash(user.pk, code))
+            for code in codes
+        ])
+        return codes
+
+    @classmethod
+    def _unused(cls, user, code):
+        code_hash = SecretGenerator.generate_recovery_hash(user.pk, code.strip().lower())
+        return cls.objects.filter(user=user, code_hash=code_hash, used_at__isnull=True)
+
+    @classmethod
+    def is_unused(cls, user, code):
+        return cls._unused(user, code).exists()
+
+    @classmethod
+    def consume(cls, user, code):
+        """Mark the code used; False if it is unknown or another request used it first."""
+        return bool(cls._unused(user, code).update(used_at=timezone.now()))
+
+
+
+class TrustedDevice(models.Model):
+    """
+    A device that completed MFA and may skip it on later logins.
+    Only a keyed hash of the device token is stored.
+    """
+    # user lookups go through trusteddevice_user_live_idx
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="trusted_devices", db_index=False)
+    token_hash = models.CharField(max_length=64, unique=True)
+    device = models.CharField(max_length=255, blank=True)
+    request_ip = models.GenericIPAddressField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    last_used_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()
+    revoked_at = models.DateTimeField(null=True, blank=True)
+
+    objects = UserOwnedQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = "Trusted Device"
+        verbose_name_plural = "Trusted Devices"
+        indexes = [
+            models.Index(fields=["user", "revoked_at", "expires_at"], name="trusteddevice_user_live_idx"),
+        ]
+
+    def __str__(self):
+        return f"Trusted device of {self.user.email}"
+
+    def revoke(self):
+        self.revoked_at = timezone.now()
+        self.save(update_fields=["revoked_at"])
+
+    @classmethod
+    def revoke_for_users(cls, user_ids, using=None):
+        """Revoke every device of `user_ids` not revoked yet; returns how many."""
+        devices = cls.objects.filter(user_id__in=user_ids, revoked_at__isnull=True)
+        return (devices.using(using) if using else devices).update(revoked_at=timezone.now())
+
+
+
 class TempPasswordManager(models.Model):
     """
     Manager for temporary passwords, allowing users to change password after first login.
@@ -250,6 +482,8 @@ class TempPasswordManager(models.Model):
     is_used = models.BooleanField(default=False)
     used_at = models.DateTimeField(null=True, blank=True)
 
+    objects = UserOwnedQuerySet.as_manager()
+
     def is_valid(self,password):
         if self.is_used or self.user.has_temp_password is False:
             return False
@@ -280,3 +514,73 @@ class TempPasswordManager(models.Model):
         verbose_name = 'Temporary Password Manager'
         verbose_name_plural = 'Temporary Password Managers'
 
+
+
+
+class AuditEventQuerySet(UserOwnedQuerySet):
+
+    def for_user(self, user):
+        return self.filter(user=user)
+
+    def for_email(self, email):
+        return self.filter(email=email)
+
+    def between(self, since=None, until=None):
+        queryset = self
+        if since is not None:
+            queryset = queryset.filter(created_at__gte=since)
+        if until is not None:
+            queryset = queryset.filter(created_at__lt=until)
+        return queryset
+
+    def of_type(self, *events):
+        return self.filter(event__in=events)
+
+
+class AuditEvent(models.Model):
+    """
+    Authentication audit record. Written in batches by
+    authentication.services.audit, never from the request itself.
+    """
+    LOGIN_SUCCEEDED = "login.succeeded"
+    LOGIN_FAILED = "login.failed"
+    MFA_REQUIRED = "mfa.required"
+    MFA_SUCCEEDED = "mfa.succeeded"
+    MFA_FAILED = "mfa.failed"
+    PASSWORD_RESET_REQUESTED = "password_reset.requested"
+    PASSWORD_RESET_COMPLETED = "password_reset.completed"
+    EMAIL_VERIFIED = "email.verified"
+    EVENTS = [
+        (LOGIN_SUCCEEDED, "Login succeeded"),
+        (LOGIN_FAILED, "Login failed"),
+        (MFA_REQUIRED, "MFA challenge issued"),
+        (MFA_SUCCEEDED, "MFA succeeded"),
+        (MFA_FAILED, "MFA failed"),
+        (PASSWORD_RESET_REQUESTED, "Password reset requested"),
+        (PASSWORD_RESET_COMPLETED, "Password reset completed"),
+        (EMAIL_VERIFIED, "Email verified"),
+    ]
+
+    # user lookups go through audit_user_time_idx
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="audit_events", db_index=False)
+    # as submitted, for failures where no user is known
+    email = models.CharField(max_length=254, blank=True)
+    event = models.CharField(max_length=40, choices=EVENTS)
+    request_ip = models.GenericIPAddressField(null=True, blank=True)
+    device = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    detail = models.JSONField(default=dict, blank=True)
+
+    objects = AuditEventQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = "Audit Event"
+        verbose_name_plural = "Audit Events"
+        indexes = [
+            models.Index(fields=["user", "created_at"], name="audit_user_time_idx"),
+            models.Index(fields=["email", "created_at"], name="audit_email_time_idx"),
+            models.Index(fields=["created_at"], name="audit_time_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.event} at {self.created_at:%Y-%m-%d %H:%M:%S}"
@@ -0,0 +1,28 @@
+#authentication.routers
+"""
+Database router for user sharding (see authentication.services.sharding).
+
+Querysets route themselves by shard key; this router covers what they
+cannot see: saving a new user or user-owned row, and related lookups that
+only carry the instance as a hint.
+"""
+from authentication.services import sharding
+
+
+class UserShardRouter:
+
+    def _shard(self, model, hints):
+        instance = hints.get("instance")
+        if instance is None or model._meta.app_label != "authentication" or not sharding.is_enabled():
+            return None
+        if instance._state.db:
+            return instance._state.db
+        if instance._meta.app_label != "authentication":
+            return None
+        return sharding.shard_for_instance(instance)
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
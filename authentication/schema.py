@@ -0,0 +1,7 @@
+#authentication/schema.py
+from drf_spectacular.contrib.rest_framework_simplejwt import SimpleJWTScheme
+
+
+class ClaimsJWTScheme(SimpleJWTScheme):
+    """documents ClaimsJWTAuthentication as the same bearer scheme as simplejwt"""
+    target_class = "authentication.services.claims.ClaimsJWTAuthentication"
@@ -0,0 +1,62 @@
+from rest_framework import serializers
+
+from authentication.models import User
+from authentication.services import bulk_users
+
+
+class BulkUserActionSerializer(serializers.Serializer):
+    """
+    Selects users either by id/slug or by a filter set, never both empty.
+    The requesting admin is always excluded from the selection.
+    """
+    action = serializers.ChoiceField(choices=sorted(bulk_users.ACTIONS))
+
+    # ---- explicit selection ----
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, max_length=10000)
+    slugs = serializers.ListField(child=serializers.SlugField(), required=False, max_length=10000)
+
+    # ---- filter set ----
+    is_active = serializers.BooleanField(required=False, allow_null=True, default=None)
+    is_email_verified = serializers.BooleanField(required=False, allow_null=True, default=None)
+    has_temp_password = serializers.BooleanField(required=False, allow_null=True, default=None)
+    email_domain = serializers.CharField(required=False)
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+
+    FILTERS = {
+        "is_active": "is_active",
+        "is_email_verified": "is_email_verified",
+        "has_temp_password": "has_temp_password",
+        "email_domain": "email__endswith",
+        "created_after": "created_at__gte",
+        "created_before": "created_at__lt",
+    }
+
+    def validate(self, attrs):
+        lookups = {}
+        for field, lookup in self.FILTERS.items():
+            value = attrs.get(field)
+            if value is None:
+                continue
+            if field == "email_domain":
+                value = "@" + value.lstrip("@").lower()
+            lookups[lookup] = value
+
+        if not (attrs.get("ids") or attrs.get("slugs") or lookups):
+            raise serializers.ValidationError("Select users by ids, slugs or at least one filter")
+
+        attrs["lookups"] = lookups
+        return attrs
+
+    def get_queryset(self):
+        data = self.validated_data
+        queryset = User.objects.filter(**data["lookups"])
+        if data.get("ids"):
+            queryset = queryset.filter(pk__in=data["ids"])
+        if data.get("slugs"):
+            queryset = queryset.filter(slug__in=data["slugs"])
+        return queryset.exclude(pk=self.context["request"].user.pk)
+
+    def save(self):
+        action = bulk_users.ACTIONS[self.validated_data["action"]]
+        return action(self.get_queryset())
@@ -0,0 +1,18 @@
+from rest_framework import serializers
+
+from authentication.models import TrustedDevice
+
+
+class TrustedDeviceSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = TrustedDevice
+        fields = [
+            "id",
+            "device",
+            "request_ip",
+            "created_at",
+            "last_used_at",
+            "expires_at",
+        ]
+        read_only_fields = fields
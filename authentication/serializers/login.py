@@ -1,18 +1,24 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import authenticate
 
-from authentication.models import User, MultiFactorAuthCode
+from authentication.models import User, MultiFactorAuthCode, MFARecoveryCode, UserProfile
 from authentication.services.email_service import EmailService
+from authentication.services import email_filter, totp, trusted_devices
 
 
 class LoginSerializer(serializers.Serializer):
     email = serializers.EmailField()
     password = serializers.CharField()
+    # lets an authenticator-app user ask for an email code instead
+    mfa_method = serializers.ChoiceField(choices=UserProfile.MFA_METHODS, required=False)
+    # or the X-Device-Token header / the trusted_device cookie
+    device_token = serializers.CharField(required=False, max_length=128)
 
     def validate(self, attrs):
         user = attrs["email"]
 
-        user = User.objects.filter(email=user).first()
+        user = email_filter.find_user(user, "profile")
 
         if not user:
             raise serializers.ValidationError("Invalid Email")
@@ -23,30 +29,75 @@ class LoginSerializer(serializers.Serializer):
         if not user.is_email_verified:
             raise serializers.ValidationError("Email not verified")
 
-        # MFA flow
-        if user.profile.multi_factor_enabled:
+        # the second factor never replaces the password
+        if not user.check_password(attrs["password"]):
+            raise serializers.ValidationError("Invalid password")
+
+        # MFA flow, skipped for a device trusted after an earlier challenge
+        profile = user.profile
+        device_token = trusted_devices.read_token(self.context["request"], attrs.get("device_token"))
+        if profile.multi_factor_enabled and not trusted_devices.is_trusted(user, device_token):
+            mfa_method = UserProfile.MFA_EMAIL
+            if profile.uses_totp and attrs.get("mfa_method") != UserProfile.MFA_EMAIL:
+                mfa_method = UserProfile.MFA_TOTP
             return {
                 "mfa_required": True,
+                "mfa_method": mfa_method,
                 "user_id": user.id,
                 "email": user.email,
                 "user": user
             }
 
-        if not user.check_password(attrs["password"]):
-            raise serializers.ValidationError("Invalid password")
-
         return {
             "mfa_required": False,
             "user": user
         }
 
 
+class TokenIntrospectionSerializer(serializers.Serializer):
+    tokens = serializers.ListField(
+        child=serializers.CharField(max_length=4096, trim_whitespace=True),
+        allow_empty=False,
+    )
+
+    def validate_tokens(self, value):
+        limit = getattr(settings, "INTROSPECTION_MAX_TOKENS", 500)
+        if len(value) > limit:
+            raise serializers.ValidationError(f"At most {limit} tokens per request")
+        return value
+
+
 class GetTheMFACodeSerializer(serializers.Serializer):
     email = serializers.EmailField()
     code = serializers.CharField()
+    # returned by login for authenticator-app users, ties the code to that login
+    mfa_challenge = serializers.CharField(required=False, default="")
+    trust_device = serializers.BooleanField(required=False, default=False)
 
     def validate(self, attrs):
-        mfa_obj = MultiFactorAuthCode.objects.filter(user__email=attrs["email"]).first()
+        user = email_filter.find_user(attrs["email"], "profile")
+
+        # authenticator app: verified in-process, no row written until it succeeds
+        pending = totp.read_challenge(attrs["mfa_challenge"]) if user and user.profile.uses_totp else None
+        if pending is not None and pending[0] == user.pk:
+            code = attrs["code"]
+            recovery = len(code) > totp.DIGITS
+            if recovery:
+                accepted = MFARecoveryCode.is_unused(user, code)
+            else:
+                accepted = totp.verify(user.profile.totp_secret, code, user.pk)
+            # the challenge is completed once; a recovery code is only spent by the request that does
+            if accepted and totp.finish_login(pending[1]) and (not recovery or MFARecoveryCode.consume(user, code)):
+                return {
+                    "user": user,
+                    "mfa_verified": True,
+                    "trust_device": attrs["trust_device"]
+                }
+            if not accepted:
+                totp.fail_login(pending[1])
+
+        # email code (default, and fallback for authenticator users)
+        mfa_obj = MultiFactorAuthCode.objects.filter(user=user).first() if user else None
         if not mfa_obj:
             raise serializers.ValidationError("Invalid credentials")
 
@@ -55,7 +106,8 @@ class GetTheMFACodeSerializer(serializers.Serializer):
 
         return {
             "user": mfa_obj.user,
-            "mfa_verified": True
+            "mfa_verified": True,
+            "trust_device": attrs["trust_device"]
         }
 
     
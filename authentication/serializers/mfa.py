@@ -1,5 +1,8 @@
+from django.db import transaction
+from django.utils import timezone
 from rest_framework import serializers
-from authentication.models import MultiFactorAuthCode
+from authentication.models import MultiFactorAuthCode, MFARecoveryCode, TrustedDevice, UserProfile
+from authentication.services import totp
 
 
 class MFAVerifySerializer(serializers.Serializer):
@@ -16,3 +19,94 @@ class MFAVerifySerializer(serializers.Serializer):
             raise serializers.ValidationError("Invalid MFA code")
 
         return user
+
+
+# ------------------------------------------------------------
+# Authenticator app (TOTP) enrollment
+# ------------------------------------------------------------
+class TOTPEnrollSerializer(serializers.Serializer):
+
+    def validate(self, attrs):
+        profile = self.context["request"].user.profile
+        if profile.uses_totp:
+            raise serializers.ValidationError("Authenticator app is already enabled")
+        attrs["profile"] = profile
+        return attrs
+
+    def save(self):
+        profile = self.validated_data["profile"]
+        profile.totp_secret = totp.generate_secret()
+        profile.totp_confirmed_at = None
+        profile.save(update_fields=["totp_secret", "totp_confirmed_at"])
+        return {
+            "secret": profile.totp_secret,
+            "provisioning_uri": totp.provisioning_uri(profile.totp_secret, profile.user.email),
+        }
+
+
+class TOTPCodeSerializer(serializers.Serializer):
+    """Base for actions that need a current authenticator code."""
+    code = serializers.CharField()
+    allow_recovery_code = False
+
+    def validate(self, attrs):
+        user = self.context["request"].user
+        profile = user.profile
+        if not profile.totp_secret:
+            raise serializers.ValidationError("Authenticator app enrollment not started")
+
+        if not totp.verify(profile.totp_secret, attrs["code"], user.pk):
+            if not (self.allow_recovery_code and profile.uses_totp
+                    and MFARecoveryCode.consume(user, attrs["code"])):
+                raise serializers.ValidationError("Invalid code")
+
+        attrs["profile"] = profile
+        return attrs
+
+
+class TOTPConfirmSerializer(TOTPCodeSerializer):
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if attrs["profile"].uses_totp:
+            raise serializers.ValidationError("Authenticator app is already enabled")
+        return attrs
+
+    def save(self):
+        profile = self.validated_data["profile"]
+        with transaction.atomic(using=profile._state.db):
+            profile.mfa_method = UserProfile.MFA_TOTP
+            profile.totp_confirmed_at = timezone.now()
+            profile.multi_factor_enabled = True
+            profile.save(update_fields=["mfa_method", "totp_confirmed_at", "multi_factor_enabled"])
+            codes = MFARecoveryCode.regenerate(profile.user)
+        return {"recovery_codes": codes}
+
+
+class TOTPDisableSerializer(TOTPCodeSerializer):
+    allow_recovery_code = True
+
+    def save(self):
+        profile = self.validated_data["profile"]
+        with transaction.atomic(using=profile._state.db):
+            # email codes stay as the MFA method
+            profile.mfa_method = UserProfile.MFA_EMAIL
+            profile.totp_secret = ""
+            profile.totp_confirmed_at = None
+            profile.save(update_fields=["mfa_method", "totp_secret", "totp_confirmed_at"])
+            MFARecoveryCode.objects.filter(user=profile.user).delete()
+            # devices trusted under the app's MFA do not carry over to email codes
+            TrustedDevice.revoke_for_users([profile.user_id], using=profile._state.db)
+        return {}
+
+
+class RecoveryCodesSerializer(TOTPCodeSerializer):
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if not attrs["profile"].uses_totp:
+            raise serializers.ValidationError("Authenticator app is not enabled")
+        return attrs
+
+    def save(self):
+        return {"recovery_codes": MFARecoveryCode.regenerate(self.validated_data["profile"].user)}
@@ -2,26 +2,20 @@
 
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError as DjangoValidationError
-from django.db import transaction
 from rest_framework import serializers
 from django.utils import timezone
 from authentication.models import User, PasswordResetToken , TempPasswordManager
 from authentication.services.email_service import EmailService
+from authentication.services import email_filter, one_time_tokens
 
 
 class PasswordResetRequestSerializer(serializers.Serializer):
     email = serializers.EmailField()
 
     def validate(self, attrs):
-        user = User.objects.filter(email=attrs["email"]).first()
+        user = email_filter.find_user(attrs["email"])
         if user:
-            token = PasswordResetToken.objects.create(
-                user=user,
-                expires_at=timezone.now() + timezone.timedelta(hours=1),
-            )
-            EmailService.send_password_reset_email(
-                user, token, self.context["request"]
-            )
+            EmailService.request_password_reset(user, self.context["request"])
         return attrs
 
 
@@ -34,12 +28,11 @@ class PasswordResetConfirmSerializer(serializers.Serializer):
         token = attrs["token"]
         password = attrs["password"]
 
-        try:
-            password_reset_token = PasswordResetToken.objects.get(
-                token=token,
-                is_used=False
-            )
-        except PasswordResetToken.DoesNotExist:
+        password_reset_token = PasswordResetToken.objects.filter(
+            token=token,
+            is_used=False
+        ).select_related("user").first_on_any_shard()
+        if password_reset_token is None:
             raise serializers.ValidationError("Invalid token")
 
         if not password_reset_token.is_valid():
@@ -56,16 +49,24 @@ class PasswordResetConfirmSerializer(serializers.Serializer):
     def save(self):
         password = self.validated_data["password"]
         password_reset_token = self.validated_data["password_reset_token"]
-        user = password_reset_token.user
-        user.has_temp_password = False
-        user.save()
 
-        with transaction.atomic():
+        def reset_password(token):
+            user = token.user
             user.set_password(password)
-            user.save()
-            password_reset_token.mark_as_used()
+            user.has_temp_password = False
+            # also revokes the user's trusted devices (User.save)
+            user.save(update_fields=["password", "has_temp_password", "updated_at"])
 
-        return user
+        # validate() only read the token; a concurrent request may have used it since
+        try:
+            password_reset_token = one_time_tokens.consume(
+                PasswordResetToken.objects.using(password_reset_token._state.db).filter(pk=password_reset_token.pk),
+                then=reset_password,
+            )
+        except one_time_tokens.TokenRejected:
+            raise serializers.ValidationError("Invalid token")
+
+        return password_reset_token.user
 
 
 class ChangeTempPasswordSerializer(serializers.Serializer):
@@ -88,7 +89,7 @@ class ChangeTempPasswordSerializer(serializers.Serializer):
             raise serializers.ValidationError("User does not have a temporary password")
         
         try:
-            tempPassObj = TempPasswordManager.objects.get(user=user, is_used=False)
+            tempPassObj = TempPasswordManager.objects.select_related("user").get(user=user, is_used=False)
         except TempPasswordManager.DoesNotExist:
             raise serializers.ValidationError("No active temporary password found")
 
@@ -102,9 +103,14 @@ class ChangeTempPasswordSerializer(serializers.Serializer):
         password = self.validated_data["password"]
         tempPassObj = self.validated_data["temp_password_obj"]
 
-        user = tempPassObj.user
-        user.change_password(password)
-        user.save()
+        try:
+            tempPassObj = one_time_tokens.consume(
+                TempPasswordManager.objects.using(tempPassObj._state.db).filter(
+                    pk=tempPassObj.pk, temp_password=self.validated_data["temp_password"]
+                ),
+                then=lambda temp: temp.user.change_password(password),
+            )
+        except one_time_tokens.TokenRejected:
+            raise serializers.ValidationError("Temporary password is already used or invalid")
 
-        tempPassObj.mark_as_used()
-        return user
\ No newline at end of file
+        return tempPassObj.user
\ No newline at end of file
@@ -11,6 +11,7 @@ from authentication.models import (
     EmailVerificationToken,
 )
 from authentication.services.email_service import EmailService
+from authentication.services import picture_uploads
 
 
 def build_absolute_media_url(request, file_field):
@@ -48,7 +49,7 @@ class MeSerializer(serializers.Serializer):
     # ---------- Validation ----------
     def validate_email(self, value):
         user = self.context["request"].user
-        if User.objects.filter(email=value).exclude(id=user.id).exists():
+        if User.objects.by_email(value).exclude(id=user.id).first_on_any_shard() is not None:
             raise serializers.ValidationError("Email already in use")
         return value
 
@@ -58,42 +59,61 @@ class MeSerializer(serializers.Serializer):
             raise serializers.ValidationError("Slug already in use")
         return value
 
+    def validate_profile_picture(self, value):
+        # the same limits as the streaming upload (/me/picture/uploads/)
+        if value.size > picture_uploads.max_bytes():
+            raise serializers.ValidationError(f"Pictures can be at most {picture_uploads.max_bytes()} bytes")
+        image = value.image
+        try:
+            picture_uploads.check_image(image.format, image.width, image.height)
+        except picture_uploads.UploadRejected as rejected:
+            raise serializers.ValidationError(rejected.message)
+        return value
+
     # ---------- Update ----------
     def update(self, instance, validated_data):
         """
-        instance = request.user
-        Updates User + UserProfile in one request
+        instance = request.user.profile
+        Updates User + UserProfile in one request. Only the fields sent are
+        written, so concurrent PATCHes of different fields keep each other's
+        changes.
         """
         profile = instance
+        user = instance.user
         email_changed = False
 
         # ---- User updates ----
-        for field in ("first_name", "last_name", "slug"):
-            if field in validated_data:
-                setattr(instance, field, validated_data[field])
-
-        if "email" in validated_data and validated_data["email"] != instance.email:
-            instance.user.email = validated_data["email"]
-            instance.user.is_email_verified = False
-            instance.user.is_active = False
+        user_fields = [field for field in ("first_name", "last_name", "slug") if field in validated_data]
+        for field in user_fields:
+            setattr(user, field, validated_data[field])
+
+        if "email" in validated_data and validated_data["email"] != user.email:
+            user.email = validated_data["email"]
+            user.is_email_verified = False
+            user.is_active = False
+            user_fields += ["email", "is_email_verified", "is_active"]
             email_changed = True
 
-        instance.save()
+        if user_fields:
+            user.save(update_fields=[*user_fields, "updated_at"])
 
         # ---- Profile updates ----
-        for field in ("bio", "profile_picture", "multi_factor_enabled"):
-            if field in validated_data:
-                setattr(profile, field, validated_data[field])
+        profile_fields = [
+            field for field in ("bio", "profile_picture", "multi_factor_enabled") if field in validated_data
+        ]
+        for field in profile_fields:
+            setattr(profile, field, validated_data[field])
 
-        profile.save()
+        if profile_fields:
+            profile.save(update_fields=profile_fields)
 
         # ---- Re-verification if email changed ----
         if email_changed:
             token = EmailVerificationToken.objects.create(
-                user=instance,
+                user=user,
                 expires_at=timezone.now() + timezone.timedelta(hours=24),
             )
-            EmailService.send_verification_email(instance, token)
+            EmailService.send_verification_email(user, token)
 
         return instance
 
@@ -154,3 +174,30 @@ class AdminUserSerializer(serializers.ModelSerializer):
         return build_absolute_media_url(
             request, obj.profile.profile_picture
         )
+
+
+class AdminUserSearchSerializer(serializers.Serializer):
+    """Query string of the admin user search."""
+    q = serializers.CharField(max_length=200)
+    page = serializers.IntegerField(min_value=1, max_value=500, default=1)
+    page_size = serializers.IntegerField(min_value=1, max_value=100, default=20)
+
+
+class PublicUserBatchSerializer(serializers.Serializer):
+    """`?slugs=a,b,c` of the directory batch lookup."""
+    slugs = serializers.CharField()
+
+    MAX_SLUGS = 100
+
+    def validate_slugs(self, value):
+        slugs = [slug.strip() for slug in value.split(",") if slug.strip()]
+        if not slugs:
+            raise serializers.ValidationError("No slugs given")
+        if len(slugs) > self.MAX_SLUGS:
+            raise serializers.ValidationError(f"At most {self.MAX_SLUGS} slugs per request")
+        return slugs
+
+
+class PictureUploadSerializer(serializers.Serializer):
+    """Starts a resumable profile picture upload of `size` bytes."""
+    size = serializers.IntegerField(min_value=1)
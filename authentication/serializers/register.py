@@ -36,6 +36,6 @@ class RegisterSerializer(serializers.Serializer):
         return user
     
     def validate_email(self, value):
-        if User.objects.filter(email=value).exists():
+        if User.objects.by_email(value).first_on_any_shard() is not None:
             raise serializers.ValidationError("User with this email already exists.")
         return value
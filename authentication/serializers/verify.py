@@ -1,21 +1,18 @@
 from rest_framework import serializers
 from authentication.models import EmailVerificationToken
+from authentication.services import one_time_tokens
 
 
 class EmailVerifySerializer(serializers.Serializer):
     token = serializers.UUIDField()
 
     def validate(self, attrs):
-        token_obj = EmailVerificationToken.objects.filter(
-            token=attrs["token"],
-            is_used=False
-        ).first()
-
-        if not token_obj or not token_obj.is_valid():
+        try:
+            token_obj = one_time_tokens.consume(
+                EmailVerificationToken.objects.filter(token=attrs["token"]),
+                then=lambda token: token.user.verify_email(),
+            )
+        except one_time_tokens.TokenRejected:
             raise serializers.ValidationError("Invalid or expired token")
 
-        user = token_obj.user
-        user.verify_email()
-        token_obj.mark_as_used()
-
-        return user
+        return token_obj.user
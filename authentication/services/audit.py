@@ -0,0 +1,189 @@
+#authentication.services.audit
+"""
+Buffered authentication audit log.
+
+`record()` only appends a dict to an in-process ring buffer, so the request
+never waits on a write. A daemon thread drains the buffer every
+AUDIT_LOG_BATCH_SIZE events or AUDIT_LOG_FLUSH_INTERVAL_MS, whichever
+comes first, with one `bulk_create` per shard or one append to an NDJSON
+file. Memory is bounded by AUDIT_LOG_BUFFER_SIZE: if the writer falls
+behind, the oldest events are dropped and counted. What is still buffered
+at interpreter exit is flushed then.
+
+Rows are queried through `AuditEvent.objects` (`for_user`, `for_email`,
+`between`, `of_type`).
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections
+from django.utils import timezone
+
+from authentication.services import sharding
+
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseSink:
+
+    def write(self, events):
+        from authentication.models import AuditEvent
+
+        # events of a user live on that user's shard
+        by_shard = defaultdict(list)
+        for event in events:
+            alias = sharding.shard_for_user_id(event["user_id"]) if event["user_id"] else DEFAULT_DB_ALIAS
+            by_shard[alias].append(AuditEvent(**event))
+        for alias, rows in by_shard.items():
+            AuditEvent.objects.using(alias).bulk_create(rows)
+
+
+class NDJSONSink:
+    """
+    One JSON object per line. Each batch is a single O_APPEND write, so
+    several worker processes can share the file.
+    """
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+
+    def write(self, events):
+        data = "".join(
+            json.dumps({**event, "created_at": event["created_at"].isoformat()}, separators=(",", ":")) + "\n"
+            for event in events
+        ).encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+
+SINKS = {
+    "database": lambda: DatabaseSink(),
+    "ndjson": lambda: NDJSONSink(getattr(settings, "AUDIT_LOG_PATH", settings.BASE_DIR / "audit.ndjson")),
+}
+
+
+class AuditBuffer:
+    """
+    Bounded ring buffer with a background writer.
+
+    With `background=False` nothing is written until `flush()` is called.
+    """
+
+    def __init__(self, sink, capacity=10000, batch_size=200, interval=0.5, background=True):
+        self.sink = sink
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+        self.background = background
+        self.dropped = 0
+        self.failed = 0
+        self._reset()
+        if background and hasattr(os, "register_at_fork"):
+            # the child must not write the parent's events a second time
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._events = deque(maxlen=self.capacity)
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._events)
+
+    def push(self, event):
+        with self._condition:
+            if len(self._events) == self.capacity:
+                self.dropped += 1
+            self._events.append(event)
+            if len(self._events) >= self.batch_size:
+                self._condition.notify()
+        if self._thread is None and self.background:
+            self._start()
+
+    def _start(self):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+                self._thread.start()
+
+    def _drain(self):
+        events = list(self._events)
+        self._events.clear()
+        return events
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if len(self._events) < self.batch_size:
+                    self._condition.wait(self.interval)
+                events = self._drain()
+            if events:
+                close_old_connections()
+                self._write(events)
+
+    def _write(self, events):
+        try:
+            self.sink.write(events)
+        except Exception:
+            self.failed += len(events)
+            logger.exception("could not write %d audit events", len(events))
+
+    def flush(self):
+        """Write everything buffered so far from the calling thread."""
+        with self._condition:
+            events = self._drain()
+        if events:
+            self._write(events)
+        return len(events)
+
+
+_buffer = None
+_lock = threading.Lock()
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        with _lock:
+            if _buffer is None:
+                _buffer = AuditBuffer(
+                    SINKS[getattr(settings, "AUDIT_LOG_BACKEND", "database")](),
+                    capacity=getattr(settings, "AUDIT_LOG_BUFFER_SIZE", 10000),
+                    batch_size=getattr(settings, "AUDIT_LOG_BATCH_SIZE", 200),
+                    interval=getattr(settings, "AUDIT_LOG_FLUSH_INTERVAL_MS", 500) / 1000,
+                )
+    return _buffer
+
+
+def record(event, user=None, request=None, email="", **detail):
+    """
+    Queue an audit event. `user` is only read for its pk, so a lazy
+    token-backed user is not loaded.
+    """
+    if not getattr(settings, "AUDIT_LOG_BACKEND", "database"):
+        return
+    meta = request.META if request is not None else {}
+    get_buffer().push({
+        "event": event,
+        "user_id": user.pk if user is not None else None,
+        "email": email or "",
+        "request_ip": meta.get("REMOTE_ADDR"),
+        "device": meta.get("HTTP_USER_AGENT", "")[:255],
+        "created_at": timezone.now(),
+        "detail": detail,
+    })
+
+
+@atexit.register
+def flush_on_exit():
+    if _buffer is not None:
+        _buffer.flush()
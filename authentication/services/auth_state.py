@@ -0,0 +1,50 @@
+#authentication.services.auth_state
+"""
+Tracks the auth-state version of each user.
+
+The version is embedded in every access token and bumped whenever
+`is_active`, `is_email_verified`, `has_temp_password` or the password
+changes. The current value is kept in the cache so a request can be checked
+against it without loading the user row. That is still one cache read per
+authenticated request (a SELECT on the cache table with the database cache),
+deliberately not cached in the process: a revoked token is refused by every
+worker at once.
+"""
+from django.core.cache import cache
+from django.conf import settings
+
+
+AUTH_STATE_FIELDS = ("is_active", "is_email_verified", "has_temp_password", "password")
+
+CACHE_KEY = "auth-state-version:{}"
+
+
+def _timeout():
+    return int(settings.SIMPLE_JWT["ACCESS_TOKEN_LIFETIME"].total_seconds())
+
+
+def store_version(user_id, version):
+    cache.set(CACHE_KEY.format(user_id), version, _timeout())
+
+
+def forget_versions(user_ids):
+    """Drop cached versions, e.g. after a `QuerySet.update` bumped them in bulk."""
+    cache.delete_many([CACHE_KEY.format(user_id) for user_id in user_ids])
+
+
+def current_version(user_id):
+    """Return the current version for `user_id`, or None if the user is gone."""
+    version = cache.get(CACHE_KEY.format(user_id))
+    if version is not None:
+        return version
+
+    from authentication.models import User
+
+    version = (
+        User.objects.filter(pk=user_id)
+        .values_list("auth_state_version", flat=True)
+        .first()
+    )
+    if version is not None:
+        store_version(user_id, version)
+    return version
@@ -0,0 +1,197 @@
+#authentication.services.bulk_users
+"""
+Bulk administrative actions on users.
+
+Every action walks the selected users in primary-key chunks and applies the
+change with a single `QuerySet.update` per chunk, so touching a whole
+department costs a handful of statements instead of one save per user.
+Emails produced by an action are sent over one backend connection per batch,
+after the chunk's changes are committed. A failed email does not undo them
+or stop the others: the result counts what went out and lists the users
+whose email failed, so they can be sent again.
+
+With USER_SHARDS set, an action runs the selection on every shard in turn,
+and each chunk's statements go to the shard its users live on.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from authentication.models import User, EmailVerificationToken, TempPasswordManager, TrustedDevice
+from authentication.services import auth_state, metrics, sharding
+from authentication.services.email_service import EmailService
+from authentication.services.secrets import SecretGenerator
+
+
+CHUNK_SIZE = getattr(settings, "BULK_USER_CHUNK_SIZE", 1000)
+EMAIL_BATCH_SIZE = getattr(settings, "BULK_EMAIL_BATCH_SIZE", 100)
+
+# the fields email templates need
+EMAIL_FIELDS = ("id", "email", "first_name", "last_name")
+
+logger = logging.getLogger(__name__)
+
+
+class BulkResult:
+
+    def __init__(self):
+        self.updated = 0
+        self.emails_sent = 0
+        # ids of users whose email could not be sent
+        self.emails_failed = []
+
+    def as_dict(self):
+        return {"updated": self.updated, "emails_sent": self.emails_sent, "emails_failed": self.emails_failed}
+
+
+def iter_id_chunks(queryset, chunk_size=CHUNK_SIZE):
+    """Yield lists of primary keys from `queryset` using keyset pagination."""
+    ids = queryset.order_by("pk").values_list("pk", flat=True)
+    last_id = 0
+    while True:
+        chunk = list(ids.filter(pk__gt=last_id)[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1]
+
+
+def _update_state(ids, using, **fields):
+    """Update auth-state fields and invalidate tokens issued before the change."""
+    updated = User.objects.using(using).filter(pk__in=ids).update(
+        auth_state_version=F("auth_state_version") + 1,
+        updated_at=timezone.now(),
+        **fields,
+    )
+    transaction.on_commit(lambda: auth_state.forget_versions(ids), using=using)
+    return updated
+
+
+def _send_in_batches(send, items, result):
+    """Send `send(user, *args)` for each item, recording every email in `result`."""
+    for start in range(0, len(items), EMAIL_BATCH_SIZE):
+        batch = items[start:start + EMAIL_BATCH_SIZE]
+        done = 0
+        try:
+            with EmailService.open_batch() as connection:
+                for user, *args in batch:
+                    try:
+                        send(user, *args, connection=connection)
+                    except Exception:
+                        logger.exception("could not send bulk email to user %s", user.pk)
+                        result.emails_failed.append(user.pk)
+                    else:
+                        result.emails_sent += 1
+                    done += 1
+        except Exception:
+            # the connection could not be opened: the rest of the batch never went out
+            logger.exception("could not open an email connection for %d users", len(batch) - done)
+            result.emails_failed.extend(user.pk for user, *_ in batch[done:])
+
+
+def _issue_verification_tokens(ids, using):
+    """Retire live verification tokens of `ids` and create one new token each."""
+    now = timezone.now()
+    EmailVerificationToken.objects.using(using).filter(
+        user_id__in=ids, is_used=False, expires_at__gt=now
+    ).update(is_used=True, used_at=now)
+
+    users = User.objects.using(using).filter(pk__in=ids).only(*EMAIL_FIELDS)
+    tokens = EmailVerificationToken.objects.using(using).bulk_create([
+        EmailVerificationToken(user=user, expires_at=now + timedelta(hours=24))
+        for user in users
+    ])
+    # bulk_create sends no post_save
+    metrics.TOKENS_ISSUED.inc(len(tokens), type=EmailVerificationToken.__name__)
+    return [(token.user, token) for token in tokens]
+
+
+def _shard_chunks(queryset):
+    """(alias, ids) for every chunk of `queryset`, shard by shard."""
+    if not sharding.is_enabled():
+        using = queryset.db
+        for ids in iter_id_chunks(queryset):
+            yield using, ids
+        return
+    for using in sharding.aliases():
+        for ids in iter_id_chunks(queryset.using(using)):
+            yield using, ids
+
+
+def activate(queryset):
+    result = BulkResult()
+    for using, ids in _shard_chunks(queryset):
+        with transaction.atomic(using=using):
+            result.updated += _update_state(ids, using, is_active=True)
+    return result
+
+
+def deactivate(queryset):
+    result = BulkResult()
+    for using, ids in _shard_chunks(queryset):
+        with transaction.atomic(using=using):
+            result.updated += _update_state(ids, using, is_active=False)
+            # as User.save does for one user
+            TrustedDevice.revoke_for_users(ids, using=using)
+    return result
+
+
+def force_reverification(queryset):
+    result = BulkResult()
+    for using, ids in _shard_chunks(queryset):
+        with transaction.atomic(using=using):
+            result.updated += _update_state(ids, using, is_email_verified=False, email_verified_at=None)
+            pending = _issue_verification_tokens(ids, using)
+        _send_in_batches(EmailService.send_verification_email, pending, result)
+    return result
+
+
+def resend_verification(queryset):
+    result = BulkResult()
+    for using, ids in _shard_chunks(queryset.filter(is_email_verified=False)):
+        with transaction.atomic(using=using):
+            pending = _issue_verification_tokens(ids, using)
+        result.updated += len(pending)
+        _send_in_batches(EmailService.send_verification_email, pending, result)
+    return result
+
+
+def reset_temp_password(queryset, validity_hours=24):
+    result = BulkResult()
+    for using, ids in _shard_chunks(queryset):
+        now = timezone.now()
+        users = list(User.objects.using(using).filter(pk__in=ids).only(*EMAIL_FIELDS))
+        passwords = SecretGenerator.generate_temp_passwords(len(users))
+        managers = [
+            TempPasswordManager(
+                user=user,
+                temp_password=temp_password,
+                expires_at=now + timedelta(hours=validity_hours),
+            )
+            for user, temp_password in zip(users, passwords)
+        ]
+
+        with transaction.atomic(using=using):
+            # the old password must stop working along with the sessions
+            result.updated += _update_state(ids, using, has_temp_password=True, password=make_password(None))
+            TrustedDevice.revoke_for_users(ids, using=using)
+            TempPasswordManager.objects.using(using).filter(user_id__in=ids).delete()
+            TempPasswordManager.objects.using(using).bulk_create(managers)
+
+        pending = [(manager.user, manager.temp_password, validity_hours) for manager in managers]
+        _send_in_batches(EmailService.send_temp_password_email, pending, result)
+    return result
+
+
+ACTIONS = {
+    "activate": activate,
+    "deactivate": deactivate,
+    "force_reverification": force_reverification,
+    "reset_temp_password": reset_temp_password,
+    "resend_verification": resend_verification,
+}
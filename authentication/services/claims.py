@@ -0,0 +1,122 @@
+#authentication.services.claims
+"""
+JWT claims that let permission checks run without loading the user.
+
+`AuthStateRefreshToken` embeds the user's auth-state flags in every token it
+issues. `ClaimsJWTAuthentication` turns those claims into a `ClaimsUser`,
+which answers `is_active`, `is_email_verified` and `has_temp_password`
+straight from the token and only fetches the row when a view asks for
+anything else.
+"""
+from django.utils.functional import SimpleLazyObject, empty
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from authentication.services import auth_state
+
+
+STATE_CLAIMS = ("is_active", "is_email_verified", "has_temp_password")
+VERSION_CLAIM = "state_version"
+
+
+class AuthStateRefreshToken(RefreshToken):
+    """Refresh token whose claims (and its access token's) carry the auth state."""
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        for claim in STATE_CLAIMS:
+            token[claim] = getattr(user, claim)
+        token[VERSION_CLAIM] = user.auth_state_version
+        auth_state.store_version(user.pk, user.auth_state_version)
+        return token
+
+
+class ClaimsUser(SimpleLazyObject):
+    """
+    Lazy user backed by the access token.
+
+    The state flags and primary key come from the claims; any other attribute
+    loads the user from the database once. `isinstance(obj, User)` keeps
+    working, so the object can be passed to querysets and FK assignments.
+    """
+
+    def __init__(self, user_model, validated_token):
+        user_id = validated_token[api_settings.USER_ID_CLAIM]
+
+        def load():
+            return user_model.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+
+        super().__init__(load)
+        self.__dict__["_claims"] = validated_token
+        self.__dict__["_user_id"] = user_id
+
+    def _claim(self, name):
+        if self._wrapped is not empty:
+            return getattr(self._wrapped, name)
+        return self._claims[name]
+
+    @property
+    def pk(self):
+        return self._user_id
+
+    @property
+    def id(self):
+        return self._user_id
+
+    @property
+    def is_active(self):
+        return self._claim("is_active")
+
+    @property
+    def is_email_verified(self):
+        return self._claim("is_email_verified")
+
+    @property
+    def has_temp_password(self):
+        return self._claim("has_temp_password")
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_anonymous(self):
+        return False
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that trusts the auth-state claims instead of the row.
+
+    The token's state version is compared with the cached current version;
+    a mismatch means the state changed after the token was issued and the
+    client has to log in again. Tokens issued before the claims existed fall
+    back to the regular database lookup.
+    """
+
+    def get_user(self, validated_token):
+        if VERSION_CLAIM not in validated_token:
+            return super().get_user(validated_token)
+
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        version = auth_state.current_version(user_id)
+        if version is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if version != validated_token[VERSION_CLAIM]:
+            raise AuthenticationFailed(
+                _("Account state changed, please log in again."), code="state_changed"
+            )
+
+        if not validated_token["is_active"]:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        return ClaimsUser(self.user_model, validated_token)
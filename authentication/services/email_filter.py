@@ -0,0 +1,273 @@
+#authentication.services.email_filter
+"""
+Negative-lookup filter for user emails.
+
+A Bloom filter of every user's normalized email, held in process memory,
+lets the public endpoints (login, MFA verification, password reset request)
+answer a made-up address without touching the database. A Bloom filter can
+say "maybe" for an unknown email (about EMAIL_FILTER_FALSE_POSITIVE_RATE of
+the time, then the database decides as before) but never "no" for a known
+one, so no real user is turned away:
+
+- Until the first build has finished, every email is a "maybe".
+- A daemon thread rebuilds it from all shards every
+  EMAIL_FILTER_REBUILD_INTERVAL seconds, which also drops deleted and
+  changed addresses.
+- Users saved in between are added by a post_save signal and published to
+  the other worker processes through a log in the cache: numbered entries per
+  RECENT_SLOT seconds, claimed with cache.add. The same thread reads the new
+  entries every EMAIL_FILTER_REFRESH_INTERVAL seconds into its own filter, so
+  a lookup never reads the cache; a user saved by another worker is known
+  here after at most that long. With several workers the cache must be
+  shared, as for auth_state.
+
+A definite miss is answered after the recent average database lookup time,
+so it cannot be told apart from a database miss by timing.
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, close_old_connections
+
+from authentication.services import sharding
+
+
+logger = logging.getLogger(__name__)
+
+RECENT_KEY = "email-filter:recent:{}:{}"
+RECENT_SLOT = 60
+RECENT_BATCH = 100
+
+
+class BloomFilter:
+    """
+    Sized for `capacity` members at `error_rate` false positives. Positions
+    come from one 128-bit BLAKE2b digest by double hashing.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.capacity = capacity
+        self.count = 0
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=16).digest(), "little")
+        h1, h2 = digest & 0xFFFFFFFFFFFFFFFF, (digest >> 64) | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, key):
+        """Set the bits of `key`; counted only if one of them was still clear (not a repeat)."""
+        bits = self.bits
+        new = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+
+class LookupTime:
+    """Moving average of the database lookups the filter stands in for."""
+
+    def __init__(self, initial=0.001, weight=0.05):
+        self.value = initial
+        self.weight = weight
+
+    def observe(self, seconds):
+        self.value += self.weight * (seconds - self.value)
+
+
+class EmailFilter:
+
+    def __init__(self, error_rate=0.01, interval=3600, refresh_interval=5, headroom=1.25):
+        self.error_rate = error_rate
+        self.interval = interval
+        self.refresh_interval = refresh_interval
+        self.headroom = headroom
+        self.lookup_time = LookupTime()
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._filter = None
+        self._pending = None
+        self._lock = threading.Lock()
+        self._building = threading.Lock()
+        self._thread = None
+        # next unread entry of the recent log, per slot
+        self._cursors = {}
+
+    @property
+    def ready(self):
+        return self._filter is not None
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="email-filter", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        next_build = 0
+        while True:
+            try:
+                close_old_connections()
+                if time.monotonic() >= next_build:
+                    next_build = time.monotonic() + self.interval
+                    self.rebuild()
+                self.refresh()
+            except Exception:
+                logger.exception("could not build the email filter")
+            time.sleep(self.refresh_interval)
+
+    def rebuild(self):
+        """Build a new filter from all shards and swap it in; None if a build is already running."""
+        from authentication.models import User
+
+        if not self._building.acquire(blocking=False):
+            return None
+        try:
+            with self._lock:
+                self._pending = []
+            aliases = sharding.aliases() if sharding.is_enabled() else [DEFAULT_DB_ALIAS]
+            total = sum(User.objects.using(alias).count() for alias in aliases)
+            bloom = BloomFilter(int(total * self.headroom) + 1000, self.error_rate)
+            for alias in aliases:
+                for email in User.objects.using(alias).values_list("email", flat=True).iterator(chunk_size=5000):
+                    bloom.add(User.objects.email_key(email))
+            with self._lock:
+                # saved while the table was being read
+                for key in self._pending:
+                    bloom.add(key)
+                self._pending = None
+                self._filter = bloom
+            return bloom
+        finally:
+            self._building.release()
+
+    def refresh(self):
+        """Add the entries other processes put in the recent log since the last call; returns how many."""
+        now = int(time.time() // RECENT_SLOT)
+        # the previous slot too: a writer may have picked it just before the turn
+        cursors = {slot: self._cursors.get(slot, 0) for slot in (now - 1, now)}
+        read = 0
+        for slot, start in cursors.items():
+            while True:
+                names = [RECENT_KEY.format(slot, n) for n in range(start, start + RECENT_BATCH)]
+                found = cache.get_many(names)
+                for name in names:
+                    if name not in found:
+                        break
+                    self.add(found[name])
+                    start += 1
+                    read += 1
+                cursors[slot] = start
+                if len(found) < RECENT_BATCH:
+                    break
+        self._cursors = cursors
+        return read
+
+    def publish(self, key):
+        """Append `key` to the recent log for the other processes."""
+        slot = int(time.time() // RECENT_SLOT)
+        start = self._cursors.get(slot, 0)
+        for n in range(start, start + 10 * RECENT_BATCH):
+            if cache.add(RECENT_KEY.format(slot, n), key, RECENT_SLOT * 3):
+                return n
+        logger.warning("could not publish a new email to the other processes")
+        return None
+
+    def add(self, key):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(key)
+            bloom = self._filter
+        if bloom is not None:
+            bloom.add(key)
+            if bloom.count == bloom.capacity + 1:
+                # past its size the false-positive rate climbs; start over
+                threading.Thread(target=self.rebuild, name="email-filter-grow", daemon=True).start()
+
+    def might_exist(self, key):
+        bloom = self._filter
+        return bloom is None or key in bloom
+
+
+_filter = None
+_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, "EMAIL_FILTER_ENABLED", False)
+
+
+def get_filter():
+    global _filter
+    if _filter is None:
+        with _lock:
+            if _filter is None:
+                _filter = EmailFilter(
+                    error_rate=getattr(settings, "EMAIL_FILTER_FALSE_POSITIVE_RATE", 0.01),
+                    interval=getattr(settings, "EMAIL_FILTER_REBUILD_INTERVAL", 3600),
+                    refresh_interval=getattr(settings, "EMAIL_FILTER_REFRESH_INTERVAL", 5),
+                )
+    _filter.start()
+    return _filter
+
+
+def remember(email):
+    """Called for every saved user: add it here, and tell the other processes."""
+    if not is_enabled():
+        return
+    from authentication.models import User
+
+    key = User.objects.email_key(email)
+    email_filter = get_filter()
+    email_filter.add(key)
+    email_filter.publish(key)
+
+
+def find_user(email, *related):
+    """
+    `User.objects.by_email(email).first_on_any_shard()`, without the
+    database when the filter rules the email out.
+    """
+    from authentication.models import User
+
+    if is_enabled():
+        email_filter = get_filter()
+        if not email_filter.might_exist(User.objects.email_key(email)):
+            time.sleep(email_filter.lookup_time.value)
+            return None
+
+    started = time.perf_counter()
+    queryset = User.objects.by_email(email)
+    if related:
+        queryset = queryset.select_related(*related)
+    user = queryset.first_on_any_shard()
+    if is_enabled():
+        get_filter().lookup_time.observe(time.perf_counter() - started)
+    return user
@@ -1,29 +1,118 @@
 # authentication/email_service.py
-from django.core.mail import send_mail
+from datetime import timedelta
+from pathlib import PurePosixPath
+
+from django.core.cache import cache
+from django.core.mail import get_connection, send_mail
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.utils import timezone
 from django.conf import settings
 
+from authentication.models import EmailVerificationToken, PasswordResetToken
+from authentication.services import metrics
+
 
 class EmailService:
 
+    # repeat requests for the same user and email type inside this window
+    # send no other email; the token sent first stays valid
+    COALESCE_WINDOW = getattr(settings, "AUTH_EMAIL_COALESCE_WINDOW", timedelta(minutes=5))
+
+    @staticmethod
+    def _coalesce(kind, token_model, user, validity, send, retire_live=False, **fields):
+        """
+        Issue a token and send it at most once per window; returns the token,
+        or None when the request was coalesced. The marker in the shared
+        cache makes a duplicate request free and settles concurrent ones; if
+        it was lost, a live token issued inside the window shows the email
+        already went out. `retire_live` marks older live tokens as used.
+        """
+        key = f"auth-email:{kind}:{user.pk}"
+        window = EmailService.COALESCE_WINDOW
+        if not cache.add(key, True, int(window.total_seconds())):
+            return None
+
+        now = timezone.now()
+        live = token_model.objects.filter(user=user, is_used=False, expires_at__gt=now)
+        try:
+            if live.filter(created_at__gte=now - window).exists():
+                return None
+            if retire_live:
+                live.update(is_used=True, used_at=now)
+            token = token_model.objects.create(user=user, expires_at=now + validity, **fields)
+            try:
+                send(token)
+            except Exception:
+                # never delivered, so it must not hold back the next request
+                token_model.objects.filter(pk=token.pk).update(is_used=True, used_at=now)
+                raise
+        except Exception:
+            cache.delete(key)
+            raise
+        return token
+
     @staticmethod
-    def _send(subject, template, context, to_email):
+    def request_password_reset(user, request):
+        """Coalesced "forgot password": returns the token, or None if suppressed."""
+        return EmailService._coalesce(
+            "password_reset",
+            PasswordResetToken,
+            user,
+            timedelta(hours=1),
+            lambda token: EmailService.send_password_reset_email(user, token, request),
+            request_ip=request.META.get("REMOTE_ADDR"),
+            device=request.META.get("HTTP_USER_AGENT", ""),
+        )
+
+    @staticmethod
+    def request_verification(user, request_ip=None, device=""):
+        """Coalesced "resend verification": returns the token, or None if suppressed."""
+        # a resend has always replaced the previous link
+        return EmailService._coalesce(
+            "email_verification",
+            EmailVerificationToken,
+            user,
+            timedelta(hours=24),
+            lambda token: EmailService.send_verification_email(user, token),
+            retire_live=True,
+            request_ip=request_ip,
+            device=device,
+        )
+
+    @staticmethod
+    def _send(subject, template, context, to_email, connection=None):
         html_message = render_to_string(template, context)
         plain_message = strip_tags(html_message)
 
-        send_mail(
-            subject=subject,
-            message=plain_message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[to_email],
-            html_message=html_message,
-            fail_silently=False,
-        )
+        label = PurePosixPath(template).stem
+        try:
+            send_mail(
+                subject=subject,
+                message=plain_message,
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                recipient_list=[to_email],
+                html_message=html_message,
+                fail_silently=False,
+                connection=connection,
+            )
+        except Exception:
+            metrics.EMAILS.inc(template=label, outcome="failed")
+            raise
+        metrics.EMAILS.inc(template=label, outcome="sent")
+
+    @staticmethod
+    def open_batch():
+        """
+        Open one backend connection to reuse across many sends:
+
+            with EmailService.open_batch() as connection:
+                EmailService.send_verification_email(user, token, connection=connection)
+        """
+        return get_connection(fail_silently=False)
 
     @staticmethod
-    def send_verification_email(user, token):
+    def send_verification_email(user, token, connection=None):
         context = {
             'user': user,
             'verification_url': f"{settings.FRONTEND_BASE_URL}/verify-email/{token.token}/",
@@ -37,6 +126,7 @@ class EmailService:
             template="emails/email_verification/verification_email.html",
             context=context,
             to_email=user.email,
+            connection=connection,
         )
 
     @staticmethod
@@ -96,3 +186,22 @@ class EmailService:
             context=context,
             to_email=user.email,
         )
+
+    @staticmethod
+    def send_temp_password_email(user, temp_password, expiration_hours=24, connection=None):
+        context = {
+            'user': user,
+            'temp_password': temp_password,
+            'expiration_hours': expiration_hours,
+            'support_url': settings.SUPPORT_URL,
+            'site_name': settings.SITE_NAME,
+            'current_year': timezone.now().year,
+        }
+
+        EmailService._send(
+            subject="Your Temporary Password",
+            template="emails/temp_password/temp_password_email.html",
+            context=context,
+            to_email=user.email,
+            connection=connection,
+        )
@@ -0,0 +1,117 @@
+#authentication.services.introspection
+"""
+Batch introspection of access tokens for services that cannot verify JWTs.
+
+`introspect()` answers for many tokens at once, in order. Each answer says
+whether the token is active and, if so, gives the user id and the auth-state
+flags the permission classes check (`is_active`, `is_email_verified`,
+`has_temp_password`), read from the user's row rather than the token's
+claims, so a gateway sees the state as it is now.
+
+- Repeated tokens in a batch are decoded once, and each user is loaded once,
+  with one `in_bulk` per shard for the whole batch.
+- Answers are cached per token until it expires. A cached answer carries
+  the auth-state version it was built from and is only used while that is
+  still the user's current version (auth_state keeps it in the cache), so
+  deactivating a user or changing their password takes effect at once.
+- Tokens that do not decode (bad signature, expired, not an access token)
+  are answered without touching the database or the cache.
+"""
+import hashlib
+
+from django.core.cache import cache
+from django.utils import timezone
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from authentication.services import auth_state, sharding
+from authentication.services.claims import STATE_CLAIMS, VERSION_CLAIM
+
+
+CACHE_KEY = "token-introspection:{}"
+INACTIVE = {"active": False}
+
+
+def _key(raw):
+    return CACHE_KEY.format(hashlib.sha256(raw.encode()).hexdigest())
+
+
+def _decode(raw):
+    try:
+        return AccessToken(raw)
+    except TokenError:
+        return None
+
+
+def _load_users(user_ids):
+    """{id: user} with the auth-state columns, one query per shard."""
+    from authentication.models import User
+
+    by_shard = {}
+    for pk in user_ids:
+        by_shard.setdefault(sharding.shard_for_user_id(pk), []).append(pk)
+    users = {}
+    for alias, ids in by_shard.items():
+        users.update(
+            User.objects.using(alias).only("id", "auth_state_version", *STATE_CLAIMS).in_bulk(ids)
+        )
+    return users
+
+
+def _answer(token, user):
+    if user is None or not user.is_active:
+        return INACTIVE
+    if VERSION_CLAIM in token and token[VERSION_CLAIM] != user.auth_state_version:
+        # issued before the state last changed
+        return INACTIVE
+    return {
+        "active": True,
+        "user_id": user.pk,
+        **{claim: getattr(user, claim) for claim in STATE_CLAIMS},
+        "exp": token["exp"],
+    }
+
+
+def introspect(raw_tokens):
+    """One answer per token of `raw_tokens`, in the same order."""
+    unique = list(dict.fromkeys(raw_tokens))
+    cached = cache.get_many([_key(raw) for raw in unique])
+
+    # a cached answer stands while its user's auth state has not moved on
+    versions = cache.get_many([
+        auth_state.CACHE_KEY.format(entry["answer"]["user_id"])
+        for entry in cached.values() if entry["answer"]["active"]
+    ])
+    answers, pending = {}, {}
+    for raw in unique:
+        entry = cached.get(_key(raw))
+        if entry is not None:
+            answer = entry["answer"]
+            if not answer["active"] or versions.get(auth_state.CACHE_KEY.format(answer["user_id"])) == entry["version"]:
+                answers[raw] = answer
+                continue
+        token = _decode(raw)
+        if token is None:
+            answers[raw] = INACTIVE
+        else:
+            pending[raw] = token
+
+    if pending:
+        users = _load_users({token[api_settings.USER_ID_CLAIM] for token in pending.values()})
+        now = timezone.now().timestamp()
+        to_cache = {}
+        for raw, token in pending.items():
+            user = users.get(token[api_settings.USER_ID_CLAIM])
+            answers[raw] = _answer(token, user)
+            if user is not None:
+                to_cache[_key(raw)] = (
+                    {"answer": answers[raw], "version": user.auth_state_version},
+                    max(int(token["exp"] - now), 1),
+                )
+        for user in users.values():
+            auth_state.store_version(user.pk, user.auth_state_version)
+        for key, (entry, timeout) in to_cache.items():
+            cache.set(key, entry, timeout)
+
+    return [answers[raw] for raw in raw_tokens]
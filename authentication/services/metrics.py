@@ -0,0 +1,39 @@
+#authentication.services.metrics
+"""
+Authentication metrics, exposed with the rest at `/api/metrics/` (see
+core.metrics). Token types are labelled with the model name.
+"""
+from core.metrics import Counter, Histogram
+
+
+PASSWORD_HASH_DURATION = Histogram(
+    "auth_password_hash_duration_seconds",
+    "Time spent hashing (operation=encode) or checking (operation=verify) a password.",
+    ("algorithm", "operation"),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+EMAILS = Counter(
+    "auth_emails_total",
+    "Emails handed to the email backend, by template and outcome (sent, failed).",
+    ("template", "outcome"),
+)
+TOKENS_ISSUED = Counter(
+    "auth_tokens_issued_total",
+    "Password reset tokens, email verification tokens and MFA codes created.",
+    ("type",),
+)
+TOKENS_CONSUMED = Counter(
+    "auth_tokens_consumed_total",
+    "Tokens and MFA codes accepted.",
+    ("type",),
+)
+MFA_CHALLENGES = Counter(
+    "auth_mfa_challenges_total",
+    "Logins answered with an MFA challenge, by method (email, totp).",
+    ("method",),
+)
+MFA_VERIFICATIONS = Counter(
+    "auth_mfa_verifications_total",
+    "MFA code submissions, by outcome (succeeded, failed).",
+    ("outcome",),
+)
@@ -0,0 +1,63 @@
+#authentication.services.one_time_tokens
+"""
+Race-free consumption of one-time tokens.
+
+`consume()` marks a token used with a single conditional UPDATE that only
+matches while the token is unused and unexpired, and decides on the number
+of rows it changed: of two concurrent requests for the same token exactly
+one wins. The dependent user change runs in the same transaction, so a
+failure rolls the token back with it. Works for every model with `user`,
+`is_used`, `used_at` and `expires_at` fields.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from authentication.services import metrics, sharding
+
+
+INVALID = "invalid"
+USED = "used"
+EXPIRED = "expired"
+
+
+class TokenRejected(Exception):
+    """The token does not exist, was already used or has expired (`reason`)."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _candidate_aliases(queryset):
+    # routed by a shard key (or .using()): only that shard can hold the token
+    if queryset._db is not None or not sharding.is_enabled():
+        return [queryset.db]
+    return sharding.aliases()
+
+
+def _reason(queryset):
+    token = queryset.only("is_used").first_on_any_shard()
+    if token is None:
+        return INVALID
+    return USED if token.is_used else EXPIRED
+
+
+def consume(queryset, then=None):
+    """
+    Consume the token `queryset` selects (one row, e.g. `filter(token=...)`)
+    and return it with its `user` loaded. `then(token)` is called inside the
+    transaction. Without a shard key every shard is tried in turn. Raises
+    TokenRejected; the reason is only looked up then.
+    """
+    now = timezone.now()
+    for alias in _candidate_aliases(queryset):
+        tokens = queryset.using(alias)
+        with transaction.atomic(using=alias):
+            if not tokens.filter(is_used=False, expires_at__gt=now).update(is_used=True, used_at=now):
+                continue
+            token = tokens.select_related("user").get()
+            if then is not None:
+                then(token)
+        metrics.TOKENS_CONSUMED.inc(type=queryset.model.__name__)
+        return token
+    raise TokenRejected(_reason(queryset))
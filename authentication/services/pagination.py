@@ -0,0 +1,72 @@
+#authentication.services.pagination
+"""
+Paginators for very large tables.
+
+`EstimatedCountPaginator` replaces the `COUNT(*)` of an unfiltered queryset
+with the row estimate kept by the database's statistics. Filtered querysets
+and small tables still get an exact count.
+
+`KeysetPagination` pages an API list by id with an opaque cursor: every page
+is one index range read, however deep, and no count is taken.
+"""
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+
+# below this the exact count is cheap enough and more useful
+EXACT_COUNT_THRESHOLD = 10_000
+
+
+def estimated_row_count(model, using="default"):
+    """Return the planner's row estimate for `model`'s table, or None."""
+    connection = connections[using]
+    table = model._meta.db_table
+
+    if connection.vendor == "postgresql":
+        sql = "SELECT reltuples::bigint FROM pg_class WHERE relname = %s"
+    elif connection.vendor == "mysql":
+        sql = (
+            "SELECT table_rows FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = %s"
+        )
+    elif connection.vendor == "sqlite":
+        # populated by ANALYZE; the first number of `stat` is the row count
+        sql = "SELECT stat FROM sqlite_stat1 WHERE tbl = %s ORDER BY idx IS NOT NULL LIMIT 1"
+    else:
+        return None
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None
+
+    if not row or row[0] is None:
+        return None
+    estimate = int(str(row[0]).split()[0])
+    return estimate if estimate >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        query = getattr(queryset, "query", None)
+
+        if query is not None and not query.where:
+            estimate = estimated_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= EXACT_COUNT_THRESHOLD:
+                return estimate
+
+        return super().count
+
+
+class KeysetPagination(CursorPagination):
+    ordering = "id"
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 100
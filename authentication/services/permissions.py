@@ -1,6 +1,11 @@
 #authentication/permission.py
 
+# request.user is a ClaimsUser for JWT requests: the flags checked here are
+# read from the access token claims and do not load the user row.
 
+import hmac
+
+from django.conf import settings
 from rest_framework.permissions import BasePermission , SAFE_METHODS
 
 
@@ -35,3 +40,12 @@ class RequiresTempPassword(BasePermission):
         )
 
     
+
+class HasIntrospectionToken(BasePermission):
+    """services calling token introspection send INTROSPECTION_TOKEN as a bearer token; unset, nobody may"""
+    def has_permission(self, request, view):
+        token = getattr(settings, "INTROSPECTION_TOKEN", None)
+        if not token:
+            return False
+        scheme, _, credentials = request.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(credentials.encode(), token.encode())
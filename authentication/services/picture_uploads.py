@@ -0,0 +1,284 @@
+#authentication.services.picture_uploads
+"""
+Resumable, size-bounded profile picture uploads.
+
+An upload is started with its total size and then sent as raw bytes in one
+or more PATCHes, each at the offset the server last reported, so a dropped
+connection resumes where it broke off. Bytes are streamed into a part file
+one buffer at a time, and the upload is refused as early as possible:
+
+- at the start, when the declared size is over PROFILE_PICTURE_MAX_BYTES;
+- as soon as a chunk runs past the declared size;
+- as soon as the header has arrived: Pillow reads only the header for the
+  format and dimensions, and anything but JPEG, PNG, GIF or WebP, or wider
+  or taller than PROFILE_PICTURE_MAX_DIMENSION, is refused without a pixel
+  being decoded. So is a file with no image header in its first
+  HEADER_BYTES.
+
+When the last byte is in, `Image.verify()` checks the file's structure, it
+is saved to storage and the profile is pointed at it in one transaction.
+The previous picture is deleted after the commit.
+
+Upload state lives in the cache and part files in PROFILE_PICTURE_UPLOAD_DIR;
+with several workers both must be shared. A user has at most
+PROFILE_PICTURE_MAX_OPEN_UPLOADS uploads open at once. Uploads left
+unfinished for PROFILE_PICTURE_UPLOAD_EXPIRY seconds expire from the cache;
+`manage.py prune_picture_uploads`, run periodically, deletes their part files.
+"""
+import tempfile
+import time
+import uuid
+from functools import partial
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.db import transaction
+
+from authentication.services import sharding
+
+
+STATE_KEY = "picture-upload:{}"
+LOCK_KEY = "picture-upload-lock:{}"
+# ids of a user's uploads, and the lock taken while one is started
+USER_KEY = "picture-uploads-of:{}"
+USER_LOCK_KEY = "picture-uploads-of-lock:{}"
+FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif", "WEBP": "webp"}
+# a JPEG's dimensions can come after up to 64 KiB of EXIF and other segments
+HEADER_BYTES = 256 * 1024
+READ_SIZE = 64 * 1024
+
+# reasons an upload is refused
+NOT_FOUND = "not_found"
+BUSY = "busy"
+WRONG_OFFSET = "wrong_offset"
+TOO_LARGE = "too_large"
+NOT_AN_IMAGE = "not_an_image"
+TOO_MANY_PIXELS = "too_many_pixels"
+TOO_MANY_UPLOADS = "too_many_uploads"
+
+
+class UploadRejected(Exception):
+    """The upload or chunk is refused for `reason`; `offset` is where to resume, if anywhere."""
+
+    def __init__(self, reason, message, offset=None):
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+        self.offset = offset
+
+
+def max_bytes():
+    return getattr(settings, "PROFILE_PICTURE_MAX_BYTES", 5 * 1024 * 1024)
+
+
+def max_dimension():
+    return getattr(settings, "PROFILE_PICTURE_MAX_DIMENSION", 4096)
+
+
+def max_open():
+    return getattr(settings, "PROFILE_PICTURE_MAX_OPEN_UPLOADS", 3)
+
+
+def _expiry():
+    return getattr(settings, "PROFILE_PICTURE_UPLOAD_EXPIRY", 24 * 3600)
+
+
+def upload_dir():
+    directory = getattr(settings, "PROFILE_PICTURE_UPLOAD_DIR", None)
+    directory = Path(directory) if directory else Path(tempfile.gettempdir()) / "profile-picture-uploads"
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+
+def _part_path(upload_id):
+    return upload_dir() / f"{upload_id}.part"
+
+
+def check_image(image_format, width, height):
+    """Refuse a format or size we do not take; called with the header's values only."""
+    if image_format not in FORMATS:
+        raise UploadRejected(NOT_AN_IMAGE, "Only JPEG, PNG, GIF and WebP pictures are accepted")
+    limit = max_dimension()
+    if width > limit or height > limit:
+        raise UploadRejected(TOO_MANY_PIXELS, f"Pictures can be at most {limit}x{limit} pixels")
+
+
+def read_header(path):
+    """(format, width, height) from the image header, or None while it is incomplete or unknown."""
+    # Pillow is only needed once an upload is in flight, not at worker start
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(path, formats=list(FORMATS)) as image:
+            return image.format, image.width, image.height
+    except Image.DecompressionBombError:
+        limit = max_dimension()
+        raise UploadRejected(TOO_MANY_PIXELS, f"Pictures can be at most {limit}x{limit} pixels")
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+        return None
+
+
+def _inspect(path, written, size):
+    """The header of the first `written` bytes if it is acceptable, None if it is not in yet."""
+    header = read_header(path)
+    if header is not None:
+        check_image(*header)
+    elif written >= min(HEADER_BYTES, size):
+        raise UploadRejected(NOT_AN_IMAGE, "Only JPEG, PNG, GIF and WebP pictures are accepted")
+    return header
+
+
+def prune():
+    """Delete the part files of uploads untouched for the expiry; returns how many."""
+    cutoff = time.time() - _expiry()
+    pruned = 0
+    for path in upload_dir().glob("*.part"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                pruned += 1
+        except FileNotFoundError:
+            pass
+    return pruned
+
+
+def start(user, size):
+    if size > max_bytes():
+        raise UploadRejected(TOO_LARGE, f"Pictures can be at most {max_bytes()} bytes")
+
+    lock = USER_LOCK_KEY.format(user.pk)
+    if not cache.add(lock, 1, 60):
+        raise UploadRejected(BUSY, "Another upload is being started")
+    try:
+        # finished, cancelled and expired uploads have no state left
+        key = USER_KEY.format(user.pk)
+        ids = cache.get(key, [])
+        states = cache.get_many([STATE_KEY.format(upload_id) for upload_id in ids])
+        ids = [upload_id for upload_id in ids if STATE_KEY.format(upload_id) in states]
+        if len(ids) >= max_open():
+            raise UploadRejected(TOO_MANY_UPLOADS, f"At most {max_open()} uploads can be open at once")
+
+        upload_id = str(uuid.uuid4())
+        _part_path(upload_id).touch(exist_ok=False)
+        state = {"id": upload_id, "user_id": user.pk, "size": size, "offset": 0, "header": None, "complete": False}
+        cache.set(STATE_KEY.format(upload_id), state, _expiry())
+        cache.set(key, [*ids, upload_id], _expiry())
+        return state
+    finally:
+        cache.delete(lock)
+
+
+def _load(user, upload_id):
+    state = cache.get(STATE_KEY.format(upload_id))
+    path = _part_path(upload_id)
+    if state is None or state["user_id"] != user.pk or not path.exists():
+        raise UploadRejected(NOT_FOUND, "Upload not found or expired")
+    # the file is the truth: a chunk cut off mid-way still counts up to its last byte
+    state["offset"] = path.stat().st_size
+    return state, path
+
+
+def status(user, upload_id):
+    state, _ = _load(user, upload_id)
+    return state
+
+
+def abort(user, upload_id):
+    _load(user, upload_id)
+    _discard(upload_id)
+
+
+def _discard(upload_id):
+    cache.delete(STATE_KEY.format(upload_id))
+    _part_path(upload_id).unlink(missing_ok=True)
+
+
+def _refuse(state, reason, message):
+    _discard(state["id"])
+    raise UploadRejected(reason, message)
+
+
+def append(user, upload_id, stream, offset, length=None):
+    """
+    Write the bytes of `stream` (at most `length` of them, when known) at
+    `offset`. Returns the new state; the profile has its new picture once
+    `complete` is set.
+    """
+    lock = LOCK_KEY.format(upload_id)
+    if not cache.add(lock, 1, 60):
+        raise UploadRejected(BUSY, "Another chunk of this upload is being written")
+    try:
+        state, path = _load(user, upload_id)
+        if offset != state["offset"]:
+            raise UploadRejected(WRONG_OFFSET, "Resume from the current offset", offset=state["offset"])
+        size = state["size"]
+        if length is not None and offset + length > size:
+            _refuse(state, TOO_LARGE, "Chunk runs past the declared size")
+
+        written, rejected = offset, None
+        with open(path, "r+b") as part:
+            part.seek(offset)
+            remaining = length
+            while remaining is None or remaining > 0:
+                data = stream.read(READ_SIZE if remaining is None else min(READ_SIZE, remaining))
+                if not data:
+                    break
+                if written + len(data) > size:
+                    rejected = UploadRejected(TOO_LARGE, "Chunk runs past the declared size")
+                    break
+                part.write(data)
+                written += len(data)
+                if remaining is not None:
+                    remaining -= len(data)
+                if state["header"] is None:
+                    # after every buffer until the header is known, not at the end of the chunk
+                    part.flush()
+                    try:
+                        state["header"] = _inspect(path, written, size)
+                    except UploadRejected as exc:
+                        rejected = exc
+                        break
+        if rejected is not None:
+            _discard(state["id"])
+            raise rejected
+        state["offset"] = written
+
+        if written == size:
+            _attach(user, state, path)
+            _discard(state["id"])
+            state["complete"] = True
+        else:
+            cache.set(STATE_KEY.format(upload_id), state, _expiry())
+        return state
+    finally:
+        cache.delete(lock)
+
+
+def _attach(user, state, path):
+    from PIL import Image
+    from authentication.models import UserProfile
+
+    try:
+        with Image.open(path, formats=list(FORMATS)) as image:
+            image.verify()
+    except Exception:
+        _refuse(state, NOT_AN_IMAGE, "The picture is damaged")
+
+    default = UserProfile._meta.get_field("profile_picture").default
+    alias = sharding.shard_for_user(user)
+    with transaction.atomic(using=alias):
+        profile = UserProfile.objects.select_for_update().select_related("user").get(user=user)
+        previous = profile.profile_picture.name
+        with open(path, "rb") as part:
+            profile.profile_picture.save(f"picture.{FORMATS[state['header'][0]]}", File(part), save=False)
+        stored = profile.profile_picture
+        try:
+            profile.save(update_fields=["profile_picture"])
+        except Exception:
+            stored.storage.delete(stored.name)
+            raise
+        if previous and previous != default:
+            transaction.on_commit(partial(stored.storage.delete, previous), using=alias)
+    return profile
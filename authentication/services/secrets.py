@@ -1,30 +1,151 @@
 # authentication/secrets.py
 
+import functools
+import os
 import string
 import hmac
 import hashlib
-import secrets
+import threading
 from django.conf import settings
 
 
+MFA_ALPHABET = string.ascii_letters + string.digits
+TEMP_PASSWORD_ALPHABET = string.ascii_letters + string.digits + string.punctuation
+
+
+class EntropyPool:
+    """
+    Buffered `os.urandom` reader.
+
+    One syscall fills `size` bytes which are then handed out under a lock.
+    The buffer is discarded in forked children so a worker never reuses
+    bytes its parent already handed out.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self._lock = threading.Lock()
+        self._buffer = b""
+        self._offset = 0
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._buffer = b""
+        self._offset = 0
+
+    def take(self, n):
+        with self._lock:
+            if self._offset + n > len(self._buffer):
+                self._buffer = os.urandom(max(self.size, n))
+                self._offset = 0
+            chunk = self._buffer[self._offset:self._offset + n]
+            self._offset += n
+            return chunk
+
+
+_pool = EntropyPool()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_pool.reset)
+
+
+@functools.lru_cache(maxsize=None)
+def _translation(alphabet):
+    """
+    Table for rejection sampling over an ASCII alphabet: bytes below the
+    largest multiple of len(alphabet) map to `alphabet[byte % n]`, the rest
+    are deleted, so every character is equally likely.
+    """
+    n = len(alphabet)
+    limit = 256 - (256 % n)
+    table = bytes(ord(alphabet[byte % n]) if byte < limit else 0 for byte in range(256))
+    return table, bytes(range(limit, 256)), limit
+
+
+def random_strings(alphabet, length, count, pool=_pool):
+    """Return `count` uniform strings of `length` characters from `alphabet`."""
+    table, rejected, limit = _translation(alphabet)
+    total = length * count
+    out = bytearray()
+    while len(out) < total:
+        need = total - len(out)
+        # expected bytes for `need` accepted ones, plus some slack
+        out += pool.take(need * 256 // limit + 8).translate(table, rejected)
+    text = out[:total].decode("ascii")
+    return [text[i:i + length] for i in range(0, total, length)]
+
+
+def random_string(alphabet, length, pool=_pool):
+    return random_strings(alphabet, length, 1, pool)[0]
+
+
+class HmacTemplate:
+    """
+    HMAC-SHA256 with the key schedule done once.
+
+    The inner and outer pad states are hashed at construction; each digest
+    only copies them, which skips re-encoding and re-padding the key and the
+    `hmac.HMAC` object setup on every call. Output equals `hmac.new(key, msg,
+    hashlib.sha256).hexdigest()`.
+    """
+
+    def __init__(self, key: bytes):
+        block_size = hashlib.sha256().block_size
+        if len(key) > block_size:
+            key = hashlib.sha256(key).digest()
+        key = key.ljust(block_size, b"\0")
+        self._inner = hashlib.sha256(key.translate(hmac.trans_36))
+        self._outer = hashlib.sha256(key.translate(hmac.trans_5C))
+
+    def hexdigest(self, message: bytes) -> str:
+        inner = self._inner.copy()
+        inner.update(message)
+        outer = self._outer.copy()
+        outer.update(inner.digest())
+        return outer.hexdigest()
+
+
 class SecretGenerator:
 
+    # rebuilt only when SECRET_KEY changes (e.g. override_settings in tests)
+    _mfa_hmac = None
+    _mfa_hmac_key = None
+
+    @staticmethod
+    def _keyed_hmac():
+        key = settings.SECRET_KEY
+        if key is not SecretGenerator._mfa_hmac_key:
+            SecretGenerator._mfa_hmac = HmacTemplate(key.encode())
+            SecretGenerator._mfa_hmac_key = key
+        return SecretGenerator._mfa_hmac
+
     @staticmethod
     def generate_mfa_hash(email: str, code: str) -> str:
-        message = f"{email}:{code}".encode()
-        return hmac.new(
-            settings.SECRET_KEY.encode(),
-            message,
-            hashlib.sha256
-        ).hexdigest()
+        return SecretGenerator._keyed_hmac().hexdigest(f"{email}:{code}".encode())
+
+    @staticmethod
+    def generate_recovery_hash(user_id, code: str) -> str:
+        return SecretGenerator._keyed_hmac().hexdigest(f"recovery:{user_id}:{code}".encode())
+
+    @staticmethod
+    def generate_device_hash(token: str) -> str:
+        return SecretGenerator._keyed_hmac().hexdigest(f"device:{token}".encode())
+
+    @staticmethod
+    def generate_device_token(length=43) -> str:
+        return random_string(string.ascii_letters + string.digits, length)
 
     @staticmethod
     def generate_mfa_code(length=8) -> str:
-        alphabet = string.ascii_letters + string.digits
-        return "".join(secrets.choice(alphabet) for _ in range(length))
-    
+        return random_string(MFA_ALPHABET, length)
+
+    @staticmethod
+    def generate_mfa_codes(count, length=8) -> list:
+        return random_strings(MFA_ALPHABET, length, count)
 
     @staticmethod
     def generate_temp_password(length=12) -> str:
-        alphabet = string.ascii_letters + string.digits + string.punctuation
-        return "".join(secrets.choice(alphabet) for _ in range(length))
+        return random_string(TEMP_PASSWORD_ALPHABET, length)
+
+    @staticmethod
+    def generate_temp_passwords(count, length=12) -> list:
+        return random_strings(TEMP_PASSWORD_ALPHABET, length, count)
@@ -0,0 +1,229 @@
+#authentication.services.sharding
+"""
+User sharding.
+
+With USER_SHARDS set to several database aliases, each user and every row
+that hangs off it (profile, tokens, MFA and recovery codes, trusted devices,
+temp passwords) live together on one alias, picked by a stable hash of the
+lower-cased email. User ids come from a separate range on each shard
+(`index << SHARD_ID_SHIFT`), so an id alone - from a JWT claim, a session or
+a foreign key - is enough to find the shard again.
+
+The position of an alias in USER_SHARDS is part of the placement: adding,
+removing or reordering shards needs a data migration.
+
+Each shard's unique index on the email only sees its own users, and a user
+whose email changes stays where it was placed. `claim_email()` keeps emails
+unique across shards with one EmailClaim row per email on `default`.
+
+Without USER_SHARDS everything stays on `default` and none of this applies.
+"""
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, models, transaction
+from django.utils import timezone
+
+
+# 2**40 user ids per shard
+SHARD_ID_SHIFT = 40
+
+# a claim no user holds after this long was left by a save that failed
+CLAIM_GRACE = timedelta(minutes=10)
+
+
+def aliases():
+    return list(getattr(settings, "USER_SHARDS", None) or [DEFAULT_DB_ALIAS])
+
+
+def is_enabled():
+    return len(aliases()) > 1
+
+
+def shard_for_email(email):
+    shards = aliases()
+    if len(shards) == 1:
+        return shards[0]
+    key = (email or "").strip().lower().encode()
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return shards[int.from_bytes(digest, "big") % len(shards)]
+
+
+def shard_for_user_id(user_id):
+    shards = aliases()
+    try:
+        index = int(user_id) >> SHARD_ID_SHIFT
+    except (TypeError, ValueError):
+        return shards[0]
+    return shards[index] if index < len(shards) else shards[0]
+
+
+def shard_for_user(user):
+    """Shard of a user instance or id; only reads `pk`, so lazy users stay unloaded."""
+    return shard_for_user_id(getattr(user, "pk", user))
+
+
+def shard_for_instance(instance):
+    """Shard a new user, or a new row owned by a user, is written to."""
+    if instance._meta.label == settings.AUTH_USER_MODEL:
+        if instance.pk is not None:
+            return shard_for_user_id(instance.pk)
+        return shard_for_email(instance.email)
+    return shard_for_user_id(instance.user_id)
+
+
+def reserve_id_range(using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Start the user id sequence on `using` at the beginning of its range.
+    Connected to post_migrate, so `migrate --database=<shard>` sets it up.
+    """
+    shards = aliases()
+    if len(shards) == 1 or using not in shards:
+        return
+
+    start = shards.index(using) << SHARD_ID_SHIFT
+    if not start:
+        return
+
+    from django.contrib.auth import get_user_model
+
+    table = get_user_model()._meta.db_table
+    connection = connections[using]
+    quoted = connection.ops.quote_name(table)
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT MAX(id) FROM {quoted}")
+        if (cursor.fetchone()[0] or 0) >= start:
+            return
+
+        # the next id handed out is start + 1
+        if connection.vendor == "sqlite":
+            cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [start, table])
+            if not cursor.rowcount:
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, start])
+        elif connection.vendor == "postgresql":
+            cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), %s)", [table, start])
+        elif connection.vendor == "mysql":
+            cursor.execute(f"ALTER TABLE {quoted} AUTO_INCREMENT = {start + 1}")
+
+
+def _email_taken(email, user_id):
+    from django.contrib.auth import get_user_model
+
+    return get_user_model().objects.by_email(email).exclude(pk=user_id).first_on_any_shard() is not None
+
+
+def claim_email(email, user_id=None):
+    """
+    Reserve the lower-cased `email` for user `user_id` (None for a new user)
+    before it is written. Raises IntegrityError, as a single database's
+    unique index would, when another user has it or is being saved with it.
+    """
+    from authentication.models import EmailClaim
+
+    claims = EmailClaim.objects.using(DEFAULT_DB_ALIAS)
+    try:
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            claims.create(email=email)
+    except IntegrityError:
+        # left by a failed save or a deleted user: take it over, at most once
+        stale = claims.filter(email=email, created_at__lt=timezone.now() - CLAIM_GRACE)
+        if _email_taken(email, user_id) or not stale.update(created_at=timezone.now()):
+            raise IntegrityError(f"Email {email!r} is already in use")
+        return
+
+    # users saved before claims were kept have none
+    if _email_taken(email, user_id):
+        release_email(email)
+        raise IntegrityError(f"Email {email!r} is already in use")
+
+
+def release_email(email):
+    from authentication.models import EmailClaim
+
+    EmailClaim.objects.using(DEFAULT_DB_ALIAS).filter(email=email).delete()
+
+
+class ShardRoutedQuerySet(models.QuerySet):
+    """
+    QuerySet that moves itself to the right shard when it is filtered or
+    created by a shard key. `shard_keys` maps a lookup to the function that
+    turns its value into an alias. An explicit `.using()` always wins.
+    """
+    shard_keys = {}
+
+    def _shard_for(self, kwargs):
+        if not is_enabled():
+            return None
+        for lookup, resolve in self.shard_keys.items():
+            if kwargs.get(lookup) is not None:
+                return resolve(kwargs[lookup])
+        return None
+
+    def _routed(self, kwargs):
+        if self._db is None:
+            alias = self._shard_for(kwargs)
+            if alias is not None:
+                return self.using(alias)
+        return self
+
+    def filter(self, *args, **kwargs):
+        queryset = super().filter(*args, **kwargs)
+        if queryset._db is None:
+            # set on the fresh clone so sticky filters (related managers) are kept
+            queryset._db = self._shard_for(kwargs)
+        return queryset
+
+    def create(self, **kwargs):
+        return super(ShardRoutedQuerySet, self._routed(kwargs)).create(**kwargs)
+
+    def get_or_create(self, defaults=None, **kwargs):
+        return super(ShardRoutedQuerySet, self._routed(kwargs)).get_or_create(defaults, **kwargs)
+
+    def update_or_create(self, defaults=None, create_defaults=None, **kwargs):
+        return super(ShardRoutedQuerySet, self._routed(kwargs)).update_or_create(
+            defaults, create_defaults, **kwargs
+        )
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        queryset = self
+        if objs and self._db is None and is_enabled():
+            queryset = self.using(shard_for_instance(objs[0]))
+        return super(ShardRoutedQuerySet, queryset).bulk_create(objs, *args, **kwargs)
+
+    def first_on_any_shard(self):
+        """
+        First match, trying this queryset's shard and then the others. For
+        lookups without a shard key (a token from an email link) and for
+        users whose email changed after they were placed. A miss costs one
+        query per shard.
+        """
+        obj = self.first()
+        if obj is not None or not is_enabled():
+            return obj
+        tried = self.db
+        for alias in aliases():
+            if alias != tried:
+                obj = self.using(alias).first()
+                if obj is not None:
+                    return obj
+        return None
+
+
+class UserQuerySet(ShardRoutedQuerySet):
+    shard_keys = {
+        "email": shard_for_email,
+        "email_lower": shard_for_email,
+        "pk": shard_for_user_id,
+        "id": shard_for_user_id,
+    }
+
+
+class UserOwnedQuerySet(ShardRoutedQuerySet):
+    shard_keys = {
+        "user": shard_for_user,
+        "user_id": shard_for_user_id,
+        "user__pk": shard_for_user_id,
+        "user__id": shard_for_user_id,
+    }
@@ -0,0 +1,140 @@
+#authentication.services.totp
+"""
+RFC 6238 time-based one-time passwords for authenticator apps.
+
+Codes are checked in-process against the secret on `UserProfile`: no row is
+written and no email is sent. Each accepted time step is claimed in the
+cache so the same code cannot be replayed inside the verification window.
+
+A login that passed the password check gets a signed challenge, which the
+client must send back with the code: a code alone, or a code sent by another
+client, completes nothing. A challenge is dropped after MAX_ATTEMPTS wrong
+codes, so a login gets a handful of guesses at a 6-digit code rather than
+as many as fit in PENDING_TTL. Used steps, waiting challenges and failure
+counts live in the shared cache (CACHES), so every worker sees them.
+"""
+import base64
+import hashlib
+import hmac
+import struct
+import time
+from urllib.parse import quote, urlencode
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+
+from authentication.services.secrets import random_string
+
+
+PERIOD = 30
+DIGITS = 6
+# accepted clock drift, in steps either side of now
+WINDOW = getattr(settings, "MFA_TOTP_WINDOW", 1)
+
+BASE32_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ234567"
+RECOVERY_ALPHABET = "abcdefghjkmnpqrstuvwxyz23456789"
+
+
+def generate_secret():
+    """160-bit secret, base32 encoded as authenticator apps expect."""
+    return random_string(BASE32_ALPHABET, 32)
+
+
+def generate_recovery_codes(count=10):
+    return [
+        f"{code[:5]}-{code[5:]}"
+        for code in (random_string(RECOVERY_ALPHABET, 10) for _ in range(count))
+    ]
+
+
+def provisioning_uri(secret, email, issuer=None):
+    """otpauth:// URI to render as a QR code in the enrollment screen."""
+    issuer = issuer or settings.SITE_NAME
+    label = quote(f"{issuer}:{email}")
+    query = urlencode({
+        "secret": secret,
+        "issuer": issuer,
+        "algorithm": "SHA1",
+        "digits": DIGITS,
+        "period": PERIOD,
+    })
+    return f"otpauth://totp/{label}?{query}"
+
+
+def code_at(secret, step):
+    key = base64.b32decode(secret, casefold=True)
+    digest = hmac.digest(key, struct.pack(">Q", step), hashlib.sha1)
+    offset = digest[-1] & 0x0F
+    value = struct.unpack(">I", digest[offset:offset + 4])[0] & 0x7FFFFFFF
+    return str(value % 10 ** DIGITS).zfill(DIGITS)
+
+
+def current_step(now=None):
+    return int((time.time() if now is None else now) // PERIOD)
+
+
+def verify(secret, code, user_id, now=None):
+    """
+    Return True if `code` is valid for a step inside the window and that
+    step has not been used by `user_id` before.
+    """
+    code = (code or "").strip().replace(" ", "")
+    if not secret or len(code) != DIGITS or not code.isdigit():
+        return False
+
+    step = current_step(now)
+    for candidate in range(step - WINDOW, step + WINDOW + 1):
+        if hmac.compare_digest(code_at(secret, candidate), code):
+            # add() is atomic: only the first request can claim the step
+            ttl = (2 * WINDOW + 1) * PERIOD
+            return cache.add(f"totp-used:{user_id}:{candidate}", True, ttl)
+    return False
+
+
+# ---- login challenge ----
+# issued after the password check so a TOTP code alone cannot log anyone in
+
+PENDING_TTL = 5 * 60
+PENDING_KEY = "mfa-pending:{}"
+ATTEMPTS_KEY = "mfa-attempts:{}"
+MAX_ATTEMPTS = getattr(settings, "MFA_TOTP_MAX_ATTEMPTS", 5)
+CHALLENGE_SALT = "authentication.totp.login-challenge"
+NONCE_ALPHABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+
+def start_login(user_id):
+    """Mark a login of `user_id` as waiting for its code; returns the challenge for the client."""
+    nonce = random_string(NONCE_ALPHABET, 32)
+    cache.set(PENDING_KEY.format(nonce), user_id, PENDING_TTL)
+    return signing.dumps({"user": user_id, "nonce": nonce}, salt=CHALLENGE_SALT)
+
+
+def read_challenge(challenge):
+    """(user_id, nonce) of a challenge that is still waiting, or None."""
+    try:
+        data = signing.loads(challenge or "", salt=CHALLENGE_SALT, max_age=PENDING_TTL)
+    except signing.BadSignature:
+        return None
+    if cache.get(PENDING_KEY.format(data["nonce"])) != data["user"]:
+        return None
+    return data["user"], data["nonce"]
+
+
+def finish_login(nonce):
+    """Return False if another request already completed this challenge."""
+    cache.delete(ATTEMPTS_KEY.format(nonce))
+    return cache.delete(PENDING_KEY.format(nonce))
+
+
+def fail_login(nonce):
+    """Count a wrong code against the challenge; the last allowed one ends it."""
+    key = ATTEMPTS_KEY.format(nonce)
+    cache.add(key, 0, PENDING_TTL)
+    try:
+        failures = cache.incr(key)
+    except ValueError:
+        # expired between add() and incr()
+        failures = MAX_ATTEMPTS
+    if failures >= MAX_ATTEMPTS:
+        cache.delete_many([PENDING_KEY.format(nonce), key])
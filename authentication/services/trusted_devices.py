@@ -0,0 +1,98 @@
+#authentication.services.trusted_devices
+"""
+Trusted-device registry.
+
+After a successful MFA challenge the client may ask to trust the device. It
+gets a random device token, returned in the response body and as a signed
+cookie. Later logins that present it for the same user skip the MFA round
+trip. Only the keyed hash of the token is stored, and a device can be
+revoked at any time. All of a user's devices are revoked when the password
+changes (reset, temp password change, bulk reset), the account is
+deactivated, or the authenticator app is disabled.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from authentication.models import TrustedDevice
+from authentication.services.secrets import SecretGenerator
+
+
+LIFETIME = getattr(settings, "TRUSTED_DEVICE_LIFETIME", timedelta(days=30))
+COOKIE_NAME = getattr(settings, "TRUSTED_DEVICE_COOKIE_NAME", "trusted_device")
+HEADER_NAME = "HTTP_X_DEVICE_TOKEN"
+COOKIE_SALT = "authentication.trusted_device"
+
+# last_used_at is refreshed at most this often, not on every login
+TOUCH_INTERVAL = timedelta(hours=1)
+
+
+def read_token(request, body_token=None):
+    """Device token from the X-Device-Token header, the validated body field or the signed cookie."""
+    token = request.META.get(HEADER_NAME) or body_token
+    if not token:
+        token = request.get_signed_cookie(COOKIE_NAME, default=None, salt=COOKIE_SALT)
+    return token or None
+
+
+def issue(user, request):
+    token = SecretGenerator.generate_device_token()
+    now = timezone.now()
+    TrustedDevice.objects.create(
+        user=user,
+        token_hash=SecretGenerator.generate_device_hash(token),
+        device=request.META.get("HTTP_USER_AGENT", "")[:255],
+        request_ip=request.META.get("REMOTE_ADDR"),
+        created_at=now,
+        last_used_at=now,
+        expires_at=now + LIFETIME,
+    )
+    return token
+
+
+def attach(response, token):
+    response.set_signed_cookie(
+        COOKIE_NAME,
+        token,
+        salt=COOKIE_SALT,
+        max_age=int(LIFETIME.total_seconds()),
+        httponly=True,
+        secure=not settings.DEBUG,
+        samesite="Lax",
+    )
+    return response
+
+
+def is_trusted(user, token):
+    if not token:
+        return False
+
+    now = timezone.now()
+    device = (
+        TrustedDevice.objects
+        .filter(
+            token_hash=SecretGenerator.generate_device_hash(token),
+            user=user,
+            revoked_at__isnull=True,
+            expires_at__gt=now,
+        )
+        .only("id", "last_used_at")
+        .first()
+    )
+    if device is None:
+        return False
+
+    if device.last_used_at < now - TOUCH_INTERVAL:
+        TrustedDevice.objects.filter(pk=device.pk).update(last_used_at=now)
+    return True
+
+
+def active_devices(user):
+    return TrustedDevice.objects.filter(
+        user=user, revoked_at__isnull=True, expires_at__gt=timezone.now()
+    ).order_by("-last_used_at")
+
+
+def revoke_all(user):
+    return active_devices(user).update(revoked_at=timezone.now())
@@ -0,0 +1,160 @@
+#authentication.services.user_directory
+"""
+Cached user cards for the public directory.
+
+A card is PublicUserSerializer's output for one user, with the picture
+as a relative URL so one entry serves every host. Cards are cached under
+the user id, and each slug under its user id, so a batch of slugs is two
+`get_many` calls when everything is warm and one query for the rest:
+
+- Saving or deleting a user or profile drops that user's card (see
+  authentication.signals), again after commit so a read racing the
+  transaction cannot put the old card back for long.
+- A slug that moved to another user, or away from this one, is caught by
+  comparing it with the card's own slug, and looked up again.
+- Users whose profile `is_deleted` are cached as hidden and left out.
+  Slugs of no user are cached too, until a user is saved with them.
+- The owner of a stored picture is cached by the file name. Names are
+  unique and never move to another user, so the entry does not go stale;
+  a replaced picture is caught by comparing it with the owner's card.
+
+With several workers the cache must be shared, as for auth_state.
+"""
+import hashlib
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from authentication.services import sharding
+
+
+CARD_KEY = "user-card:{}"
+SLUG_KEY = "user-card-slug:{}"
+PICTURE_KEY = "user-card-picture:{}"
+# cached as the user id of a slug nobody has
+NO_USER = 0
+# the columns PublicUserSerializer reads
+CARD_FIELDS = ("id", "slug", "first_name", "last_name", "profile__profile_picture", "profile__is_deleted")
+CARD_COLUMNS = frozenset(("slug", "first_name", "last_name", "profile_picture", "is_deleted"))
+
+
+def _timeout():
+    return getattr(settings, "USER_DIRECTORY_CACHE_TIMEOUT", 24 * 3600)
+
+
+def cards_queryset(queryset):
+    return queryset.select_related("profile").only(*CARD_FIELDS)
+
+
+def build_card(user):
+    from authentication.serializers.profile import PublicUserSerializer
+
+    return {
+        **PublicUserSerializer(user, context={"request": None}).data,
+        "hidden": user.profile.is_deleted,
+    }
+
+
+def public(card, request):
+    """The card as the API shows it: without `hidden`, with an absolute picture URL."""
+    card = {key: value for key, value in card.items() if key != "hidden"}
+    if card["profile_picture"] and request is not None:
+        card["profile_picture"] = request.build_absolute_uri(card["profile_picture"])
+    return card
+
+
+def store(users):
+    """Cache the cards of loaded users and return them by slug."""
+    users = list(users)
+    cards = {user.slug: build_card(user) for user in users}
+    timeout = _timeout()
+    cache.set_many({CARD_KEY.format(user.pk): cards[user.slug] for user in users}, timeout)
+    cache.set_many({SLUG_KEY.format(user.slug): user.pk for user in users}, timeout)
+    return cards
+
+
+def get_cards(slugs):
+    """Visible cards for `slugs`, by slug; unknown and deleted users are left out."""
+    slugs = list(dict.fromkeys(slugs))
+    ids = cache.get_many([SLUG_KEY.format(slug) for slug in slugs])
+    cached = cache.get_many([CARD_KEY.format(pk) for pk in ids.values()])
+
+    cards, missing = {}, []
+    for slug in slugs:
+        pk = ids.get(SLUG_KEY.format(slug))
+        if pk == NO_USER:
+            continue
+        card = cached.get(CARD_KEY.format(pk))
+        if card is not None and card["slug"] == slug:
+            cards[slug] = card
+        else:
+            missing.append(slug)
+
+    from authentication.models import User
+
+    # slugs are not a shard key: ask each shard for what is still missing
+    for alias in sharding.aliases():
+        if not missing:
+            break
+        found = store(cards_queryset(User.objects.using(alias).filter(slug__in=missing)))
+        cards.update(found)
+        missing = [slug for slug in missing if slug not in found]
+    cache.set_many({SLUG_KEY.format(slug): NO_USER for slug in missing}, _timeout())
+
+    return {slug: card for slug, card in cards.items() if not card["hidden"]}
+
+
+def get_card(slug):
+    return get_cards([slug]).get(slug)
+
+
+def get_card_by_id(user_id):
+    """The visible card of user `user_id`, or None."""
+    from authentication.models import User
+
+    card = cache.get(CARD_KEY.format(user_id))
+    if card is None:
+        user = cards_queryset(User.objects.filter(pk=user_id)).first()
+        if user is None:
+            return None
+        card = store([user])[user.slug]
+    return None if card["hidden"] else card
+
+
+def picture_owner(name):
+    """Id of the user whose profile has (or had) the picture stored as `name`, or None."""
+    from authentication.models import UserProfile
+
+    # hashed: `name` comes from the URL
+    key = PICTURE_KEY.format(hashlib.sha256(name.encode()).hexdigest())
+    user_id = cache.get(key)
+    if user_id is not None:
+        return user_id
+    # file names are not a shard key; misses are not cached, any path can be asked for
+    for alias in sharding.aliases():
+        user_id = (
+            UserProfile.objects.using(alias)
+            .filter(profile_picture=name)
+            .values_list("user_id", flat=True)
+            .first()
+        )
+        if user_id is not None:
+            cache.set(key, user_id, _timeout())
+            return user_id
+    return None
+
+
+def forget(user_id, using="default", update_fields=None, slug=None):
+    """
+    Drop a user's card, and what is cached for `slug` (their current one).
+    Saves limited to `update_fields` outside the card are skipped.
+    """
+    if update_fields is not None and not CARD_COLUMNS.intersection(update_fields):
+        return
+    keys = [CARD_KEY.format(user_id)]
+    if slug:
+        keys.append(SLUG_KEY.format(slug))
+    cache.delete_many(keys)
+    transaction.on_commit(partial(cache.delete_many, keys), using=using)
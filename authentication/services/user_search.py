@@ -0,0 +1,152 @@
+#authentication.services.user_search
+"""
+Full-text search over users for administrators.
+
+On SQLite an FTS5 table `authentication_user_search` indexes each user's
+email, first and last name and profile bio under the user's id (its
+rowid). Every term of a query matches as a word prefix, so "jo exa" finds
+john.doe@example.com; results are ranked with BM25, email and name
+matches weighing more than the bio.
+
+- The table is created by migration 0010 on every SQLite database and
+  filled by `manage.py rebuild_user_search`.
+- Saving or deleting a user or profile re-indexes that one user (see
+  authentication.signals). Querysets' `update()` and `bulk_create()`
+  send no signals; rebuild after changing indexed fields that way.
+- With USER_SHARDS each shard indexes its own users and the pages are
+  merged by rank.
+
+Other databases, or an SQLite built without FTS5, fall back to a
+case-insensitive prefix match on email and names, ordered by id.
+"""
+import heapq
+import re
+
+from django.db import DatabaseError, connections
+from django.db.models import Q
+
+from authentication.services import sharding
+
+
+TABLE = "authentication_user_search"
+# bm25() weights, in column order
+WEIGHTS = (10.0, 5.0, 5.0, 1.0)
+# same word characters as FTS5's unicode61 tokenizer
+TERM = re.compile(r"\w+")
+MAX_TERMS = 8
+INDEXED_FIELDS = frozenset(("email", "first_name", "last_name", "bio"))
+
+CREATE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5("
+    "email, first_name, last_name, bio, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+# the current row of one user, or of all of them; the user id is the rowid
+SELECT_SQL = (
+    "SELECT u.id, u.email, u.first_name, u.last_name, COALESCE(p.bio, '') "
+    "FROM authentication_user u LEFT JOIN authentication_userprofile p ON p.user_id = u.id"
+)
+
+
+# databases (by file name) known to have the table
+_available = set()
+
+
+def is_available(using="default"):
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        return False
+    name = connection.settings_dict["NAME"]
+    if name not in _available:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [TABLE])
+            if cursor.fetchone() is None:
+                return False
+        _available.add(name)
+    return True
+
+
+def create_index(connection):
+    """Create the FTS5 table; False when SQLite was built without FTS5."""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_SQL)
+    except DatabaseError:
+        return False
+    return True
+
+
+def sync_user(user_id, using="default", update_fields=None):
+    """
+    Re-index one user from the tables, or drop them if they are gone.
+    Saves limited to `update_fields` outside the index are skipped.
+    """
+    if update_fields is not None and not INDEXED_FIELDS.intersection(update_fields):
+        return
+    if not is_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE} WHERE rowid = %s", [user_id])
+        cursor.execute(
+            f"INSERT INTO {TABLE} (rowid, email, first_name, last_name, bio) {SELECT_SQL} WHERE u.id = %s",
+            [user_id],
+        )
+
+
+def rebuild(using="default"):
+    """Re-index every user on `using` with one INSERT ... SELECT and return the row count."""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE}")
+        cursor.execute(f"INSERT INTO {TABLE} (rowid, email, first_name, last_name, bio) {SELECT_SQL}")
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+        cursor.execute(f"SELECT COUNT(*) FROM {TABLE}")
+        return cursor.fetchone()[0]
+
+
+def terms(query):
+    return TERM.findall(query.lower())[:MAX_TERMS]
+
+
+def match_expression(words):
+    """Every word as a quoted prefix, so user input never reaches FTS5's query syntax."""
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def _ranked_ids(words, limit, using):
+    weights = ", ".join(str(weight) for weight in WEIGHTS)
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"SELECT bm25({TABLE}, {weights}) AS score, rowid FROM {TABLE} "
+            f"WHERE {TABLE} MATCH %s ORDER BY score LIMIT %s",
+            [match_expression(words), limit],
+        )
+        return cursor.fetchall()
+
+
+def _fallback_ids(words, limit, using):
+    from authentication.models import User
+
+    queryset = User.objects.using(using)
+    for word in words:
+        queryset = queryset.filter(
+            Q(email__istartswith=word) | Q(first_name__istartswith=word) | Q(last_name__istartswith=word)
+        )
+    return [(0.0, pk) for pk in queryset.order_by("pk").values_list("pk", flat=True)[:limit]]
+
+
+def search(query, offset=0, limit=20):
+    """
+    Ids of the users matching `query`, best first: `limit` of them after
+    skipping `offset`.
+    """
+    words = terms(query)
+    if not words:
+        return []
+    wanted = offset + limit
+    pages = []
+    for alias in sharding.aliases():
+        find = _ranked_ids if is_available(alias) else _fallback_ids
+        pages.append(find(words, wanted, alias))
+    ranked = heapq.merge(*pages) if len(pages) > 1 else pages[0]
+    return [pk for _, pk in list(ranked)[offset:wanted]]
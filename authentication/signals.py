@@ -1,8 +1,9 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
 
-from .models import UserProfile
+from authentication.services import email_filter, metrics, user_directory, user_search
+from .models import EmailVerificationToken, MultiFactorAuthCode, PasswordResetToken, UserProfile
 
 User = get_user_model()
 
@@ -12,3 +13,32 @@ def create_user_profile(sender, instance, created, **kwargs):
     if created:
         UserProfile.objects.get_or_create(user=instance)
 
+
+@receiver(post_save, sender=User)
+def remember_email(sender, instance, update_fields=None, **kwargs):
+    # new users and changed emails; deleted ones drop out at the next rebuild
+    if update_fields is not None and "email" not in update_fields:
+        return
+    email_filter.remember(instance.email)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, using, update_fields=None, **kwargs):
+    user_search.sync_user(instance.pk, using, update_fields)
+    user_directory.forget(instance.pk, using, update_fields, slug=instance.slug)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def profile_changed(sender, instance, using, update_fields=None, **kwargs):
+    user_search.sync_user(instance.user_id, using, update_fields)
+    user_directory.forget(instance.user_id, using, update_fields)
+
+
+@receiver(post_save, sender=PasswordResetToken)
+@receiver(post_save, sender=EmailVerificationToken)
+@receiver(post_save, sender=MultiFactorAuthCode)
+def count_issued_token(sender, instance, created, **kwargs):
+    if created:
+        metrics.TOKENS_ISSUED.inc(type=sender.__name__)
@@ -1,3 +1,1458 @@
-from django.test import TestCase
+import datetime
+import decimal
+import hashlib
+import hmac
+import io
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import IntegrityError, connection
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework.throttling import ScopedRateThrottle
+
+from authentication.models import (
+    User,
+    EmailVerificationToken,
+    MultiFactorAuthCode,
+    PasswordResetToken,
+    TempPasswordManager,
+    UserProfile,
+    AuditEvent,
+    MFARecoveryCode,
+    EmailClaim,
+)
+from authentication.services import audit, bulk_users, email_filter, picture_uploads, sharding, totp, trusted_devices
+from authentication.services.email_service import EmailService
+from authentication.services.claims import AuthStateRefreshToken
+from authentication.services.secrets import HmacTemplate, MFA_ALPHABET, TEMP_PASSWORD_ALPHABET, random_strings
+from core import fastjson, schema, warmup
+from core.admission import AdmissionControlMiddleware, Limiter
+from core.metrics import Counter, Histogram, MmapValues, Registry, metrics_view
+from core.profiling import ProfilingMiddleware
+
+
+def app_queries(queries):
+    """
+    Captured queries without the database cache's own, for plan checks: its
+    culling counts the whole table. Query counts take all of them.
+    """
+    table = settings.CACHES["default"].get("LOCATION", "")
+    return [query for query in queries if f'"{table}"' not in query["sql"]]
+
+
+# ------------------------------------------------------------
+# Query-plan regression suite
+# ------------------------------------------------------------
+class QueryPlanTests(TestCase):
+    """
+    Runs each hot path, captures its SQL and fails if `EXPLAIN QUERY PLAN`
+    reports a full table scan for any of it.
+    """
+
+    PLANNED = ("SELECT", "UPDATE", "DELETE")
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="active@example.com",
+            password="Str0ng-passw0rd",
+            is_active=True,
+            is_email_verified=True,
+            has_temp_password=False,
+        )
+        cls.mfa_user = User.objects.create_user(
+            email="mfa@example.com",
+            password="Str0ng-passw0rd",
+            is_active=True,
+            is_email_verified=True,
+            has_temp_password=False,
+        )
+        cls.mfa_user.profile.multi_factor_enabled = True
+        cls.mfa_user.profile.save()
+
+        cls.new_user = User.objects.create_user(
+            email="new@example.com",
+            password=None,
+            is_active=True,
+        )
+        _, cls.temp_password = TempPasswordManager.create_temp_password(cls.new_user)
+
+        cls.admin = User.objects.create_superuser(email="admin@example.com", password="Str0ng-passw0rd")
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        # written on demand in this thread instead of by the writer thread
+        self.audit = audit.AuditBuffer(audit.DatabaseSink(), background=False)
+        self.enterContext(mock.patch.object(audit, "_buffer", self.audit))
+
+    def authenticate(self, user):
+        token = AuthStateRefreshToken.for_user(user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def scans(self, queries):
+        found = []
+        with connection.cursor() as cursor:
+            for query in app_queries(queries):
+                sql = query["sql"]
+                if not sql.lstrip().upper().startswith(self.PLANNED):
+                    continue
+                if "sqlite_stat1" in sql:
+                    # ANALYZE's statistics (EstimatedCountPaginator): a row per index, and absent until ANALYZE
+                    continue
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+                details = [row[-1] for row in cursor.fetchall()]
+                # a walk in index order that LIMIT stops reads one page, not the table
+                page_walk = " LIMIT " in sql and " WHERE " not in sql and not any("TEMP B-TREE" in d for d in details)
+                for detail in details:
+                    # FTS5 lookups (MATCH, rowid =) show as a virtual table scan with constraints
+                    virtual_lookup = "VIRTUAL TABLE INDEX" in detail and not detail.endswith(":")
+                    if detail.startswith("SCAN") and "CONSTANT ROW" not in detail and not virtual_lookup and not page_walk:
+                        found.append(f"{detail}\n    {sql}")
+        return found
+
+    def assertNoTableScans(self, queries):
+        found = self.scans(queries)
+        self.assertFalse(found, "table scans found:\n" + "\n".join(found))
+
+    def run_hot_path(self, fn):
+        with CaptureQueriesContext(connection) as ctx:
+            result = fn()
+        self.assertTrue(ctx.captured_queries)
+        self.assertNoTableScans(ctx.captured_queries)
+        return result
+
+    def test_login(self):
+        response = self.run_hot_path(lambda: self.client.post(
+            reverse("login"),
+            {"email": self.user.email, "password": "Str0ng-passw0rd"},
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.data["mfa_required"])
+        self.assertIn("access", response.data["tokens"])
+
+    def test_login_mixed_case_email(self):
+        response = None
+
+        def login():
+            nonlocal response
+            response = self.client.post(
+                reverse("login"),
+                {"email": "Active@EXAMPLE.com", "password": "Str0ng-passw0rd"},
+            )
+
+        self.run_hot_path(login)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("tokens", response.data)
+
+    def test_login_with_mfa(self):
+        response = self.run_hot_path(lambda: self.client.post(
+            reverse("login"),
+            {"email": self.mfa_user.email, "password": "Str0ng-passw0rd"},
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data["mfa_required"])
+        self.assertTrue(response.data["code_sent"])
+        self.assertNotIn("tokens", response.data)
+
+    def test_verify_mfa(self):
+        _, code = MultiFactorAuthCode.create_code(self.mfa_user, RequestFactory().post("/"))
+        response = self.run_hot_path(lambda: self.client.post(
+            reverse("login-verify-mfa"),
+            {"email": self.mfa_user.email, "code": code},
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("access", response.data["tokens"])
+
+    def test_mfa_code_is_single_use(self):
+        mfa_obj, code = MultiFactorAuthCode.create_code(self.mfa_user, RequestFactory().post("/"))
+        self.assertTrue(mfa_obj.validate_and_consume(code))
+        self.assertFalse(mfa_obj.validate_and_consume(code))
+        self.assertFalse(MultiFactorAuthCode.objects.filter(user=self.mfa_user).exists())
+
+    def test_email_verification(self):
+        token = EmailVerificationToken.objects.create(
+            user=self.new_user,
+            expires_at=timezone.now() + timedelta(hours=24),
+        )
+        self.run_hot_path(lambda: self.client.get(
+            reverse("email-verify", args=[token.token])
+        ))
+
+    def test_email_verification_token_is_single_use(self):
+        token = EmailVerificationToken.objects.create(
+            user=self.new_user,
+            expires_at=timezone.now() + timedelta(hours=24),
+        )
+        url = reverse("email-verify", args=[token.token])
+        with CaptureQueriesContext(connection) as ctx:
+            first = self.client.get(url)
+        statements = [query["sql"].split()[0] for query in app_queries(ctx.captured_queries)]
+        second = self.client.get(url)
+
+        self.assertEqual(first.status_code, 200)
+        # conditional UPDATE of the token, token and user SELECT, user UPDATE
+        self.assertEqual([s for s in statements if s in self.PLANNED], ["UPDATE", "SELECT", "UPDATE"])
+        self.assertEqual(second.status_code, 400)
+        self.assertEqual(second.data["error"], "Token expired or already used")
+        self.new_user.refresh_from_db()
+        self.assertTrue(self.new_user.is_email_verified)
+
+    def test_resend_email_verification(self):
+        self.authenticate(self.new_user)
+        response = self.run_hot_path(lambda: self.client.post(reverse("email-resend")))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["message"], "Verification email resent successfully")
+        self.assertTrue(EmailVerificationToken.objects.filter(user=self.new_user, is_used=False).exists())
+
+    def test_password_reset_request(self):
+        response = self.run_hot_path(lambda: self.client.post(
+            reverse("password-reset-request"), {"email": self.user.email}
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("message", response.data)
+        self.assertTrue(PasswordResetToken.objects.filter(user=self.user).exists())
+
+    def test_password_reset_confirm(self):
+        token = PasswordResetToken.objects.create(
+            user=self.user,
+            expires_at=timezone.now() + timedelta(hours=1),
+        )
+        self.run_hot_path(lambda: self.client.post(
+            reverse("password-reset-confirm"),
+            {"token": str(token.token), "password": "An0ther-passw0rd"},
+        ))
+
+    def test_change_temp_password(self):
+        self.authenticate(self.new_user)
+        response = self.run_hot_path(lambda: self.client.post(
+            reverse("change-temp-password"),
+            {"temp_password": self.temp_password, "password": "An0ther-passw0rd"},
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["message"], "Password changed successfully")
+        self.new_user.refresh_from_db()
+        self.assertFalse(self.new_user.has_temp_password)
+        self.assertTrue(self.new_user.check_password("An0ther-passw0rd"))
+
+    def test_me(self):
+        self.authenticate(self.user)
+        self.run_hot_path(lambda: self.client.get(reverse("me")))
+
+    def test_me_update_writes_only_sent_fields(self):
+        self.authenticate(self.user)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.patch(reverse("me"), {"first_name": "Ada", "multi_factor_enabled": True})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(User.objects.get(pk=self.user.pk).first_name, "Ada")
+        self.assertTrue(UserProfile.objects.get(user=self.user).multi_factor_enabled)
+        updates = [query["sql"] for query in ctx.captured_queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 2)
+        self.assertNotIn('"bio"', updates[1])
+
+    def test_admin_user_detail(self):
+        self.authenticate(self.admin)
+        self.run_hot_path(lambda: self.client.get(
+            reverse("admin-users-detail", args=[self.user.slug])
+        ))
+
+    def test_register(self):
+        self.authenticate(self.admin)
+        response = self.run_hot_path(lambda: self.client.post(
+            reverse("register"), {"email": "fresh@example.com"}
+        ))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["email"], "fresh@example.com")
+        self.assertTrue(User.objects.filter(pk=response.data["user_id"], email="fresh@example.com").exists())
+
+    def test_audit_log(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(
+                reverse("login"),
+                {"email": self.user.email, "password": "Str0ng-passw0rd"},
+            )
+        self.assertFalse([q for q in ctx.captured_queries if "auditevent" in q["sql"]])
+        self.assertEqual(self.audit.flush(), 1)
+
+        since = timezone.now() - timedelta(hours=1)
+        self.run_hot_path(lambda: list(AuditEvent.objects.for_user(self.user).between(since).order_by("-created_at")))
+        self.run_hot_path(lambda: list(AuditEvent.objects.between(since).of_type(AuditEvent.LOGIN_SUCCEEDED)))
+
+
+    def test_admin_user_search(self):
+        self.user.first_name, self.user.last_name = "Ada", "Lovelace"
+        self.user.save()
+        self.mfa_user.profile.bio = "Lovelace scholar"
+        self.mfa_user.profile.save()
+        self.authenticate(self.admin)
+
+        url = reverse("admin-users-search")
+        responses = []
+        self.run_hot_path(lambda: responses.append(self.client.get(url, {"q": "love"})))
+        # the name outranks the bio
+        self.assertEqual([user["email"] for user in responses[0].data["results"]],
+                         ["active@example.com", "mfa@example.com"])
+
+        self.user.delete()
+        response = self.client.get(url, {"q": "love", "page_size": 1})
+        self.assertEqual([user["email"] for user in response.data["results"]], ["mfa@example.com"])
+        self.assertIsNone(response.data["next"])
+
+
+    def test_user_directory(self):
+        self.authenticate(self.user)
+        url = reverse("user-directory-batch")
+        slugs = f"{self.user.slug},{self.mfa_user.slug},nobody"
+
+        responses = []
+        self.run_hot_path(lambda: responses.append(self.client.get(url, {"slugs": slugs})))
+        self.assertEqual([card["slug"] for card in responses[0].data["results"]], [self.user.slug, self.mfa_user.slug])
+        self.assertEqual(responses[0].data["missing"], ["nobody"])
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url, {"slugs": slugs})
+        # the auth-state version (cache), the requesting user, the card ids by slug and the cards (cache)
+        self.assertEqual(len(ctx.captured_queries), 4)
+        self.assertEqual(len(app_queries(ctx.captured_queries)), 1)
+
+        # saves drop the cached cards
+        self.user.first_name = "Renamed"
+        self.user.save()
+        self.mfa_user.profile.is_deleted = True
+        self.mfa_user.profile.save()
+        response = self.client.get(url, {"slugs": slugs})
+        self.assertEqual([card["first_name"] for card in response.data["results"]], ["Renamed"])
+        self.assertEqual(response.data["missing"], [self.mfa_user.slug, "nobody"])
+
+        first = self.client.get(reverse("user-directory-list"), {"page_size": 2})
+        self.assertEqual([card["slug"] for card in first.data["results"]], [self.user.slug, self.new_user.slug])
+        # the first page walks the primary key from the start; later ones seek to the cursor
+        self.run_hot_path(lambda: responses.append(self.client.get(first.data["next"])))
+        self.assertEqual([card["slug"] for card in responses[1].data["results"]], [self.admin.slug])
+        self.assertIsNone(responses[1].data["next"])
+        self.assertEqual(self.client.get(reverse("user-directory-detail", args=[self.mfa_user.slug])).status_code, 404)
+
+    def plans(self, queries, table):
+        """EXPLAIN QUERY PLAN details of the captured SELECTs on `table`, per query."""
+        found = []
+        with connection.cursor() as cursor:
+            for query in app_queries(queries):
+                if query["sql"].startswith("SELECT") and f'FROM "{table}"' in query["sql"]:
+                    cursor.execute(f"EXPLAIN QUERY PLAN {query['sql']}")
+                    found.append((query["sql"], " | ".join(row[-1] for row in cursor.fetchall())))
+        return found
+
+    def test_admin_token_changelist(self):
+        for _ in range(3):
+            PasswordResetToken.objects.create(user=self.user, expires_at=timezone.now() + timedelta(hours=1))
+        self.client.force_login(self.admin)
+
+        changelists = [
+            (reverse("admin:authentication_passwordresettoken_changelist"), {}),
+            (reverse("admin:authentication_passwordresettoken_changelist"), {"expires_at_range": "live"}),
+            (reverse("admin:authentication_multifactorauthcode_changelist"), {"expires_at_range": "day"}),
+            (reverse("admin:authentication_user_changelist"), {"created_at_range": "week"}),
+            (reverse("admin:authentication_auditevent_changelist"), {"created_at_range": "day"}),
+        ]
+        # a table far too big to count: the changelist pages with LIMIT
+        self.enterContext(mock.patch("authentication.services.pagination.estimated_row_count", return_value=5_000_000))
+        for url, params in changelists:
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            # every query of the page, not only the rows: no date bar DISTINCT, no sort
+            self.assertNoTableScans(ctx.captured_queries)
+            for query in app_queries(ctx.captured_queries):
+                self.assertNotIn("DISTINCT", query["sql"])
+            for table in ("authentication_passwordresettoken", "authentication_user"):
+                for sql, plan in self.plans(ctx.captured_queries, table):
+                    self.assertNotIn("TEMP B-TREE", plan, sql)
+
+        response = self.client.get(*changelists[1])
+        self.assertEqual(len(response.context["cl"].result_list), 3)
+
+    def test_admin_search_is_case_insensitive_on_email(self):
+        mixed = User.objects.create_user(email="Mixed.Case@Example.com", password="Str0ng-passw0rd")
+        token = PasswordResetToken.objects.create(user=mixed, expires_at=timezone.now() + timedelta(hours=1))
+        self.client.force_login(self.admin)
+
+        for q in ("Mixed.Case@Ex", "mixed.case", "MIXED"):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(reverse("admin:authentication_user_changelist"), {"q": q})
+            self.assertEqual(list(response.context["cl"].result_list), [mixed])
+            searches = [plan for sql, plan in self.plans(ctx.captured_queries, "authentication_user") if "LOWER" in sql]
+            self.assertTrue(searches)
+            self.assertTrue(all("user_email_lower_uniq" in plan for plan in searches), searches)
+
+        response = self.client.get(reverse("admin:authentication_passwordresettoken_changelist"), {"q": "Mixed.CASE@"})
+        self.assertEqual(list(response.context["cl"].result_list), [token])
+        # as typed and lower-cased on plain columns
+        response = self.client.get(reverse("admin:authentication_user_changelist"), {"q": mixed.slug.upper()})
+        self.assertEqual(list(response.context["cl"].result_list), [mixed])
+
+
+class AuthStateTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email="state@example.com",
+            password="Str0ng-passw0rd",
+            is_active=True,
+            is_email_verified=True,
+            has_temp_password=False,
+        )
+
+    def version(self):
+        return User.objects.values_list("auth_state_version", flat=True).get(pk=self.user.pk)
+
+    def test_only_state_changes_bump_the_version(self):
+        self.user.first_name = "Ada"
+        self.user.save()
+        self.assertEqual(self.version(), 0)
+
+        self.user.is_active = False
+        self.user.save(update_fields=["is_active"])
+        self.assertEqual(self.version(), 1)
+
+        # changed by another instance: refreshing is not a change of ours
+        stale = User.objects.get(pk=self.user.pk)
+        self.user.is_active = True
+        self.user.save()
+        stale.refresh_from_db()
+        stale.last_name = "Lovelace"
+        stale.save()
+        self.assertEqual(self.version(), 2)
+
+        # neither is a deferred password loading on first access
+        deferred = User.objects.defer("password").get(pk=self.user.pk)
+        self.assertTrue(deferred.password)
+        deferred.first_name = "Grace"
+        deferred.save()
+        self.assertEqual(self.version(), 2)
+
+    def test_tokens_issued_before_a_state_change_are_rejected(self):
+        old = APIClient(HTTP_AUTHORIZATION=f"Bearer {AuthStateRefreshToken.for_user(self.user).access_token}")
+        self.assertEqual(old.get(reverse("me")).status_code, 200)
+
+        self.user.change_password("An0ther-passw0rd")
+        response = old.get(reverse("me"))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.data["code"], "state_changed")
+
+        fresh = APIClient(HTTP_AUTHORIZATION=f"Bearer {AuthStateRefreshToken.for_user(self.user).access_token}")
+        self.assertEqual(fresh.get(reverse("me")).status_code, 200)
+
+        # seen from a cold cache too, as on a worker that never cached it
+        cache.clear()
+        self.assertEqual(old.get(reverse("me")).status_code, 401)
+
+
+class EmailCoalescingTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email="forgetful@example.com", password="Str0ng-passw0rd", is_active=True)
+
+    def setUp(self):
+        cache.clear()
+        self.enterContext(mock.patch.object(audit, "_buffer", audit.AuditBuffer(audit.DatabaseSink(), background=False)))
+
+    def request_reset(self):
+        response = self.client.post(reverse("password-reset-request"), {"email": self.user.email})
+        self.assertEqual(response.status_code, 200)
+
+    def test_repeat_reset_requests_send_one_email(self):
+        self.request_reset()
+        self.request_reset()
+        # a lost marker (evicted, or a cache that restarted) still sends nothing
+        cache.clear()
+        self.request_reset()
+        self.assertEqual(len(mail.outbox), 1)
+        first = PasswordResetToken.objects.get(user=self.user)
+
+        # after the window: a new link, and the one sent first still works
+        PasswordResetToken.objects.update(created_at=timezone.now() - timedelta(minutes=10))
+        cache.clear()
+        self.request_reset()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(PasswordResetToken.objects.filter(user=self.user, is_used=False).count(), 2)
+        first.refresh_from_db()
+        self.assertTrue(first.is_valid())
+
+    def test_failed_send_does_not_hold_back_the_next_request(self):
+        request = RequestFactory().post("/")
+        with mock.patch.object(EmailService, "send_password_reset_email", side_effect=OSError("down")):
+            with self.assertRaises(OSError):
+                EmailService.request_password_reset(self.user, request)
+        token = EmailService.request_password_reset(self.user, request)
+        self.assertIsNotNone(token)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(str(token.token), mail.outbox[0].body)
+        self.assertIsNone(EmailService.request_password_reset(self.user, request))
+
+    def test_resend_verification_replaces_the_link_once_per_window(self):
+        first = EmailService.request_verification(self.user)
+        self.assertIsNone(EmailService.request_verification(self.user))
+        self.assertEqual(len(mail.outbox), 1)
+
+        EmailVerificationToken.objects.update(created_at=timezone.now() - timedelta(minutes=10))
+        cache.clear()
+        second = EmailService.request_verification(self.user)
+        self.assertEqual(len(mail.outbox), 2)
+        first.refresh_from_db()
+        self.assertTrue(first.is_used)
+        self.assertTrue(second.is_valid())
+
+
+class TOTPTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="app@example.com",
+            password="Str0ng-passw0rd",
+            is_active=True,
+            is_email_verified=True,
+            has_temp_password=False,
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.enterContext(mock.patch.object(audit, "_buffer", audit.AuditBuffer(audit.DatabaseSink(), background=False)))
+
+    def code(self, secret, steps_ago=0):
+        return totp.code_at(secret, totp.current_step() - steps_ago)
+
+    def enable(self):
+        client = APIClient(HTTP_AUTHORIZATION=f"Bearer {AuthStateRefreshToken.for_user(self.user).access_token}")
+        secret = client.post(reverse("mfa-totp-enroll")).data["secret"]
+        response = client.post(reverse("mfa-totp-confirm"), {"code": self.code(secret)})
+        self.assertEqual(response.status_code, 200)
+        return client, secret, response.data["recovery_codes"]
+
+    def login(self):
+        response = self.client.post(reverse("login"), {"email": self.user.email, "password": "Str0ng-passw0rd"})
+        self.assertEqual(response.data["mfa_method"], UserProfile.MFA_TOTP)
+        return response.data["mfa_challenge"]
+
+    def verify(self, code, challenge=""):
+        return self.client.post(
+            reverse("login-verify-mfa"),
+            {"email": self.user.email, "code": code, "mfa_challenge": challenge},
+        )
+
+    def test_enroll_and_confirm(self):
+        client, secret, recovery_codes = self.enable()
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertTrue(profile.uses_totp and profile.multi_factor_enabled)
+        self.assertEqual(len(recovery_codes), 10)
+
+        # the code that confirmed the app cannot be used again
+        self.assertEqual(client.post(reverse("mfa-recovery-codes"), {"code": self.code(secret)}).status_code, 400)
+        self.assertEqual(client.post(reverse("mfa-recovery-codes"), {"code": self.code(secret, 1)}).status_code, 200)
+
+    def test_login_needs_the_challenge_of_that_login(self):
+        _, secret, _ = self.enable()
+        challenge = self.login()
+
+        # a valid code without the challenge, or with a forged one, is refused
+        self.assertEqual(self.verify(self.code(secret)).status_code, 400)
+        self.assertEqual(self.verify(self.code(secret), challenge[:-2] + "xx").status_code, 400)
+
+        response = self.verify(self.code(secret, 1), challenge)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("access", response.data["tokens"])
+
+        # the challenge completes one login, and the code is not accepted twice
+        self.assertEqual(self.verify(self.code(secret), challenge).status_code, 400)
+        self.assertEqual(self.verify(self.code(secret, 1), self.login()).status_code, 400)
+
+    def test_challenge_is_burned_after_wrong_codes(self):
+        _, secret, _ = self.enable()
+        challenge = self.login()
+        right = self.code(secret, 1)
+        wrong = str((int(right) + 500000) % 10 ** totp.DIGITS).zfill(totp.DIGITS)
+        for _ in range(totp.MAX_ATTEMPTS):
+            self.assertEqual(self.verify(wrong, challenge).status_code, 400)
+
+        self.assertIsNone(totp.read_challenge(challenge))
+        self.assertEqual(self.verify(right, challenge).status_code, 400)
+        # a new login starts a new count
+        self.assertEqual(self.verify(right, self.login()).status_code, 200)
+
+    def test_verify_is_throttled(self):
+        with mock.patch.object(ScopedRateThrottle, "THROTTLE_RATES", {"mfa_verify": "2/min"}):
+            statuses = [self.verify("000000").status_code for _ in range(3)]
+        self.assertEqual(statuses, [400, 400, 429])
+
+    def test_challenge_is_signed_and_expires(self):
+        challenge = totp.start_login(self.user.pk)
+        self.assertEqual(totp.read_challenge(challenge)[0], self.user.pk)
+        self.assertIsNone(totp.read_challenge(challenge[:-1]))
+        with mock.patch("django.core.signing.time.time", return_value=time.time() + totp.PENDING_TTL + 1):
+            self.assertIsNone(totp.read_challenge(challenge))
+
+    def test_recovery_code_is_spent_only_by_a_login_that_succeeds(self):
+        _, _, recovery_codes = self.enable()
+        code = recovery_codes[0]
+
+        # no waiting login: the code stays unused
+        self.assertEqual(self.verify(code, "not-a-challenge").status_code, 400)
+        self.assertTrue(MFARecoveryCode.is_unused(self.user, code))
+
+        challenge = self.login()
+        self.assertEqual(self.verify(code.upper(), challenge).status_code, 200)
+        self.assertFalse(MFARecoveryCode.is_unused(self.user, code))
+        self.assertEqual(self.verify(code, self.login()).status_code, 400)
+
+        # the completed challenge does not spend another code
+        self.assertEqual(self.verify(recovery_codes[1], challenge).status_code, 400)
+        self.assertTrue(MFARecoveryCode.is_unused(self.user, recovery_codes[1]))
+
+
+class BulkUserActionTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(email="admin@sales.example.com", password="Str0ng-passw0rd")
+        cls.users = [
+            User.objects.create_user(
+                email=f"user{n}@sales.example.com",
+                password="Str0ng-passw0rd",
+                is_active=True,
+                is_email_verified=n != 2,
+                has_temp_password=False,
+            )
+            for n in range(3)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self.enterContext(mock.patch.object(audit, "_buffer", audit.AuditBuffer(audit.DatabaseSink(), background=False)))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AuthStateRefreshToken.for_user(self.admin).access_token}")
+
+    def run_action(self, action, **selection):
+        # versions are forgotten once the changes commit
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("admin-users-bulk"),
+                {"action": action, "email_domain": "sales.example.com", **selection},
+                format="json",
+            )
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def states(self, *fields):
+        return list(User.objects.filter(pk__in=[user.pk for user in self.users]).order_by("pk").values_list(*fields))
+
+    def test_deactivate_and_activate_invalidate_tokens(self):
+        old = APIClient(HTTP_AUTHORIZATION=f"Bearer {AuthStateRefreshToken.for_user(self.users[0]).access_token}")
+        self.assertEqual(old.get(reverse("me")).status_code, 200)
+
+        self.assertEqual(self.run_action("deactivate"), {"action": "deactivate", "updated": 3, "emails_sent": 0, "emails_failed": []})
+        self.assertEqual(self.states("is_active", "auth_state_version"), [(False, 1)] * 3)
+        self.assertTrue(User.objects.get(pk=self.admin.pk).is_active)
+        self.assertEqual(old.get(reverse("me")).data["code"], "state_changed")
+
+        self.assertEqual(self.run_action("activate")["updated"], 3)
+        self.assertEqual(self.states("is_active", "auth_state_version"), [(True, 2)] * 3)
+
+    def test_force_reverification(self):
+        result = self.run_action("force_reverification", ids=[self.users[0].pk, self.users[1].pk])
+        self.assertEqual((result["updated"], result["emails_sent"]), (2, 2))
+        self.assertEqual(self.states("is_email_verified", "auth_state_version")[:2], [(False, 1)] * 2)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ["user0@sales.example.com", "user1@sales.example.com"])
+        self.assertEqual(EmailVerificationToken.objects.filter(user__in=self.users[:2], is_used=False).count(), 2)
+
+    def test_resend_verification_skips_verified_users(self):
+        result = self.run_action("resend_verification")
+        self.assertEqual((result["updated"], result["emails_sent"]), (1, 1))
+        self.assertEqual([message.to for message in mail.outbox], [["user2@sales.example.com"]])
+        self.assertEqual(self.states("auth_state_version"), [(0,)] * 3)
+
+    def test_reset_temp_password_reports_failed_emails(self):
+        send = EmailService.send_temp_password_email
+        refused = self.users[1]
+
+        def flaky(user, *args, **kwargs):
+            if user.pk == refused.pk:
+                raise OSError("mailbox unavailable")
+            return send(user, *args, **kwargs)
+
+        with mock.patch.object(EmailService, "send_temp_password_email", side_effect=flaky), \
+                self.assertLogs("authentication.services.bulk_users", "ERROR"):
+            result = self.run_action("reset_temp_password")
+        self.assertEqual(result["updated"], 3)
+        self.assertEqual(result["emails_sent"], 2)
+        self.assertEqual(result["emails_failed"], [refused.pk])
+        self.assertEqual(len(mail.outbox), 2)
+        # saved for everyone, also the user whose email failed
+        self.assertEqual(self.states("has_temp_password", "auth_state_version"), [(True, 1)] * 3)
+        self.assertFalse(any(user.has_usable_password() for user in User.objects.filter(pk__in=[u.pk for u in self.users])))
+        self.assertEqual(TempPasswordManager.objects.filter(user__in=self.users).count(), 3)
+
+        # no connection at all: every email of the batch is reported
+        with mock.patch.object(EmailService, "open_batch", side_effect=ConnectionRefusedError), \
+                self.assertLogs("authentication.services.bulk_users", "ERROR"):
+            result = self.run_action("reset_temp_password", ids=[refused.pk])
+        self.assertEqual((result["emails_sent"], result["emails_failed"]), (0, [refused.pk]))
+
+
+@override_settings(USER_SHARDS=["default", "shard_1"])
+class ShardingTests(TestCase):
+    databases = {"default", "shard_1"}
+
+    def setUp(self):
+        cache.clear()
+        self.enterContext(mock.patch.object(audit, "_buffer", audit.AuditBuffer(audit.DatabaseSink(), background=False)))
+        sharding.reserve_id_range(using="shard_1")
+
+    def email_on(self, alias, name="user"):
+        return next(
+            email for email in (f"{name}{n}@example.com" for n in itertools.count())
+            if sharding.shard_for_email(email) == alias
+        )
+
+    def create(self, email):
+        return User.objects.create_user(email=email, password="Str0ng-passw0rd", is_active=True)
+
+    def test_user_and_owned_rows_live_on_its_shard(self):
+        user = self.create(self.email_on("shard_1"))
+        self.assertEqual(user._state.db, "shard_1")
+        self.assertEqual(user.pk >> sharding.SHARD_ID_SHIFT, 1)
+        self.assertEqual(sharding.shard_for_user_id(user.pk), "shard_1")
+        self.assertFalse(User.objects.using("default").filter(email=user.email).exists())
+
+        # the profile, from post_save, and rows created through querysets follow the user
+        token = PasswordResetToken.objects.create(user=user, expires_at=timezone.now() + timedelta(hours=1))
+        self.assertEqual(token._state.db, "shard_1")
+        self.assertTrue(UserProfile.objects.using("shard_1").filter(user_id=user.pk).exists())
+        self.assertEqual(User.objects.filter(pk=user.pk).db, "shard_1")
+        self.assertEqual(User.objects.by_email(user.email.upper()).get(), user)
+
+    def test_first_on_any_shard_finds_moved_emails(self):
+        user = self.create(self.email_on("shard_1"))
+        user.email = self.email_on("default", "moved")
+        user.save()
+        self.assertIsNone(User.objects.by_email(user.email).first())
+        self.assertEqual(User.objects.by_email(user.email).first_on_any_shard(), user)
+        self.assertIsNone(User.objects.by_email("nobody@example.com").first_on_any_shard())
+
+    def test_email_is_unique_across_shards(self):
+        user = self.create(self.email_on("shard_1"))
+        taken = self.email_on("default", "taken")
+        user.email = taken.upper()
+        user.save(update_fields=["email"])
+
+        # the new user would go to `default`, where no row has the email
+        with self.assertRaises(IntegrityError):
+            self.create(taken)
+        self.assertFalse(User.objects.using("default").filter(email=taken).exists())
+
+        # the old email is free again, and the one just taken is not
+        user.email = self.email_on("shard_1", "other")
+        user.save()
+        self.create(taken)
+        user.email = taken
+        with self.assertRaises(IntegrityError):
+            user.save()
+
+    def test_claims_of_failed_saves_are_taken_over(self):
+        email = self.email_on("default")
+        sharding.claim_email(email)
+        with self.assertRaises(IntegrityError):
+            self.create(email)
+
+        EmailClaim.objects.filter(email=email).update(created_at=timezone.now() - sharding.CLAIM_GRACE)
+        self.assertEqual(self.create(email).email, email)
+
+        # users from before claims were kept are still found
+        legacy = self.email_on("shard_1", "legacy")
+        self.create(legacy)
+        EmailClaim.objects.filter(email=legacy).delete()
+        with self.assertRaises(IntegrityError):
+            sharding.claim_email(legacy)
+        self.assertFalse(EmailClaim.objects.filter(email=legacy).exists())
+
+    def test_bulk_actions_reach_every_shard(self):
+        admin = User.objects.create_superuser(email=self.email_on("default", "admin"), password="Str0ng-passw0rd")
+        users = [self.create(self.email_on(alias)) for alias in ("default", "shard_1")]
+        tokens = [trusted_devices.issue(user, RequestFactory().post("/")) for user in users]
+        client = APIClient(HTTP_AUTHORIZATION=f"Bearer {AuthStateRefreshToken.for_user(admin).access_token}")
+
+        with self.captureOnCommitCallbacks(execute=True, using="shard_1"):
+            response = client.post(
+                reverse("admin-users-bulk"),
+                {"action": "deactivate", "email_domain": "example.com"},
+                format="json",
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["updated"], 2)
+        for alias, user, token in zip(("default", "shard_1"), users, tokens):
+            user.refresh_from_db()
+            self.assertEqual((user._state.db, user.is_active, user.auth_state_version), (alias, False, 1))
+            self.assertFalse(trusted_devices.is_trusted(user, token))
+
+
+class TrustedDeviceTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="device@example.com",
+            password="Str0ng-passw0rd",
+            is_active=True,
+            is_email_verified=True,
+            has_temp_password=False,
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.enterContext(mock.patch.object(audit, "_buffer", audit.AuditBuffer(audit.DatabaseSink(), background=False)))
+        self.user.refresh_from_db()
+
+    def enable_totp(self):
+        client = APIClient(HTTP_AUTHORIZATION=f"Bearer {AuthStateRefreshToken.for_user(self.user).access_token}")
+        secret = client.post(reverse("mfa-totp-enroll")).data["secret"]
+        self.assertEqual(client.post(reverse("mfa-totp-confirm"), {"code": totp.code_at(secret, totp.current_step())}).status_code, 200)
+        return client, secret
+
+    def login(self, **data):
+        return APIClient().post(
+            reverse("login"), {"email": self.user.email, "password": "Str0ng-passw0rd", **data}, format="json"
+        )
+
+    def trust(self):
+        token = trusted_devices.issue(self.user, RequestFactory().post("/"))
+        self.assertTrue(trusted_devices.is_trusted(self.user, token))
+        return token
+
+    def test_trusted_device_skips_mfa(self):
+        _, secret = self.enable_totp()
+        challenge = self.login().data["mfa_challenge"]
+        response = APIClient().post(
+            reverse("login-verify-mfa"),
+            {
+                "email": self.user.email,
+                "code": totp.code_at(secret, totp.current_step() - 1),
+                "mfa_challenge": challenge,
+                "trust_device": True,
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+
+        # the token from the body, as a client without cookies sends it back
+        self.assertTrue(self.login().data["mfa_required"])
+        response = self.login(device_token=response.data["device_token"])
+        self.assertFalse(response.data["mfa_required"])
+        self.assertEqual(self.login(device_token=["not", "a", "string"]).status_code, 400)
+
+    def test_new_password_revokes_devices(self):
+        token = self.trust()
+        self.user.first_name = "Ada"
+        self.user.save()
+        self.assertTrue(trusted_devices.is_trusted(self.user, token))
+
+        self.user.set_password("An0ther-passw0rd")
+        self.user.save()
+        self.assertFalse(trusted_devices.is_trusted(self.user, token))
+
+    def test_deactivation_revokes_devices(self):
+        token = self.trust()
+        self.user.is_active = False
+        self.user.save(update_fields=["is_active"])
+        self.assertFalse(trusted_devices.is_trusted(self.user, token))
+
+        # a device trusted again after reactivation stays trusted
+        self.user.is_active = True
+        self.user.save(update_fields=["is_active"])
+        self.assertTrue(trusted_devices.is_trusted(self.user, self.trust()))
+
+    def test_bulk_deactivation_and_reset_revoke_devices(self):
+        token = self.trust()
+        bulk_users.deactivate(User.objects.filter(pk=self.user.pk))
+        self.assertFalse(trusted_devices.is_trusted(self.user, token))
+
+        token = self.trust()
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk_users.reset_temp_password(User.objects.filter(pk=self.user.pk))
+        self.assertFalse(trusted_devices.is_trusted(self.user, token))
+
+    def test_disabling_the_app_revokes_devices(self):
+        client, secret = self.enable_totp()
+        token = self.trust()
+        response = client.post(reverse("mfa-totp-disable"), {"code": totp.code_at(secret, totp.current_step() - 1)})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(trusted_devices.is_trusted(self.user, token))
+
+    def test_list_and_revoke(self):
+        client = APIClient(HTTP_AUTHORIZATION=f"Bearer {AuthStateRefreshToken.for_user(self.user).access_token}")
+        first, second = self.trust(), self.trust()
+        devices = client.get(reverse("trusted-devices-list")).data
+        self.assertEqual(len(devices), 2)
+
+        self.assertEqual(client.delete(reverse("trusted-devices-detail", args=[devices[0]["id"]])).status_code, 204)
+        self.assertEqual(len(client.get(reverse("trusted-devices-list")).data), 1)
+        client.post(reverse("trusted-devices-revoke-all"))
+        self.assertFalse(trusted_devices.is_trusted(self.user, first) or trusted_devices.is_trusted(self.user, second))
+
+
+class SchemaViewTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        for fmt, (filename, _) in schema.FORMATS.items():
+            (directory / filename).write_bytes(b"openapi: 3.0.3 # " + fmt.encode() * 100)
+        self.enterContext(override_settings(OPENAPI_SCHEMA_DIR=directory))
+        schema.reset()
+        self.addCleanup(schema.reset)
+
+    def get(self, **headers):
+        return schema.CachedSchemaView.as_view()(RequestFactory().get("/api/schema/", headers=headers))
+
+    def test_gzip_and_identity_bodies_have_their_own_etags(self):
+        plain = self.get()
+        gzipped = self.get(accept_encoding="br, gzip")
+        self.assertEqual(gzipped["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Encoding", plain)
+        self.assertNotEqual(plain["ETag"], gzipped["ETag"])
+        self.assertIn("Accept-Encoding", plain["Vary"])
+
+        self.assertEqual(self.get(if_none_match=plain["ETag"]).status_code, 304)
+        self.assertEqual(self.get(if_none_match=plain["ETag"], accept_encoding="gzip").status_code, 200)
+        self.assertEqual(self.get(if_none_match=f'"other", W/{gzipped["ETag"]}', accept_encoding="gzip").status_code, 304)
+
+    def test_accept_encoding_q_values(self):
+        self.assertFalse(schema.accepts_gzip("gzip;q=0, identity"))
+        self.assertFalse(schema.accepts_gzip("*;q=0.5, gzip;q=0"))
+        self.assertFalse(schema.accepts_gzip("gzipped"))
+        self.assertTrue(schema.accepts_gzip("*"))
+        self.assertTrue(schema.accepts_gzip("identity, GZIP;q=0.5"))
+        self.assertNotIn("Content-Encoding", self.get(accept_encoding="gzip;q=0"))
+
+
+class WarmupTests(SimpleTestCase):
+
+    def test_views_do_not_import_pillow(self):
+        code = (
+            "import sys, django; django.setup(); import authentication.urls; "
+            "sys.exit('PIL' in sys.modules)"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, "DJANGO_SETTINGS_MODULE": "core.settings"},
+            capture_output=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
+
+    def test_steps_are_timed_and_failures_logged(self):
+        steps = (("broken", mock.Mock(side_effect=RuntimeError)), ("urls", warmup._resolve_urls))
+        with mock.patch.object(warmup, "STEPS", steps), self.assertLogs("core.warmup", "ERROR"):
+            timings = warmup.warmup(skip=("schema",))
+        self.assertEqual(set(timings), {"broken", "urls"})
+
+    def test_only_persistent_connections_are_opened(self):
+        persistent, closing = mock.Mock(settings_dict={"CONN_MAX_AGE": 60}), mock.Mock(settings_dict={"CONN_MAX_AGE": 0})
+        connections = {"default": persistent, "shard_1": closing}
+        with mock.patch("django.db.connections", connections):
+            warmup._connect_databases()
+        persistent.ensure_connection.assert_called_once()
+        closing.ensure_connection.assert_not_called()
+
+
+class AuditBufferTests(SimpleTestCase):
+
+    def test_buffer_is_bounded(self):
+        written = []
+        sink = mock.Mock(write=written.extend)
+        buffer = audit.AuditBuffer(sink, capacity=3, background=False)
+        for n in range(5):
+            buffer.push({"n": n})
+
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.dropped, 2)
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual([event["n"] for event in written], [2, 3, 4])
+
+
+class LoginFailureAuditTests(TestCase):
+
+    def setUp(self):
+        self.buffer = self.enterContext(
+            mock.patch.object(audit, "_buffer", audit.AuditBuffer(audit.DatabaseSink(), background=False))
+        )
+
+    def events(self):
+        self.buffer.flush()
+        return list(AuditEvent.objects.order_by("pk").values_list("event", "email"))
+
+    def test_failures_record_the_submitted_email(self):
+        self.client.post(reverse("login"), {"email": "nobody@example.com", "password": "wrong-password"})
+        self.client.post(reverse("login-verify-mfa"), {"email": "nobody@example.com", "code": "12345678"})
+        self.assertEqual(
+            self.events(),
+            [(AuditEvent.LOGIN_FAILED, "nobody@example.com"), (AuditEvent.MFA_FAILED, "nobody@example.com")],
+        )
+
+    def test_body_that_is_not_an_object_is_a_bad_request(self):
+        for name in ("login", "login-verify-mfa"):
+            response = self.client.post(reverse(name), ["nobody@example.com"], content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.events(), [(AuditEvent.LOGIN_FAILED, ""), (AuditEvent.MFA_FAILED, "")])
+
+
+class AdmissionControlTests(SimpleTestCase):
+
+    def test_limiter_queue_and_deadline(self):
+        limiter = Limiter("test", limit=1, queue=1, timeout=0.01)
+        self.assertTrue(limiter.acquire())
+        # one waiter times out, the queue is then free again
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.shed, 1)
+
+    @override_settings(ADMISSION_CLASSES={
+        "password_hashing": {"URL_NAMES": ["login"], "LIMIT": 0, "QUEUE": 0},
+    })
+    def test_sheds_with_retry_after(self):
+        middleware = AdmissionControlMiddleware(lambda request: HttpResponse())
+        factory = RequestFactory()
+
+        response = middleware(factory.post(reverse("login")))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+        # reads and other endpoints are not classified
+        self.assertEqual(middleware(factory.get(reverse("me"))).status_code, 200)
+
+
+class ProfilingMiddlewareTests(SimpleTestCase):
+
+    def test_off_by_default(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ProfilingMiddleware(lambda request: HttpResponse())
+
+    def test_profiles_listed_endpoints_and_rotates(self):
+        directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        factory = RequestFactory()
+        with override_settings(PROFILE_URL_NAMES=["me"], PROFILE_DIR=directory, PROFILE_MAX_FILES=2):
+            middleware = ProfilingMiddleware(lambda request: HttpResponse())
+            for _ in range(3):
+                middleware(factory.get(reverse("me")))
+                time.sleep(0.002)
+            middleware(factory.get(reverse("login")))
+
+        files = sorted(path.name for path in directory.iterdir())
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(name.startswith("me__") and name.endswith(".prof") for name in files))
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_render_text_format(self):
+        registry = Registry()
+        emails = Counter("emails_total", "Emails.", ("template", "outcome"), registry=registry)
+        latency = Histogram("latency_seconds", "Latency.", ("view",), buckets=(0.1, 1), registry=registry)
+        emails.inc(template="welcome", outcome="sent")
+        emails.inc(2, template="welcome", outcome="sent")
+        latency.observe(0.05, view="login")
+        latency.observe(0.5, view="login")
+
+        text = registry.render()
+        self.assertIn("# TYPE emails_total counter", text)
+        self.assertIn('emails_total{template="welcome",outcome="sent"} 3.0', text)
+        self.assertIn('latency_seconds_bucket{view="login",le="0.1"} 1.0', text)
+        self.assertIn('latency_seconds_bucket{view="login",le="1.0"} 2.0', text)
+        self.assertIn('latency_seconds_bucket{view="login",le="+Inf"} 2.0', text)
+        self.assertIn('latency_seconds_count{view="login"} 2.0', text)
+
+    def test_file_backed_values_are_summed_across_processes(self):
+        directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        other = MmapValues(directory / "1.db")
+        other.add([('["logins_total","",[]]', 2)])
+        with override_settings(METRICS_DIR=directory):
+            registry = Registry()
+            logins = Counter("logins_total", "Logins.", registry=registry)
+            logins.inc()
+            spread = Counter("spread_total", "Many series.", ("n",), registry=registry)
+            for n in range(2000):  # grows the file past its first mapping
+                spread.inc(n=n)
+            text = registry.render()
+        self.assertIn("logins_total 3.0", text)
+        self.assertIn('spread_total{n="1999"} 1.0', text)
+
+    def test_endpoint_is_closed_until_a_token_is_set(self):
+        request = RequestFactory().get("/api/metrics/", HTTP_AUTHORIZATION="Bearer scraper-secret")
+        self.assertEqual(metrics_view(request).status_code, 403)
+        with override_settings(METRICS_TOKEN="scraper-secret"):
+            self.assertEqual(metrics_view(request).status_code, 200)
+            self.assertEqual(metrics_view(RequestFactory().get("/api/metrics/")).status_code, 401)
+
+
+class SecretsTests(SimpleTestCase):
+
+    def test_hmac_template_matches_hmac(self):
+        block = hashlib.sha256().block_size
+        # empty, short, exactly one block and longer than a block (hashed first)
+        for key in (b"", b"secret", b"k" * block, os.urandom(block + 1), os.urandom(200)):
+            template = HmacTemplate(key)
+            for message in (b"", b"user@example.com:ABCD1234", os.urandom(1000)):
+                self.assertEqual(template.hexdigest(message), hmac.new(key, message, hashlib.sha256).hexdigest())
+
+    def test_random_strings_use_the_alphabet(self):
+        for alphabet in (MFA_ALPHABET, TEMP_PASSWORD_ALPHABET, "abc"):
+            strings = random_strings(alphabet, 12, 50)
+            self.assertEqual(len(strings), 50)
+            self.assertTrue(all(len(text) == 12 and set(text) <= set(alphabet) for text in strings))
+        self.assertEqual(random_strings(MFA_ALPHABET, 8, 0), [])
+
+    def test_random_strings_reject_the_uneven_tail(self):
+        class EveryByte:
+            def take(self, n):
+                return (bytes(range(256)) * (n // 256 + 1))[:n]
+
+        # 255 is past the last whole multiple of 3 and dropped; 0..254 split evenly
+        text = random_strings("abc", 255, 1, pool=EveryByte())[0]
+        self.assertEqual({char: text.count(char) for char in "abc"}, {"a": 85, "b": 85, "c": 85})
+
+
+class FastJSONTests(SimpleTestCase):
+
+    def render(self, data):
+        return fastjson.ORJSONRenderer().render(data), JSONRenderer().render(data)
+
+    def parse(self, body):
+        return (
+            fastjson.ORJSONParser().parse(io.BytesIO(body), "application/json", {}),
+            JSONParser().parse(io.BytesIO(body), "application/json", {}),
+        )
+
+    def test_same_bytes_as_drf(self):
+        now = timezone.now()
+        data = {
+            "aware": now,
+            "naive": datetime.datetime(2026, 1, 2, 3, 4, 5, 6),
+            "date": now.date(),
+            "time": datetime.time(12, 30),
+            "duration": timedelta(hours=1, microseconds=5),
+            "uuid": uuid.uuid4(),
+            "decimal": decimal.Decimal("12.50"),
+            "unicode": "Zoë 東京 🔐",
+            "separators": "line\u2028paragraph\u2029",
+            "escapes": "quote \" backslash \\ tab \t nul \x00",
+            "numbers": [0, -1, 2 ** 63 - 1, 0.1, 1234.5, True, None],
+            "int keys": {1: "one", 2: "two"},
+            "nested": [[], {}, [{"a": ()}]],
+            "users": [{"email": "a@example.com", "id": n} for n in range(3)],
+        }
+        fast, stock = self.render(data)
+        self.assertEqual(fast, stock)
+        self.assertEqual(*self.parse(stock))
+
+        # past 64 bits the stdlib encoder takes over
+        self.assertEqual(*self.render({"big": 2 ** 64}))
+
+    def test_exponent_floats_differ_only_in_spelling(self):
+        fast, stock = self.render([1e16, 1.5e-7])
+        self.assertEqual((fast, stock), (b"[1e16,1.5e-7]", b"[1e+16,1.5e-07]"))
+        self.assertEqual(self.parse(fast), self.parse(stock))
+
+
+
+class EmailFilterTests(TestCase):
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = email_filter.BloomFilter(20000, 0.01)
+        for n in range(20000):
+            bloom.add(f"user-{n}@example.com")
+        self.assertTrue(all(f"user-{n}@example.com" in bloom for n in range(20000)))
+        false_positives = sum(f"nobody-{n}@example.com" in bloom for n in range(20000))
+        self.assertLess(false_positives / 20000, 0.02)
+
+    def test_bloom_filter_counts_repeats_once(self):
+        bloom = email_filter.BloomFilter(100, 0.01)
+        self.assertTrue(bloom.add("a@example.com"))
+        self.assertFalse(bloom.add("a@example.com"))
+        bloom.add("b@example.com")
+        self.assertEqual(bloom.count, 2)
+
+    def test_only_saves_that_write_the_email_are_remembered(self):
+        user = User.objects.create_user(email="saved@example.com", password="Str0ng-passw0rd")
+        with mock.patch.object(email_filter, "remember") as remember:
+            user.last_login = timezone.now()
+            user.save(update_fields=["last_login"])
+            remember.assert_not_called()
+            user.email = "renamed@example.com"
+            user.save(update_fields=["email"])
+            user.save()
+        self.assertEqual(remember.call_args_list, [mock.call("renamed@example.com")] * 2)
+
+    @override_settings(EMAIL_FILTER_ENABLED=True)
+    def test_unknown_email_skips_the_database(self):
+        built = email_filter.EmailFilter()
+        self.enterContext(mock.patch.object(audit, "_buffer", audit.AuditBuffer(audit.DatabaseSink(), background=False)))
+        self.enterContext(mock.patch.object(email_filter.EmailFilter, "start"))
+        self.enterContext(mock.patch.object(email_filter, "_filter", built))
+        built.rebuild()
+        url = reverse("password-reset-request")
+
+        response = self.client.post(url, {"email": "nobody@example.com"})
+        self.assertEqual(response.status_code, 200)
+        # cache table included: a miss reads no backend at all
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertIsNone(email_filter.find_user("nobody@example.com"))
+        self.assertEqual(ctx.captured_queries, [])
+
+        # saved after the build: added by the signal
+        user = User.objects.create_user(email="Late@Example.com", password="Str0ng-passw0rd")
+        self.assertEqual(email_filter.find_user("late@example.com"), user)
+
+    def test_other_processes_additions_are_read_in_the_background(self):
+        built = email_filter.EmailFilter()
+        built.rebuild()
+        other = email_filter.EmailFilter()
+        other.rebuild()
+        key = User.objects.email_key("Elsewhere@Example.com")
+        self.assertFalse(built.might_exist(key))
+
+        other.add(key)
+        other.publish(key)
+        self.assertFalse(built.might_exist(key))
+        self.assertEqual(built.refresh(), 1)
+        self.assertTrue(built.might_exist(key))
+        self.assertEqual(built.refresh(), 0)
+
+
+class PictureUploadTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="picture@example.com",
+            password="Str0ng-passw0rd",
+            is_active=True,
+            is_email_verified=True,
+            has_temp_password=False,
+        )
+
+    def setUp(self):
+        directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.enterContext(override_settings(
+            MEDIA_ROOT=directory / "media", PROFILE_PICTURE_UPLOAD_DIR=directory / "uploads",
+        ))
+        self.client = APIClient()
+        token = AuthStateRefreshToken.for_user(self.user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    @staticmethod
+    def png(width, height):
+        body = io.BytesIO()
+        Image.new("RGB", (width, height), "teal").save(body, "PNG")
+        return body.getvalue()
+
+    def send(self, upload_id, offset, data):
+        return self.client.generic(
+            "PATCH", reverse("picture-upload-chunk", args=[upload_id]), data,
+            content_type="application/offset+octet-stream", HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def test_resumed_upload_is_attached(self):
+        data = self.png(64, 48)
+        upload_id = self.client.post(reverse("picture-upload"), {"size": len(data)}).data["id"]
+
+        self.assertEqual(self.send(upload_id, 0, data[:100]).data["offset"], 100)
+        retry = self.send(upload_id, 0, data[:100])
+        self.assertEqual((retry.status_code, retry.data["offset"]), (409, 100))
+        response = self.send(upload_id, 100, data[100:])
+        self.assertTrue(response.data["complete"])
+
+        self.user.profile.refresh_from_db()
+        with self.user.profile.profile_picture.open() as picture:
+            self.assertEqual(picture.read(), data)
+        self.assertEqual(self.client.get(reverse("picture-upload-chunk", args=[upload_id])).status_code, 404)
+
+    def test_refused_from_the_header(self):
+        self.assertEqual(self.client.post(reverse("picture-upload"), {"size": 10 ** 9}).status_code, 413)
+
+        data = self.png(5000, 8)
+        upload_id = self.client.post(reverse("picture-upload"), {"size": len(data) + 10 ** 6}).data["id"]
+        self.assertEqual(self.send(upload_id, 0, data[:64]).status_code, 413)
+        self.assertEqual(self.client.get(reverse("picture-upload-chunk", args=[upload_id])).status_code, 404)
+
+        # not an image: refused once the header should have been in, not at the end of the chunk
+        garbage = io.BytesIO(bytes(4 * 1024 * 1024))
+        state = picture_uploads.start(self.user, len(garbage.getvalue()))
+        with self.assertRaises(picture_uploads.UploadRejected):
+            picture_uploads.append(self.user, state["id"], garbage, 0, len(garbage.getvalue()))
+        self.assertLessEqual(garbage.tell(), picture_uploads.HEADER_BYTES)
+
+    @override_settings(PROFILE_PICTURE_MAX_OPEN_UPLOADS=2)
+    def test_open_uploads_per_user_are_capped(self):
+        url = reverse("picture-upload")
+        first, _ = (self.client.post(url, {"size": 100}).data["id"] for _ in range(2))
+        self.assertEqual(self.client.post(url, {"size": 100}).status_code, 429)
+
+        # a cancelled upload frees its place
+        self.client.delete(reverse("picture-upload-chunk", args=[first]))
+        self.assertEqual(self.client.post(url, {"size": 100}).status_code, 201)
+        self.assertEqual(self.client.post(url, {"size": 100}).status_code, 429)
+
+    def test_prune_deletes_expired_part_files(self):
+        fresh = picture_uploads.start(self.user, 100)["id"]
+        stale = picture_uploads.start(self.user, 100)["id"]
+        old = time.time() - picture_uploads._expiry() - 1
+        os.utime(picture_uploads._part_path(stale), (old, old))
+
+        out = io.StringIO()
+        call_command("prune_picture_uploads", stdout=out)
+        self.assertIn("deleted 1 ", out.getvalue())
+        self.assertTrue(picture_uploads._part_path(fresh).exists())
+        self.assertFalse(picture_uploads._part_path(stale).exists())
+
+
+class MediaDeliveryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.enterContext(override_settings(MEDIA_ROOT=directory))
+        self.user = User.objects.create_user(email="media@example.com", password="Str0ng-passw0rd")
+        self.user.profile.profile_picture.save("me.png", ContentFile(bytes(range(256)) * 4))
+        self.name = self.user.profile.profile_picture.name
+        self.url = self.user.profile.profile_picture.url
+
+    def test_file_response_with_ranges_and_validators(self):
+        response = self.client.get(self.url)
+        self.assertEqual(b"".join(response.streaming_content), bytes(range(256)) * 4)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertIn("private", response["Cache-Control"])
+
+        partial = self.client.get(self.url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial["Content-Range"], "bytes 10-19/1024")
+        self.assertEqual(b"".join(partial.streaming_content), bytes(range(10, 20)))
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE="bytes=2000-").status_code, 416)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+    @override_settings(MEDIA_DELIVERY="x-accel-redirect")
+    def test_offloaded_to_the_proxy(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected-media/{self.name}")
+        self.assertEqual(response.content, b"")
+
+    def test_hidden_and_replaced_pictures_are_not_served(self):
+        old_url = self.url
+        self.user.profile.profile_picture.save("new.png", ContentFile(b"new"))
+        self.assertEqual(self.client.get(old_url).status_code, 404)
+        self.assertEqual(self.client.get(self.user.profile.profile_picture.url).status_code, 200)
+
+        self.user.profile.is_deleted = True
+        self.user.profile.save()
+        self.assertEqual(self.client.get(self.user.profile.profile_picture.url).status_code, 404)
+        self.assertEqual(self.client.get("/media/../settings.py").status_code, 404)
+
+    def test_pictures_follow_their_owner_not_the_slug(self):
+        old_slug = self.user.slug
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.user.slug = "renamed"
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+        # the old slug's new owner has no say over the files filed under it
+        other = User.objects.create_user(email="other@example.com", password="Str0ng-passw0rd", slug=old_slug)
+        other.profile.profile_picture.save("other.png", ContentFile(b"other"))
+        self.assertTrue(other.profile.profile_picture.name.startswith(f"{old_slug}/"))
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(self.client.get(other.profile.profile_picture.url).status_code, 200)
+
+        self.user.profile.is_deleted = True
+        self.user.profile.save()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(self.client.get(other.profile.profile_picture.url).status_code, 200)
+        self.assertEqual(self.client.get(f"/media/{old_slug}/nothing.png").status_code, 404)
+
+
+@override_settings(INTROSPECTION_TOKEN="gateway-secret")
+class TokenIntrospectionTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email="active@example.com",
+            password="Str0ng-passw0rd",
+            is_active=True,
+            is_email_verified=True,
+            has_temp_password=False,
+        )
+        cls.other = User.objects.create_user(email="other@example.com", password="Str0ng-passw0rd", is_active=True)
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse("token-introspect")
+        self.client = APIClient(HTTP_AUTHORIZATION="Bearer gateway-secret")
+
+    def introspect(self, tokens):
+        response = self.client.post(self.url, {"tokens": tokens}, format="json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()["results"]
+
+    def test_batch_resolves_each_user_once_and_is_cached(self):
+        token = str(AuthStateRefreshToken.for_user(self.user).access_token)
+        second = str(AuthStateRefreshToken.for_user(self.user).access_token)
+        other = str(AuthStateRefreshToken.for_user(self.other).access_token)
+        tokens = [token, "not-a-token", second, other, token]
+
+        with CaptureQueriesContext(connection) as ctx:
+            results = self.introspect(tokens)
+        self.assertEqual(len([q for q in ctx.captured_queries if "authentication_user" in q["sql"]]), 1)
+        self.assertEqual(results[1], {"active": False})
+        self.assertEqual(results[0], results[4])
+        self.assertEqual(
+            {key: results[0][key] for key in ("active", "user_id", "is_active", "is_email_verified", "has_temp_password")},
+            {"active": True, "user_id": self.user.pk, "is_active": True, "is_email_verified": True, "has_temp_password": False},
+        )
+        self.assertEqual(results[3]["user_id"], self.other.pk)
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.introspect(tokens), results)
+        # the cached answers and the users' auth-state versions, both from the cache
+        self.assertEqual(len(ctx.captured_queries), 2)
+        self.assertEqual(app_queries(ctx.captured_queries), [])
+
+        # a state change outdates the cached answers at once
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.introspect([token])[0], {"active": False})
+
+    def test_requires_the_introspection_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer wrong")
+        self.assertIn(self.client.post(self.url, {"tokens": ["x"]}, format="json").status_code, (401, 403))
+        with override_settings(INTROSPECTION_MAX_TOKENS=2):
+            self.client.credentials(HTTP_AUTHORIZATION="Bearer gateway-secret")
+            response = self.client.post(self.url, {"tokens": ["a", "b", "c"]}, format="json")
+        self.assertEqual(response.status_code, 400)
@@ -3,7 +3,10 @@ from rest_framework.routers import DefaultRouter
 
 from .views import (
     MeView,
+    PictureUploadView,
+    PictureUploadChunkView,
     AdminUsersView,
+    PublicUserDirectoryView,
     EmailVerificationView,
     ResendEmailVerificationView,
     RegisterUserView,
@@ -11,7 +14,13 @@ from .views import (
     PasswordResetConfirmView,
     ChangeTempPassword,
     LoginView,
+    TokenIntrospectionView,
     GetTheMFACode,
+    TOTPEnrollView,
+    TOTPConfirmView,
+    TOTPDisableView,
+    RecoveryCodesView,
+    TrustedDeviceView,
 )
 
 router = DefaultRouter()
@@ -20,15 +29,36 @@ router.register(
     AdminUsersView,
     basename="admin-users"
 )
+router.register(
+    r"users",
+    PublicUserDirectoryView,
+    basename="user-directory"
+)
+router.register(
+    r"devices",
+    TrustedDeviceView,
+    basename="trusted-devices"
+)
 
 urlpatterns = [
 
     path("login/", LoginView.as_view(), name="login"),
     path("login/verify-mfa/", GetTheMFACode.as_view(), name="login-verify-mfa"),
+    path("token/introspect/", TokenIntrospectionView.as_view(), name="token-introspect"),
     # ─────────────────────────────
     # User self
     # ─────────────────────────────
     path("me/", MeView.as_view(), name="me"),
+    path("me/picture/uploads/", PictureUploadView.as_view(), name="picture-upload"),
+    path("me/picture/uploads/<uuid:upload_id>/", PictureUploadChunkView.as_view(), name="picture-upload-chunk"),
+
+    # ─────────────────────────────
+    # Authenticator app MFA
+    # ─────────────────────────────
+    path("mfa/totp/enroll/", TOTPEnrollView.as_view(), name="mfa-totp-enroll"),
+    path("mfa/totp/confirm/", TOTPConfirmView.as_view(), name="mfa-totp-confirm"),
+    path("mfa/totp/disable/", TOTPDisableView.as_view(), name="mfa-totp-disable"),
+    path("mfa/recovery-codes/", RecoveryCodesView.as_view(), name="mfa-recovery-codes"),
 
     # ─────────────────────────────
     # Registration (admin only)
@@ -2,18 +2,31 @@
 from rest_framework.generics import RetrieveUpdateAPIView
 from rest_framework.permissions import IsAuthenticated , IsAdminUser , AllowAny
 from rest_framework.response import Response
-from rest_framework import viewsets 
+from rest_framework import mixins, viewsets 
+from rest_framework.decorators import action
 from rest_framework.views import APIView
 from rest_framework import status
-from .serializers import (profile,register,password_reset,login,password_reset)
-from .models import User , EmailVerificationToken , MultiFactorAuthCode , PasswordResetToken
+from .serializers import (profile,register,password_reset,login,password_reset,bulk,mfa,devices)
+from .models import User , EmailVerificationToken , MultiFactorAuthCode , PasswordResetToken , UserProfile , AuditEvent
+from django.core.files.storage import default_storage
+from django.http import Http404
 from django.utils import timezone
+from django.views.decorators.http import require_safe
 from datetime import timedelta
-from rest_framework.throttling import UserRateThrottle
+from rest_framework.throttling import ScopedRateThrottle, UserRateThrottle
 import uuid
-from rest_framework_simplejwt.tokens import RefreshToken
+from authentication.services.claims import AuthStateRefreshToken
 from authentication.services.email_service import EmailService
-from authentication.services.permissions import HasTemporaryPassword,IsActiveUser,IsEmailVerified,RequiresTempPassword
+from authentication.services import audit, introspection, metrics, one_time_tokens, picture_uploads, sharding, totp, trusted_devices, user_directory, user_search
+from authentication.services.pagination import KeysetPagination
+from core import media
+from authentication.services.permissions import HasIntrospectionToken,HasTemporaryPassword,IsActiveUser,IsEmailVerified,RequiresTempPassword
+
+def submitted_email(serializer):
+    """The email a rejected request was sent with, for the audit log; the body may not be an object."""
+    data = serializer.initial_data
+    return str(data.get("email", ""))[:254] if isinstance(data, dict) else ""
+
 
 class EmailResendThrottle(UserRateThrottle):
     rate = "3/hour"
@@ -28,6 +41,71 @@ class MeView(RetrieveUpdateAPIView):
         return self.request.user.profile
     
 
+"""
+resumable profile picture upload: POST the size, then PATCH raw bytes from
+the reported offset (Upload-Offset header) until complete
+"""
+class PictureUploadView(APIView):
+    permission_classes = [IsActiveUser,IsEmailVerified]
+
+    REJECTION_STATUS = {
+        picture_uploads.NOT_FOUND: status.HTTP_404_NOT_FOUND,
+        picture_uploads.BUSY: status.HTTP_409_CONFLICT,
+        picture_uploads.WRONG_OFFSET: status.HTTP_409_CONFLICT,
+        picture_uploads.TOO_LARGE: status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        picture_uploads.NOT_AN_IMAGE: status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        picture_uploads.TOO_MANY_PIXELS: status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        picture_uploads.TOO_MANY_UPLOADS: status.HTTP_429_TOO_MANY_REQUESTS,
+    }
+
+    def post(self, request, *args, **kwargs):
+        serializer = profile.PictureUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.respond(
+            lambda: picture_uploads.start(request.user, serializer.validated_data["size"]),
+            status.HTTP_201_CREATED,
+        )
+
+    def respond(self, operation, success_status=status.HTTP_200_OK):
+        try:
+            state = operation()
+        except picture_uploads.UploadRejected as rejected:
+            body = {"error": rejected.message}
+            if rejected.offset is not None:
+                body["offset"] = rejected.offset
+            return Response(body, status=self.REJECTION_STATUS[rejected.reason])
+
+        body = {key: state[key] for key in ("id", "offset", "size", "complete")}
+        if state["complete"]:
+            body["profile_picture"] = profile.build_absolute_media_url(
+                self.request, self.request.user.profile.profile_picture
+            )
+        return Response(body, status=success_status, headers={"Upload-Offset": str(state["offset"])})
+
+
+class PictureUploadChunkView(PictureUploadView):
+
+    def get(self, request, upload_id, *args, **kwargs):
+        return self.respond(lambda: picture_uploads.status(request.user, upload_id))
+
+    def patch(self, request, upload_id, *args, **kwargs):
+        try:
+            offset = int(request.headers["Upload-Offset"])
+            length = int(request.headers["Content-Length"]) if request.headers.get("Content-Length") else None
+        except (KeyError, ValueError):
+            return Response({"error": "Upload-Offset header required"}, status=status.HTTP_400_BAD_REQUEST)
+        # read straight from the request; request.data would buffer the body
+        return self.respond(lambda: picture_uploads.append(request.user, upload_id, request._request, offset, length))
+
+    def delete(self, request, upload_id, *args, **kwargs):
+        try:
+            picture_uploads.abort(request.user, upload_id)
+        except picture_uploads.UploadRejected as rejected:
+            return Response({"error": rejected.message}, status=self.REJECTION_STATUS[rejected.reason])
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+
 """
 this model is admin only model need the admin to access this route
 """
@@ -38,9 +116,92 @@ class AdminUsersView(viewsets.ModelViewSet):
     
     def get_queryset(self):
         return User.objects.all()
+
+    @action(detail=False, methods=["get"], url_path="search")
+    def search(self, request, *args, **kwargs):
+        """users matching every word of `q` as a prefix, best match first"""
+        params = profile.AdminUserSearchSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        page, page_size = params.validated_data["page"], params.validated_data["page_size"]
+
+        # one extra id tells whether there is a next page, without a count
+        ids = user_search.search(
+            params.validated_data["q"], offset=(page - 1) * page_size, limit=page_size + 1
+        )
+        has_next, ids = len(ids) > page_size, ids[:page_size]
+        users = {}
+        for alias in sharding.aliases():
+            on_shard = [pk for pk in ids if sharding.shard_for_user_id(pk) == alias]
+            if on_shard:
+                users.update(
+                    User.objects.using(alias).filter(pk__in=on_shard)
+                    .select_related("profile")
+                    .prefetch_related("groups", "user_permissions")
+                    .in_bulk()
+                )
+        ranked = [users[pk] for pk in ids if pk in users]
+        return Response({
+            "page": page,
+            "next": page + 1 if has_next else None,
+            "results": self.get_serializer(ranked, many=True).data,
+        })
+
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request, *args, **kwargs):
+        """apply one action to many users selected by ids, slugs or filters"""
+        serializer = bulk.BulkUserActionSerializer(data=request.data, context={"request": request})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        result = serializer.save()
+        return Response(
+            {"action": serializer.validated_data["action"], **result.as_dict()},
+            status=status.HTTP_200_OK
+        )
     
 
 
+"""
+public user cards for any signed-in user or service: by slug, many slugs at
+once, or every user page by page; deleted profiles are left out
+"""
+class PublicUserDirectoryView(mixins.ListModelMixin, viewsets.GenericViewSet):
+    serializer_class = profile.PublicUserSerializer
+    pagination_class = KeysetPagination
+    lookup_field = 'slug'
+
+    def get_queryset(self):
+        return user_directory.cards_queryset(User.objects.filter(profile__is_deleted=False))
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_queryset())
+        # warms the cache for the batch and slug lookups
+        cards = user_directory.store(page)
+        return self.get_paginated_response(
+            [user_directory.public(cards[user.slug], request) for user in page]
+        )
+
+    def retrieve(self, request, slug=None, *args, **kwargs):
+        card = user_directory.get_card(slug)
+        if card is None:
+            return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(user_directory.public(card, request))
+
+    @action(detail=False, methods=["get"], url_path="batch")
+    def batch(self, request, *args, **kwargs):
+        """cards for `?slugs=a,b,c` in the order asked, and the slugs not found"""
+        params = profile.PublicUserBatchSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        slugs = params.validated_data["slugs"]
+
+        cards = user_directory.get_cards(slugs)
+        return Response({
+            "results": [user_directory.public(cards[slug], request) for slug in dict.fromkeys(slugs) if slug in cards],
+            "missing": [slug for slug in dict.fromkeys(slugs) if slug not in cards],
+        })
+
+
+
 """
 this will handel the email verification
 """
@@ -49,22 +210,18 @@ class EmailVerificationView(APIView):
 
     def get(self, request, token, *args, **kwargs):
         
-        email_token = EmailVerificationToken.objects.filter(token=token).first()
-
-        if not email_token:
-            return Response(
-                {"error": "Invalid token"},
-                status=status.HTTP_400_BAD_REQUEST
+        try:
+            email_token = one_time_tokens.consume(
+                EmailVerificationToken.objects.filter(token=token),
+                then=lambda email_token: email_token.user.verify_email(),
             )
-
-        if not email_token.is_valid():
+        except one_time_tokens.TokenRejected as rejected:
             return Response(
-                {"error": "Token expired or already used"},
+                {"error": "Invalid token" if rejected.reason == one_time_tokens.INVALID else "Token expired or already used"},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        email_token.mark_as_used()
-        email_token.user.verify_email()
+        audit.record(AuditEvent.EMAIL_VERIFIED, user=email_token.user, request=request)
 
         return Response(
             {"message": "Email verified successfully"},
@@ -86,29 +243,26 @@ class ResendEmailVerificationView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        EmailVerificationToken.objects.filter(
-            user=user,
-            is_used=False,
-            expires_at__gt=timezone.now()
-        ).update(
-            is_used=True,
-            used_at=timezone.now()
-        )
-
-        token = EmailVerificationToken.objects.create(
-            user=user,
-            expires_at=timezone.now() + timedelta(hours=24),
+        # repeats inside the coalescing window reuse the live token and
+        # send nothing, the response stays the same
+        EmailService.request_verification(
+            user,
             request_ip=self.get_client_ip(request),
             device=request.META.get("HTTP_USER_AGENT", "")
         )
 
-        EmailService.send_verification_email(user, token)
-
         return Response(
             {"message": "Verification email resent successfully"},
             status=status.HTTP_200_OK
         )
 
+    @staticmethod
+    def get_client_ip(request):
+        forwarded_for = request.META.get("HTTP_X_FORWARDED_FOR")
+        if forwarded_for:
+            return forwarded_for.split(",")[0].strip()
+        return request.META.get("REMOTE_ADDR")
+
 
 """
 user registration view
@@ -152,6 +306,7 @@ class PasswordResetRequestView(APIView):
     def post(self,request,*args,**kwargs):
         password_reset_obj  = password_reset.PasswordResetRequestSerializer(data=request.data,context={"request": request})
         if password_reset_obj.is_valid():
+            audit.record(AuditEvent.PASSWORD_RESET_REQUESTED, request=request, email=password_reset_obj.validated_data["email"])
             return Response(
                 {"message":"Password Reset link send to your email please check the email for the instructions"},
                 status=status.HTTP_200_OK
@@ -169,7 +324,8 @@ class PasswordResetConfirmView(APIView):
     def post(self,request,*args,**kwargs):
         serializer = password_reset.PasswordResetConfirmSerializer(data=request.data,context={"request": request})
         if serializer.is_valid():
-            serializer.save()
+            user = serializer.save()
+            audit.record(AuditEvent.PASSWORD_RESET_COMPLETED, user=user, request=request)
             return Response(
                 {"message":"Password Reset successfully"},
                 status=status.HTTP_200_OK
@@ -201,6 +357,21 @@ class ChangeTempPassword(APIView):
 
 
 
+class TokenIntrospectionView(APIView):
+    """
+    state of a batch of access tokens for services that cannot verify them,
+    one answer per token in the order sent (authentication.services.introspection)
+    """
+    authentication_classes = []
+    permission_classes = [HasIntrospectionToken]
+
+    def post(self, request, *args, **kwargs):
+        serializer = login.TokenIntrospectionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response({"results": introspection.introspect(serializer.validated_data["tokens"])})
+
+
+
 """
 this is the login view now
 """
@@ -214,6 +385,7 @@ class LoginView(APIView):
         )
 
         if not serializer.is_valid():
+            audit.record(AuditEvent.LOGIN_FAILED, request=request, email=submitted_email(serializer))
             return Response({"message":"Invalid credentials","errors":serializer.errors},
                 status=status.HTTP_400_BAD_REQUEST
             )
@@ -223,12 +395,31 @@ class LoginView(APIView):
         # MFA REQUIRED → DO NOT ISSUE TOKENS
         if data["mfa_required"]:
             user = data["user"]
+            audit.record(AuditEvent.MFA_REQUIRED, user=user, request=request, method=data["mfa_method"])
+            metrics.MFA_CHALLENGES.inc(method=data["mfa_method"])
+
+            # authenticator app: nothing to write or send
+            if data["mfa_method"] == UserProfile.MFA_TOTP:
+                return Response(
+                    {
+                        "message": "MFA verification required",
+                        "mfa_required": True,
+                        "mfa_method": UserProfile.MFA_TOTP,
+                        "code_sent": False,
+                        "user_email":data['email'],
+                        # sent back with the code to login/verify-mfa/
+                        "mfa_challenge": totp.start_login(user.pk),
+                    },
+                    status=status.HTTP_200_OK
+                )
+
             mfa_obj, raw_code = MultiFactorAuthCode.create_code(user,request)
             EmailService.send_mfa_code_email(user, raw_code, request)
             return Response(
                 {
                     "message": "MFA verification required",
                     "mfa_required": True,
+                    "mfa_method": UserProfile.MFA_EMAIL,
                     "code_sent": True,
                     "user_email":data['email']
                 },
@@ -237,8 +428,9 @@ class LoginView(APIView):
 
         # NO MFA → ISSUE TOKENS
         user = data["user"]
+        audit.record(AuditEvent.LOGIN_SUCCEEDED, user=user, request=request)
 
-        refresh = RefreshToken.for_user(user)
+        refresh = AuthStateRefreshToken.for_user(user)
 
         return Response(
             {
@@ -256,6 +448,9 @@ class LoginView(APIView):
 
 class GetTheMFACode(APIView):
     permission_classes = [AllowAny]
+    # per client IP, on top of the per-challenge limit (totp.MAX_ATTEMPTS)
+    throttle_classes = [ScopedRateThrottle]
+    throttle_scope = "mfa_verify"
 
     def post(self, request, *args, **kwargs):
         serializer = login.GetTheMFACodeSerializer(
@@ -264,22 +459,107 @@ class GetTheMFACode(APIView):
         )
 
         if not serializer.is_valid():
+            audit.record(AuditEvent.MFA_FAILED, request=request, email=submitted_email(serializer))
+            metrics.MFA_VERIFICATIONS.inc(outcome="failed")
             return Response(
                 serializer.errors,
                 status=status.HTTP_400_BAD_REQUEST
             )
 
         data = serializer.validated_data
+        audit.record(AuditEvent.MFA_SUCCEEDED, user=data["user"], request=request, trusted_device=data["trust_device"])
+        metrics.MFA_VERIFICATIONS.inc(outcome="succeeded")
 
-        refresh = RefreshToken.for_user(data["user"])
+        refresh = AuthStateRefreshToken.for_user(data["user"])
+        payload = {
+            "message": "Login successfully",
+            "tokens": {
+                "access": str(refresh.access_token),
+                "refresh": str(refresh),
+            }
+        }
 
-        return Response(
-            {
-                "message": "Login successfully",
-                "tokens": {
-                    "access": str(refresh.access_token),
-                    "refresh": str(refresh),
-                }
-            },
-            status=status.HTTP_200_OK
-        )
+        # later logins from this device skip the MFA challenge
+        device_token = None
+        if data["trust_device"]:
+            device_token = trusted_devices.issue(data["user"], request)
+            payload["device_token"] = device_token
+
+        response = Response(payload, status=status.HTTP_200_OK)
+        if device_token:
+            trusted_devices.attach(response, device_token)
+        return response
+
+
+
+"""
+authenticator app (TOTP) management for the logged-in user
+"""
+class TOTPActionView(APIView):
+    permission_classes = [IsActiveUser,IsEmailVerified]
+    serializer_class = None
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data, context={"request": request})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(serializer.save(), status=status.HTTP_200_OK)
+
+
+class TOTPEnrollView(TOTPActionView):
+    """returns the secret and the otpauth:// URI to show as a QR code"""
+    serializer_class = mfa.TOTPEnrollSerializer
+
+
+class TOTPConfirmView(TOTPActionView):
+    """checks the first code from the app, enables TOTP and returns recovery codes"""
+    serializer_class = mfa.TOTPConfirmSerializer
+
+
+class TOTPDisableView(TOTPActionView):
+    """falls back to email codes"""
+    serializer_class = mfa.TOTPDisableSerializer
+
+
+class RecoveryCodesView(TOTPActionView):
+    """replaces the recovery codes"""
+    serializer_class = mfa.RecoveryCodesSerializer
+
+
+
+"""
+trusted devices of the logged-in user: list and revoke
+"""
+class TrustedDeviceView(mixins.ListModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    permission_classes = [IsActiveUser,IsEmailVerified]
+    serializer_class = devices.TrustedDeviceSerializer
+
+    def get_queryset(self):
+        return trusted_devices.active_devices(self.request.user)
+
+    def perform_destroy(self, instance):
+        instance.revoke()
+
+    @action(detail=False, methods=["post"], url_path="revoke-all")
+    def revoke_all(self, request, *args, **kwargs):
+        revoked = trusted_devices.revoke_all(request.user)
+        return Response({"revoked": revoked}, status=status.HTTP_200_OK)
+
+
+
+"""
+files under MEDIA_ROOT: the current picture of a visible profile, or the
+default picture; the bytes are sent by the front proxy (core.media)
+"""
+@require_safe
+def media_view(request, path):
+    default = UserProfile._meta.get_field("profile_picture").default
+    if path != default:
+        # by the stored name: the <slug>/ it is filed under is the slug at
+        # upload time, which may since have changed or gone to another user
+        owner = user_directory.picture_owner(path)
+        card = user_directory.get_card_by_id(owner) if owner is not None else None
+        if card is None or card["profile_picture"] != default_storage.url(path):
+            raise Http404("No such file")
+    return media.send_file(request, path)
@@ -0,0 +1,149 @@
+"""
+Admission control.
+
+Endpoints that hash passwords or send email are grouped into classes in
+ADMISSION_CLASSES. Each class runs at most LIMIT requests at once; up to
+QUEUE more wait, each for at most TIMEOUT_MS. Past that the request is shed
+with 503 and Retry-After instead of tying up a worker thread.
+
+All classes together may hold at most ADMISSION_CAPACITY - ADMISSION_RESERVED
+requests, running or waiting, so the reserved share of the worker's threads
+always stays free for everything else (`/me`, token refresh and other cheap
+reads). Limits are per process: size ADMISSION_CAPACITY to the worker's
+thread count.
+"""
+import functools
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+
+from core.metrics import Counter
+
+
+SHED = Counter(
+    "http_admission_rejections_total",
+    "Requests shed with 503 by admission control, by class.",
+    ("admission_class",),
+)
+
+
+class Limiter:
+    """Concurrency cap with a bounded wait queue and a per-request deadline."""
+
+    def __init__(self, name, limit, queue, timeout):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.shed = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue:
+                self.shed += 1
+                return False
+
+            deadline = time.monotonic() + self.timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed += 1
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class Budget:
+    """Non-blocking counter shared by all classes."""
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.used >= self.size:
+                self.shed += 1
+                return False
+            self.used += 1
+            return True
+
+    def give(self):
+        with self._lock:
+            self.used -= 1
+
+
+class AdmissionControlMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        capacity = getattr(settings, "ADMISSION_CAPACITY", 16)
+        reserved = getattr(settings, "ADMISSION_RESERVED", 4)
+        self.budget = Budget(max(capacity - reserved, 1))
+        self.limiters = {}
+        self.by_url_name = {}
+        for name, config in getattr(settings, "ADMISSION_CLASSES", {}).items():
+            limiter = Limiter(
+                name,
+                limit=config["LIMIT"],
+                queue=config.get("QUEUE", 0),
+                timeout=config.get("TIMEOUT_MS", 1000) / 1000,
+            )
+            self.limiters[name] = limiter
+            for url_name in config["URL_NAMES"]:
+                self.by_url_name[url_name] = limiter
+        self.classify = functools.lru_cache(maxsize=1024)(self._classify)
+
+    def _classify(self, path):
+        try:
+            return self.by_url_name.get(resolve(path).url_name)
+        except Resolver404:
+            return None
+
+    def __call__(self, request):
+        limiter = self.classify(request.path_info) if request.method not in ("GET", "HEAD", "OPTIONS") else None
+        if limiter is None:
+            return self.get_response(request)
+
+        if not self.budget.take():
+            return self.reject(limiter)
+        try:
+            if not limiter.acquire():
+                return self.reject(limiter)
+            try:
+                return self.get_response(request)
+            finally:
+                limiter.release()
+        finally:
+            self.budget.give()
+
+    def reject(self, limiter):
+        SHED.inc(admission_class=limiter.name)
+        response = JsonResponse(
+            {"detail": "The server is busy, please retry shortly."},
+            status=503,
+        )
+        response["Retry-After"] = str(max(math.ceil(limiter.timeout), 1))
+        return response
@@ -0,0 +1,78 @@
+"""
+orjson-backed JSON renderer and parser for DRF.
+
+The output is what rest_framework's JSONRenderer writes with the default
+UNICODE_JSON, COMPACT_JSON and STRICT_JSON settings: datetimes, Decimals,
+lazy strings and the other types DRF's encoder knows are handed to that
+encoder, and U+2028/U+2029 are escaped. Whatever orjson cannot do
+(indented output for the browsable API, integers past 64 bits, other JSON
+settings) goes through the stdlib path, as does everything when orjson is
+not installed. Two differences remain:
+
+- floats in exponent form are spelled without the sign and zero padding
+  Python adds (`1e16` and `1.5e-7` where DRF writes `1e+16` and
+  `1.5e-07`); they parse to the same numbers, but the bytes differ.
+- NaN and infinities render as null instead of raising.
+
+`manage.py bench_json` measures both and compares their output.
+"""
+import codecs
+import io
+
+from django.conf import settings
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    OPTIONS = (
+        orjson.OPT_NON_STR_KEYS
+        # formatted by DRF's encoder ("Z" for UTC), as JSONRenderer does
+        | orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+    )
+
+
+class ORJSONRenderer(JSONRenderer):
+
+    def __init__(self):
+        self._default = self.encoder_class().default
+        self._native = orjson is not None and self.compact and not self.ensure_ascii and self.strict
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None or not self._native:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(data, default=self._default, option=OPTIONS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        if b"\xe2\x80\xa8" in ret or b"\xe2\x80\xa9" in ret:
+            ret = ret.replace(b"\xe2\x80\xa8", b"\\u2028").replace(b"\xe2\x80\xa9", b"\\u2029")
+        return ret
+
+
+class ORJSONParser(JSONParser):
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get("encoding", settings.DEFAULT_CHARSET)
+        if orjson is None or not self.strict or codecs.lookup(encoding).name != "utf-8":
+            return super().parse(stream, media_type, parser_context)
+
+        body = stream.read()
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError:
+            # the stdlib's error message, and what only it accepts
+            # (integers past 64 bits, lone surrogate escapes)
+            return super().parse(io.BytesIO(body), media_type, parser_context)
@@ -0,0 +1,151 @@
+"""
+Delivery of files under MEDIA_ROOT.
+
+Views decide whether a file may be seen and then call `send_file()`, which
+answers conditional requests itself (ETag and Last-Modified from a stat of
+the file) and hands the transfer to the front proxy, so no worker ever
+reads the bytes. MEDIA_DELIVERY picks how:
+
+- "x-accel-redirect" (nginx): an `X-Accel-Redirect` to MEDIA_ACCEL_PREFIX +
+  the file's path, which must be an internal location over MEDIA_ROOT:
+
+      location /protected-media/ {
+          internal;
+          alias /srv/app/media/;
+      }
+
+- "x-sendfile" (Apache mod_xsendfile, lighttpd): an `X-Sendfile` header with
+  the absolute path.
+- "django", for local runs and tests: a FileResponse, which the WSGI
+  server sends with os.sendfile when it offers `wsgi.file_wrapper`
+  (gunicorn, uWSGI; not runserver). A single byte range is answered with
+  206 by reading just that range.
+
+The proxy answers ranges and revalidation for the offloaded modes; every
+mode sends `Accept-Ranges`, `Cache-Control` (MEDIA_CACHE_MAX_AGE) and the
+validators.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+
+X_ACCEL_REDIRECT = "x-accel-redirect"
+X_SENDFILE = "x-sendfile"
+DJANGO = "django"
+
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _delivery():
+    return getattr(settings, "MEDIA_DELIVERY", DJANGO)
+
+
+def parse_range(header, size):
+    """(start, end) of a single byte range, None to send everything, or ValueError if unsatisfiable."""
+    match = RANGE.match(header.strip()) if header else None
+    if match is None:
+        # absent, several ranges or another unit: the whole file is a valid answer
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+class _RangeFile:
+    """Reads `length` bytes from where `file` is; no fileno(), so it is never sent with sendfile."""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def send_file(request, name):
+    """Respond with the file `name` under MEDIA_ROOT, or raise Http404."""
+    try:
+        path = safe_join(settings.MEDIA_ROOT, name)
+        stat = os.stat(path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404("No such file")
+
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if not_modified is not None:
+        patch_cache_control(not_modified, private=True, max_age=_max_age())
+        return not_modified
+
+    content_type, encoding = mimetypes.guess_type(path)
+    content_type = content_type or "application/octet-stream"
+    delivery = _delivery()
+
+    if delivery == X_ACCEL_REDIRECT:
+        prefix = getattr(settings, "MEDIA_ACCEL_PREFIX", "/protected-media/")
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = prefix.rstrip("/") + "/" + quote(name)
+    elif delivery == X_SENDFILE:
+        response = HttpResponse(content_type=content_type)
+        response["X-Sendfile"] = path
+    else:
+        response = _file_response(request, path, stat.st_size, content_type, etag)
+
+    if encoding:
+        response["Content-Encoding"] = encoding
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(stat.st_mtime)
+    patch_cache_control(response, private=True, max_age=_max_age())
+    return response
+
+
+def _max_age():
+    return getattr(settings, "MEDIA_CACHE_MAX_AGE", 3600)
+
+
+def _file_response(request, path, size, content_type, etag):
+    range_header = request.headers.get("Range")
+    if request.headers.get("If-Range", etag) != etag:
+        # the client's copy is stale: send the whole file
+        range_header = None
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    file = open(path, "rb")
+    if byte_range is None:
+        return FileResponse(file, content_type=content_type)
+
+    start, end = byte_range
+    file.seek(start)
+    response = FileResponse(_RangeFile(file, end - start + 1), content_type=content_type, status=206)
+    response["Content-Length"] = str(end - start + 1)
+    response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return response
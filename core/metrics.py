@@ -0,0 +1,367 @@
+"""
+Prometheus metrics.
+
+Counters and histograms exposed in the Prometheus text format at
+`/api/metrics/`. An update is a dict lookup and a float add under a
+process-local lock that is never held across I/O.
+
+Without METRICS_DIR every process keeps its values in memory and a scrape
+only sees the worker that answered it. With several workers set METRICS_DIR:
+each process then keeps its values in a memory-mapped file `<pid>.db` in that
+directory (still without any cross-process locking, only the owner writes
+it) and a scrape sums the files of all processes, including workers that have
+since exited, so counters never go backwards. Empty the directory when the
+server starts, e.g. in the gunicorn config:
+
+    def on_starting(server):
+        from core import metrics
+        metrics.clear_directory()
+
+Scrapes send METRICS_TOKEN as `Authorization: Bearer <token>`; while it is
+unset the endpoint is closed.
+"""
+import bisect
+import contextlib
+import hmac
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+
+from core.profiling import endpoint_name
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+def metrics_dir():
+    directory = getattr(settings, "METRICS_DIR", None)
+    return Path(directory) if directory else None
+
+
+def clear_directory(directory=None):
+    directory = Path(directory) if directory else metrics_dir()
+    if directory is not None and directory.is_dir():
+        for path in directory.glob("*.db"):
+            path.unlink(missing_ok=True)
+
+
+class MemoryValues:
+
+    def __init__(self):
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add(self, pairs):
+        with self._lock:
+            for key, amount in pairs:
+                self._values[key] += amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class MmapValues:
+    """
+    Append-only slots of (key, float) in a memory-mapped file, written only
+    by the process that owns it.
+
+    Layout: an 8-byte count of bytes in use, then per slot a 4-byte key
+    length, the key padded to 8 bytes and an 8-byte double. A new slot is
+    written before the count covers it, so readers never see a partial one.
+    """
+    USED = struct.Struct("<Q")
+    KEY_LENGTH = struct.Struct("<I")
+    VALUE = struct.Struct("<d")
+    INITIAL_SIZE = 1 << 16
+
+    def __init__(self, path):
+        self._file = open(path, "a+b")
+        size = max(os.fstat(self._file.fileno()).st_size, self.INITIAL_SIZE)
+        self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self._used = self.USED.unpack_from(self._mmap)[0] or self.USED.size
+        self._positions = {key: position for key, position, _ in self._slots(self._mmap, self._used)}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _slots(cls, data, used):
+        position = cls.USED.size
+        while position < used:
+            length = cls.KEY_LENGTH.unpack_from(data, position)[0]
+            key_end = position + cls.KEY_LENGTH.size + length
+            value_position = key_end + (-key_end % 8)
+            key = bytes(data[position + cls.KEY_LENGTH.size:key_end]).decode()
+            yield key, value_position, cls.VALUE.unpack_from(data, value_position)[0]
+            position = value_position + cls.VALUE.size
+
+    @classmethod
+    def read(cls, path):
+        data = Path(path).read_bytes()
+        if len(data) < cls.USED.size:
+            return
+        for key, _, value in cls._slots(data, cls.USED.unpack_from(data)[0]):
+            yield key, value
+
+    def _allocate(self, key):
+        encoded = key.encode()
+        key_end = self._used + self.KEY_LENGTH.size + len(encoded)
+        value_position = key_end + (-key_end % 8)
+        end = value_position + self.VALUE.size
+        if end > len(self._mmap):
+            size = len(self._mmap)
+            while size < end:
+                size *= 2
+            self._mmap.close()
+            self._file.truncate(size)
+            self._mmap = mmap.mmap(self._file.fileno(), size)
+        self.KEY_LENGTH.pack_into(self._mmap, self._used, len(encoded))
+        self._mmap[self._used + self.KEY_LENGTH.size:key_end] = encoded
+        self.VALUE.pack_into(self._mmap, value_position, 0.0)
+        self._used = end
+        self.USED.pack_into(self._mmap, 0, end)
+        self._positions[key] = value_position
+        return value_position
+
+    def add(self, pairs):
+        with self._lock:
+            for key, amount in pairs:
+                position = self._positions.get(key)
+                if position is None:
+                    position = self._allocate(key)
+                self.VALUE.pack_into(self._mmap, position, self.VALUE.unpack_from(self._mmap, position)[0] + amount)
+
+    def items(self):
+        with self._lock:
+            return [(key, value) for key, _, value in self._slots(self._mmap, self._used)]
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self._store = None
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            # a forked worker counts into its own file, not its parent's
+            os.register_at_fork(after_in_child=self._forget_store)
+
+    def _forget_store(self):
+        self._store = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    @property
+    def store(self):
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    directory = metrics_dir()
+                    if directory is None:
+                        self._store = MemoryValues()
+                    else:
+                        directory.mkdir(parents=True, exist_ok=True)
+                        self._store = MmapValues(directory / f"{os.getpid()}.db")
+        return self._store
+
+    def collect(self):
+        """Every sample summed over all processes, as {key: value}."""
+        directory = metrics_dir()
+        if directory is None:
+            return dict(self.store.items())
+        totals = defaultdict(float)
+        for path in directory.glob("*.db"):
+            for key, value in MmapValues.read(path):
+                totals[key] += value
+        return totals
+
+    def render(self):
+        samples = defaultdict(list)
+        for key, value in self.collect().items():
+            name, suffix, labelvalues = json.loads(key)
+            samples[name].append((suffix, tuple(labelvalues), value))
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            lines += metric.render(samples.get(name, []))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        self._keys = {}
+        registry.register(self)
+
+    def _labelvalues(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _key(self, suffix, labelvalues):
+        return json.dumps([self.name, suffix, labelvalues], separators=(",", ":"))
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        labelvalues = self._labelvalues(labels)
+        key = self._keys.get(labelvalues)
+        if key is None:
+            key = self._keys.setdefault(labelvalues, self._key("", labelvalues))
+        self.registry.store.add(((key, amount),))
+
+    def render(self, samples):
+        if not samples and not self.labelnames:
+            return [f"{self.name} 0.0"]
+        return [
+            f"{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}"
+            for _, labelvalues, value in sorted(samples)
+        ]
+
+
+class Histogram(Metric):
+    """
+    Each observation adds 1 to a single bucket slot; buckets are made
+    cumulative when rendered.
+    """
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(name, documentation, labelnames, **kwargs)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets if bound != math.inf)) + (math.inf,)
+
+    def _keys_for(self, labelvalues):
+        keys = self._keys.get(labelvalues)
+        if keys is None:
+            keys = self._keys.setdefault(labelvalues, (
+                [self._key(f"_bucket:{index}", labelvalues) for index in range(len(self.buckets))],
+                self._key("_sum", labelvalues),
+                self._key("_count", labelvalues),
+            ))
+        return keys
+
+    def observe(self, value, **labels):
+        buckets, sum_key, count_key = self._keys_for(self._labelvalues(labels))
+        bucket = buckets[bisect.bisect_left(self.buckets, value)]
+        self.registry.store.add(((bucket, 1), (sum_key, value), (count_key, 1)))
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self, samples):
+        series = defaultdict(lambda: {"buckets": [0.0] * len(self.buckets), "_sum": 0.0, "_count": 0.0})
+        for suffix, labelvalues, value in samples:
+            if suffix.startswith("_bucket:"):
+                index = int(suffix.partition(":")[2])
+                if index < len(self.buckets):
+                    series[labelvalues]["buckets"][index] += value
+            else:
+                series[labelvalues][suffix] += value
+
+        lines = []
+        names = self.labelnames + ("le",)
+        for labelvalues, values in sorted(series.items()):
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, values["buckets"]):
+                cumulative += count
+                labels = format_labels(names, labelvalues + (format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {format_value(cumulative)}")
+            labels = format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {format_value(values['_sum'])}")
+            lines.append(f"{self.name}_count{labels} {format_value(values['_count'])}")
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time from the request entering the middleware stack to the response, by view.",
+    ("view", "method", "status"),
+)
+THROTTLED_REQUESTS = Counter(
+    "http_throttled_requests_total",
+    "Requests rejected with 429 by a DRF throttle, by view.",
+    ("view",),
+)
+METHODS = frozenset(("GET", "HEAD", "OPTIONS", "POST", "PUT", "PATCH", "DELETE"))
+
+
+class MetricsMiddleware:
+    """Times every request. Keep it near the top of MIDDLEWARE."""
+
+    def __init__(self, get_response):
+        if not getattr(settings, "METRICS_ENABLED", True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, "resolver_match", None)
+        # not resolved when a middleware answered first (admission control)
+        view = match.view_name if match is not None else endpoint_name(request.path_info)
+        REQUEST_DURATION.observe(
+            elapsed,
+            view=view,
+            method=request.method if request.method in METHODS else "other",
+            status=f"{response.status_code // 100}xx",
+        )
+        if response.status_code == 429:
+            THROTTLED_REQUESTS.inc(view=view)
+        return response
+
+
+def metrics_view(request):
+    # closed until METRICS_TOKEN is set, like token introspection
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if not token:
+        return HttpResponse(status=403)
+    scheme, _, credentials = request.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(credentials.encode(), token.encode()):
+        return HttpResponse(status=401, headers={"WWW-Authenticate": "Bearer"})
+    return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,208 @@
+"""
+Sampled request profiling.
+
+Off unless configured: with PROFILE_SAMPLE_RATE at 0, no PROFILE_URL_NAMES
+and no PROFILE_TRIGGER_TOKEN the middleware removes itself at start-up.
+Otherwise an unsampled request costs one random() call and a header lookup.
+
+A request is profiled when it falls in the sample, its URL name is listed
+in PROFILE_URL_NAMES, or it carries `X-Profile-Token: <PROFILE_TRIGGER_TOKEN>`.
+Output goes to PROFILE_DIR as `<url name>__<unix ms>_<pid>_<elapsed us>.<ext>`:
+
+- PROFILER = "cprofile": exact call counts and times, `.prof` (pstats).
+- PROFILER = "sampling": the request thread's stack is sampled every
+  PROFILE_SAMPLE_INTERVAL_MS from a helper thread and written as collapsed
+  stacks, `.folded`, ready for flamegraph.pl or speedscope. Much cheaper
+  than cProfile for slow requests.
+
+With PROFILE_TRACEMALLOC the top allocation sites go in a `.alloc.txt`
+file next to it. Only the newest PROFILE_MAX_FILES profiles are kept.
+`manage.py profile_report` aggregates them per endpoint.
+
+One request per process is profiled at a time; others that would have been
+sampled meanwhile run unprofiled.
+"""
+import cProfile
+import functools
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.urls import Resolver404, resolve
+
+
+logger = logging.getLogger(__name__)
+
+TRIGGER_HEADER = "HTTP_X_PROFILE_TOKEN"
+FILENAME = re.compile(
+    r"^(?P<endpoint>[\w-]+)__(?P<timestamp>\d+)_(?P<pid>\d+)_(?P<elapsed_us>\d+)\.(?P<kind>prof|folded)$"
+)
+
+
+def profile_dir():
+    return Path(getattr(settings, "PROFILE_DIR", settings.BASE_DIR / "profiles"))
+
+
+@functools.lru_cache(maxsize=1024)
+def endpoint_name(path):
+    try:
+        match = resolve(path)
+    except Resolver404:
+        return "unresolved"
+    return re.sub(r"[^\w-]", "-", match.view_name or match.url_name or "unnamed")
+
+
+def frame_label(code):
+    filename = code.co_filename
+    for marker in ("site-packages/", "lib/python"):
+        if marker in filename:
+            filename = filename.split(marker, 1)[1]
+            break
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ",")
+
+
+class CProfiler:
+    suffix = ".prof"
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def dump(self, path):
+        self._profile.dump_stats(path)
+
+
+class StackSampler:
+    """
+    Counts the collapsed stacks of the calling thread, sampled from a helper
+    thread. Frames above the caller (server, outer middleware) are left out.
+    """
+    suffix = ".folded"
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread_id = threading.get_ident()
+        self._skip = 0
+        frame = sys._getframe(1)
+        while frame is not None:
+            self._skip += 1
+            frame = frame.f_back
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            if len(stack) > self._skip:
+                self.stacks[";".join(frame_label(code) for code in stack[self._skip:])] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        path.write_text("".join(f"{stack} {count}\n" for stack, count in self.stacks.items()))
+
+
+class ProfilingMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, "PROFILE_SAMPLE_RATE", 0.0)
+        self.url_names = set(getattr(settings, "PROFILE_URL_NAMES", ()))
+        self.trigger_token = getattr(settings, "PROFILE_TRIGGER_TOKEN", None)
+        if not (self.sample_rate or self.url_names or self.trigger_token):
+            raise MiddlewareNotUsed
+        self.directory = profile_dir()
+        self.max_files = getattr(settings, "PROFILE_MAX_FILES", 500)
+        self.tracemalloc = getattr(settings, "PROFILE_TRACEMALLOC", False)
+        self.sampling = getattr(settings, "PROFILER", "cprofile") == "sampling"
+        self.interval = getattr(settings, "PROFILE_SAMPLE_INTERVAL_MS", 1) / 1000
+        self._busy = threading.Lock()
+
+    def wants_profile(self, request):
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        if self.trigger_token:
+            token = request.META.get(TRIGGER_HEADER)
+            if token and hmac.compare_digest(token, self.trigger_token):
+                return True
+        if self.url_names:
+            return endpoint_name(request.path_info) in self.url_names
+        return False
+
+    def __call__(self, request):
+        if not self.wants_profile(request) or not self._busy.acquire(blocking=False):
+            return self.get_response(request)
+        try:
+            return self.profile(request)
+        finally:
+            self._busy.release()
+
+    def profile(self, request):
+        profiler = StackSampler(self.interval) if self.sampling else CProfiler()
+        # leave tracing alone if it was already on (python -X tracemalloc)
+        trace = self.tracemalloc and not tracemalloc.is_tracing()
+        if trace:
+            tracemalloc.start(25)
+        started = time.perf_counter()
+        profiler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.stop()
+            elapsed_us = int((time.perf_counter() - started) * 1e6)
+            snapshot = peak = None
+            if trace:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+        try:
+            self.write(request, profiler, elapsed_us, snapshot, peak)
+        except OSError:
+            logger.exception("could not write request profile")
+        return response
+
+    def write(self, request, profiler, elapsed_us, snapshot, peak):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        stem = f"{endpoint_name(request.path_info)}__{int(time.time() * 1000)}_{os.getpid()}_{elapsed_us}"
+        profiler.dump(self.directory / f"{stem}{profiler.suffix}")
+
+        if snapshot is not None:
+            lines = [f"{request.method} {request.path_info} peak={peak} bytes"]
+            lines += [str(stat) for stat in snapshot.statistics("lineno")[:50]]
+            (self.directory / f"{stem}.alloc.txt").write_text("\n".join(lines) + "\n")
+
+        self.rotate()
+
+    def rotate(self):
+        files = [path for path in self.directory.iterdir() if FILENAME.match(path.name)]
+        files.sort(key=lambda path: int(FILENAME.match(path.name)["timestamp"]))
+        for path in files[:max(len(files) - self.max_files, 0)]:
+            path.unlink(missing_ok=True)
+            path.with_suffix(".alloc.txt").unlink(missing_ok=True)
@@ -0,0 +1,163 @@
+"""
+Pre-generated OpenAPI schema.
+
+`manage.py build_openapi_schema` renders the schema once at build or deploy
+time into OPENAPI_SCHEMA_DIR, as JSON and YAML plus gzip copies. The view
+below serves those bytes from memory with an ETag per encoding. If the files are missing,
+the schema is generated in-process on first use and kept for the life of
+the worker.
+"""
+import gzip
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from django.views import View
+
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    "json": ("schema.json", "application/vnd.oai.openapi+json"),
+    "yaml": ("schema.yaml", "application/vnd.oai.openapi"),
+}
+
+
+class SchemaDocument:
+    """One rendered format, with its gzip copy and ETag computed once."""
+
+    def __init__(self, content, content_type, gzipped=None):
+        self.content = content
+        self.content_type = content_type
+        self.gzipped = gzipped if gzipped is not None else gzip.compress(content, 9, mtime=0)
+        digest = hashlib.sha256(content).hexdigest()[:32]
+        # the two bodies differ, so caches must not swap one for the other
+        self.etag = '"%s"' % digest
+        self.gzip_etag = '"%s-gzip"' % digest
+
+
+def schema_dir():
+    return Path(getattr(settings, "OPENAPI_SCHEMA_DIR", settings.BASE_DIR / "openapi"))
+
+
+def generate():
+    """Run drf-spectacular's generator and return {format: bytes}."""
+    from drf_spectacular.generators import SchemaGenerator
+    from drf_spectacular.renderers import OpenApiJsonRenderer, OpenApiYamlRenderer
+    import authentication.schema  # noqa: F401 (registers the JWT scheme extension)
+
+    schema = SchemaGenerator().get_schema(request=None, public=True)
+    return {
+        "json": OpenApiJsonRenderer().render(schema, renderer_context={}),
+        "yaml": OpenApiYamlRenderer().render(schema, renderer_context={}),
+    }
+
+
+def write(directory=None):
+    directory = Path(directory or schema_dir())
+    directory.mkdir(parents=True, exist_ok=True)
+    written = []
+    for fmt, content in generate().items():
+        filename, content_type = FORMATS[fmt]
+        document = SchemaDocument(content, content_type)
+        (directory / filename).write_bytes(document.content)
+        (directory / f"{filename}.gz").write_bytes(document.gzipped)
+        written.append(directory / filename)
+    return written
+
+
+_documents = None
+_lock = threading.Lock()
+
+
+def load():
+    """Return {format: SchemaDocument}, reading the files or generating once."""
+    global _documents
+    if _documents is not None:
+        return _documents
+
+    with _lock:
+        if _documents is None:
+            directory = schema_dir()
+            documents = {}
+            for fmt, (filename, content_type) in FORMATS.items():
+                path = directory / filename
+                if not path.exists():
+                    break
+                gz_path = directory / f"{filename}.gz"
+                gzipped = gz_path.read_bytes() if gz_path.exists() else None
+                documents[fmt] = SchemaDocument(path.read_bytes(), content_type, gzipped)
+            else:
+                _documents = documents
+                return _documents
+
+            logger.warning(
+                "OpenAPI schema files not found in %s, generating in-process; "
+                "run `manage.py build_openapi_schema` at deploy time", directory
+            )
+            _documents = {
+                fmt: SchemaDocument(content, FORMATS[fmt][1])
+                for fmt, content in generate().items()
+            }
+    return _documents
+
+
+def reset():
+    global _documents
+    _documents = None
+
+
+def accepts_gzip(header):
+    """Whether an Accept-Encoding header allows gzip, honouring q-values."""
+    qualities = {}
+    for item in header.split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding.lower()] = quality
+    return qualities.get("gzip", qualities.get("x-gzip", qualities.get("*", 0.0))) > 0
+
+
+class CachedSchemaView(View):
+    """
+    Drop-in replacement for SpectacularAPIView that never introspects views
+    at request time. YAML by default, JSON with `?format=json` or a JSON
+    Accept header.
+    """
+    http_method_names = ["get", "head"]
+
+    def get(self, request, *args, **kwargs):
+        fmt = request.GET.get("format")
+        if fmt not in FORMATS:
+            fmt = "json" if "json" in request.headers.get("Accept", "") else "yaml"
+        document = load()[fmt]
+
+        gzipped = accepts_gzip(request.headers.get("Accept-Encoding", ""))
+        etag = document.gzip_etag if gzipped else document.etag
+
+        # weak comparison, as If-None-Match asks for
+        if_none_match = {tag.removeprefix("W/") for tag in parse_etags(request.headers.get("If-None-Match", ""))}
+        if "*" in if_none_match or etag in if_none_match:
+            response = HttpResponseNotModified()
+        elif gzipped:
+            response = HttpResponse(document.gzipped, content_type=document.content_type)
+            response["Content-Encoding"] = "gzip"
+        else:
+            response = HttpResponse(document.content, content_type=document.content_type)
+
+        response["ETag"] = etag
+        response["Cache-Control"] = "public, max-age=%d" % getattr(settings, "OPENAPI_SCHEMA_MAX_AGE", 300)
+        patch_vary_headers(response, ("Accept", "Accept-Encoding"))
+        return response
@@ -48,7 +48,10 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'core.metrics.MetricsMiddleware',
+    'core.profiling.ProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'core.admission.AdmissionControlMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -59,6 +62,77 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'core.urls'
 
+# Request profiling (core.profiling), off while all three triggers are unset.
+# PROFILE_TRIGGER_TOKEN enables profiling of requests sending it in the
+# X-Profile-Token header; keep it secret.
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_URL_NAMES = []
+PROFILE_TRIGGER_TOKEN = None
+# 'cprofile' (exact, .prof) or 'sampling' (stack samples, .folded flame graphs)
+PROFILER = 'cprofile'
+PROFILE_SAMPLE_INTERVAL_MS = 1
+PROFILE_TRACEMALLOC = False
+PROFILE_DIR = BASE_DIR / 'profiles'
+PROFILE_MAX_FILES = 500
+
+# Negative-lookup filter for emails on login, MFA verification and password
+# reset (authentication.services.email_filter). Needs a shared cache with
+# several worker processes.
+EMAIL_FILTER_ENABLED = False
+EMAIL_FILTER_FALSE_POSITIVE_RATE = 0.01
+EMAIL_FILTER_REBUILD_INTERVAL = 3600
+EMAIL_FILTER_REFRESH_INTERVAL = 5
+
+# Profile pictures (authentication.services.picture_uploads), for uploads
+# through /me/ and the resumable /me/picture/uploads/. Part files of
+# unfinished uploads go to PROFILE_PICTURE_UPLOAD_DIR (default: a directory
+# under the system temp dir), which every worker must see; run
+# `manage.py prune_picture_uploads` periodically to delete expired ones.
+PROFILE_PICTURE_MAX_BYTES = 5 * 1024 * 1024
+PROFILE_PICTURE_MAX_DIMENSION = 4096
+PROFILE_PICTURE_MAX_OPEN_UPLOADS = 3
+PROFILE_PICTURE_UPLOAD_DIR = None
+PROFILE_PICTURE_UPLOAD_EXPIRY = 24 * 3600
+
+# Public user directory (authentication.services.user_directory): seconds a
+# user card stays cached; saves drop it earlier.
+USER_DIRECTORY_CACHE_TIMEOUT = 24 * 3600
+
+# Metrics (core.metrics), scraped at /api/metrics/. With several worker
+# processes set METRICS_DIR so they share one file-backed registry; empty it
+# when the server starts. Closed until METRICS_TOKEN is set; scrapers send it
+# as a bearer token.
+METRICS_ENABLED = True
+METRICS_DIR = None
+METRICS_TOKEN = None
+
+# Token introspection (authentication.services.introspection) at
+# /api/token/introspect/ for services that cannot verify JWTs themselves.
+# Closed until INTROSPECTION_TOKEN is set; callers send it as a bearer token.
+INTROSPECTION_TOKEN = None
+INTROSPECTION_MAX_TOKENS = 500
+
+# Admission control (core.admission): per process, so ADMISSION_CAPACITY
+# should match the worker's thread count. The classes below may hold at most
+# CAPACITY - RESERVED requests between them, running or queued; the rest is
+# kept for cheap reads such as /me.
+ADMISSION_CAPACITY = 16
+ADMISSION_RESERVED = 4
+ADMISSION_CLASSES = {
+    'password_hashing': {
+        'URL_NAMES': ['login', 'change-temp-password', 'password-reset-confirm'],
+        'LIMIT': 4,
+        'QUEUE': 8,
+        'TIMEOUT_MS': 1000,
+    },
+    'email': {
+        'URL_NAMES': ['register', 'password-reset-request', 'email-resend'],
+        'LIMIT': 2,
+        'QUEUE': 4,
+        'TIMEOUT_MS': 2000,
+    },
+}
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -84,9 +158,56 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # keep connections between requests, so the one core.warmup opens is
+        # still there for the first request; 0 closes it when a request ends
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+    }
+}
+
+# Cache shared by every worker process, and required once there is more than
+# one: auth-state versions (a deactivation or password change must reach all
+# workers at once), pending MFA logins and used TOTP codes, email coalescing,
+# upload state and the directory cards live here. A per-process LocMemCache
+# would let each worker go on trusting what it cached. The database cache
+# works anywhere once `python manage.py createcachetable` has run; in
+# production point it at Redis or Memcached instead, e.g.
+#
+#   CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+#                         'LOCATION': 'redis://127.0.0.1:6379/1'}}
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
     }
 }
 
+# User sharding: each alias listed here holds a slice of the users together
+# with their profiles and tokens, chosen by a hash of the email. The order is
+# part of the placement, so never reorder or resize it without moving users.
+# Empty keeps everything on 'default'. Locally, extra SQLite files can stand
+# in for the shards:
+#
+#   DATABASES['shard_1'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db_shard_1.sqlite3', 'CONN_MAX_AGE': 60}
+#   USER_SHARDS = ['default', 'shard_1']
+#
+# then run `python manage.py migrate --database=shard_1`.
+USER_SHARDS = []
+
+# `manage.py test` adds a second database, shard_1, for the sharding tests
+TEST_RUNNER = 'core.test_runner.ShardedTestRunner'
+
+DATABASE_ROUTERS = ['authentication.routers.UserShardRouter']
+
+
+# Same hasher as Django's default, timed for the password hash metrics
+PASSWORD_HASHERS = [
+    'authentication.hashers.TimedPBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -123,12 +244,26 @@ USE_TZ = True
 #rest framework 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'authentication.services.claims.ClaimsJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    # orjson when installed, same bytes as DRF's JSONRenderer (core.fastjson)
+    'DEFAULT_RENDERER_CLASSES': (
+        'core.fastjson.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'core.fastjson.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
+    # scopes of ScopedRateThrottle (login/verify-mfa/)
+    'DEFAULT_THROTTLE_RATES': {
+        'mfa_verify': '10/min',
+    },
 }
 
 SPECTACULAR_SETTINGS = {
@@ -139,6 +274,14 @@ SPECTACULAR_SETTINGS = {
     'COMPONENT_SPLIT_REQUEST': True
 }
 
+# Output of `manage.py build_openapi_schema`, served by core.schema.CachedSchemaView
+OPENAPI_SCHEMA_DIR = BASE_DIR / "openapi"
+OPENAPI_SCHEMA_MAX_AGE = 300
+
+# Run core.warmup.warmup() when wsgi.py / asgi.py is imported. Leave off with
+# `gunicorn --preload` and call it from a post_fork hook instead.
+WARMUP_ON_STARTUP = False
+
 # Simple JWT Configuration
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
@@ -162,6 +305,14 @@ STATIC_URL = 'static/'
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# How /media/ files are sent once the view allowed them (core.media):
+# "x-accel-redirect" (nginx, internal location MEDIA_ACCEL_PREFIX aliased to
+# MEDIA_ROOT), "x-sendfile" (Apache/lighttpd) or "django" (FileResponse,
+# for local runs).
+MEDIA_DELIVERY = "django"
+MEDIA_ACCEL_PREFIX = "/protected-media/"
+MEDIA_CACHE_MAX_AGE = 3600
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -179,6 +330,22 @@ EMAIL_PORT = '2525'
 EMAIL_USE_TLS = True
 DEFAULT_FROM_EMAIL = 'no-reply@cms.com'
 
+# Repeat reset / verification requests inside this window reuse the live
+# token and send no new email
+AUTH_EMAIL_COALESCE_WINDOW = timedelta(minutes=5)
+
+# Devices trusted after MFA skip the challenge for this long
+TRUSTED_DEVICE_LIFETIME = timedelta(days=30)
+
+# Authentication audit log (authentication.services.audit): "database",
+# "ndjson" (appended to AUDIT_LOG_PATH) or None to turn it off. Events are
+# buffered in memory and written every batch or interval, whichever is first.
+AUDIT_LOG_BACKEND = "database"
+AUDIT_LOG_PATH = BASE_DIR / "audit.ndjson"
+AUDIT_LOG_BUFFER_SIZE = 10000
+AUDIT_LOG_BATCH_SIZE = 200
+AUDIT_LOG_FLUSH_INTERVAL_MS = 500
+
 
 FRONTEND_BASE_URL = "http://localhost:8000/api"
 
@@ -0,0 +1,26 @@
+"""
+Test runner for `manage.py test`.
+
+Adds a second SQLite database, `shard_1`, so the sharding tests have two
+shards to spread users over. It exists only for the test run; the settings
+module stays the one production uses.
+"""
+from django.conf import settings
+from django.db import connections
+from django.test.runner import DiscoverRunner
+
+
+TEST_SHARD = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': settings.BASE_DIR / 'db_shard_1.sqlite3',
+}
+
+
+class ShardedTestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        if 'shard_1' not in settings.DATABASES:
+            settings.DATABASES['shard_1'] = TEST_SHARD
+            # built from DATABASES on first use; rebuilt with the new alias
+            connections.__dict__.pop('settings', None)
+        super().setup_test_environment(**kwargs)
@@ -14,17 +14,42 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path,include
-from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
+from django.utils.module_loading import import_string
+from authentication.views import media_view
+from core.metrics import metrics_view
+from core.schema import CachedSchemaView
+
+
+def lazy_view(dotted_path, **initkwargs):
+    """
+    Import the view class on its first request. Keeps drf_spectacular (and the
+    django.test / yaml modules it pulls in) out of worker start-up.
+    """
+    view = None
+
+    def dispatch(request, *args, **kwargs):
+        nonlocal view
+        if view is None:
+            view = import_string(dotted_path).as_view(**initkwargs)
+        return view(request, *args, **kwargs)
+
+    return dispatch
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('authentication.urls')),
-    # API Schema
-    path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
+    # Prometheus metrics (closed until METRICS_TOKEN is set)
+    path('api/metrics/', metrics_view, name='metrics'),
+    # API Schema (pre-generated by `manage.py build_openapi_schema`)
+    path('api/schema/', CachedSchemaView.as_view(), name='schema'),
     # Swagger UI
-    path('api/schema/swagger-ui/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
+    path('api/schema/swagger-ui/', lazy_view('drf_spectacular.views.SpectacularSwaggerView', url_name='schema'), name='swagger-ui'),
     # Redoc UI
-    path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
+    path('api/schema/redoc/', lazy_view('drf_spectacular.views.SpectacularRedocView', url_name='schema'), name='redoc'),
+    # access rules here, bytes from the front proxy (core.media)
+    path(settings.MEDIA_URL.strip('/') + '/<path:path>', media_view, name='media'),
 ]
@@ -0,0 +1,103 @@
+"""
+Worker warm-up.
+
+Pays the one-off costs of a fresh process (database connections, template
+compilation, password hasher and URL resolver construction, the OpenAPI
+schema) before the first request instead of during it.
+
+Call `warmup()` once per worker *after* it has forked. With
+`gunicorn --preload` the application module is imported in the master, so
+connections opened there would be shared by every child; call it from a
+`post_fork` hook instead:
+
+    def post_fork(server, worker):
+        from core.warmup import warmup
+        warmup()
+"""
+import logging
+import time
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+EMAIL_TEMPLATES = (
+    "emails/email_verification/verification_email.html",
+    "emails/mfa_code/mfa_code_email.html",
+    "emails/onboarding/welcome_email.html",
+    "emails/password_reset/reset_password_email.html",
+    "emails/temp_password/temp_password_email.html",
+)
+
+
+def _connect_databases():
+    from django.db import connections
+
+    for alias in connections:
+        # a connection without CONN_MAX_AGE is closed when the first request ends
+        if connections[alias].settings_dict.get("CONN_MAX_AGE"):
+            connections[alias].ensure_connection()
+
+
+def _load_templates():
+    from django.template.loader import get_template
+
+    for name in EMAIL_TEMPLATES:
+        get_template(name)
+
+
+def _load_hashers():
+    from django.contrib.auth.hashers import get_hashers
+
+    get_hashers()
+
+
+def _resolve_urls():
+    from django.urls import get_resolver
+
+    resolver = get_resolver()
+    resolver.url_patterns
+    # builds the reverse lookup tables used by reverse() and the admin
+    resolver.reverse_dict
+
+
+def _load_schema():
+    from core import schema
+
+    schema.load()
+
+
+STEPS = (
+    ("databases", _connect_databases),
+    ("templates", _load_templates),
+    ("hashers", _load_hashers),
+    ("urls", _resolve_urls),
+    ("schema", _load_schema),
+)
+
+
+def warmup(skip=()):
+    """Run each step once and return {step: seconds}. Failures are logged, not raised."""
+    timings = {}
+    for name, step in STEPS:
+        if name in skip:
+            continue
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception:
+            logger.exception("warm-up step %r failed", name)
+        timings[name] = time.perf_counter() - started
+    logger.info(
+        "worker warm-up done in %.1f ms (%s)",
+        sum(timings.values()) * 1000,
+        ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in timings.items()),
+    )
+    return timings
+
+
+def warmup_on_startup():
+    """Hook for wsgi.py / asgi.py, enabled with WARMUP_ON_STARTUP."""
+    if getattr(settings, "WARMUP_ON_STARTUP", False):
+        warmup()